@@ -0,0 +1,111 @@
+"""
+# api_responses.py
+API Response Models
+ブラウザに返す応答を、画面が使うフィールドだけの型付き・__slots__ 付きのモデルに絞り、
+orjson（あれば）でエンコードする。
+
+決済作成の結果（server_billing の dict）は PaymentIntent オブジェクト全体や計算の内訳を含むが、
+画面が使うのは client_secret と金額・状態だけなので、それ以外は返さない
+（応答が小さくなり、エンコードも速くなる。内部のメタデータも外に出ない）。
+"""
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Union
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson  # Optional: 標準の json より数倍速い。なければ標準の json で同じ形にエンコードする
+except ImportError:
+    orjson = None
+
+
+class FastJSONResponse(JSONResponse):
+    """orjson でエンコードする JSONResponse（dataclass のモデルもそのまま渡せる）"""
+
+    def render(self, content: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content)
+        return super().render(_plain(content))
+
+
+def _plain(value: Any) -> Any:
+    """モデルを dict にする（標準の json 用。dataclasses.asdict は値をコピーするので遅い）"""
+    slots = getattr(type(value), '__slots__', None)
+    if slots is None:
+        return value
+    return {name: _plain(getattr(value, name)) for name in slots}
+
+
+@dataclass(frozen=True)
+class BillingAmount:
+    """画面に表示する請求額"""
+
+    __slots__ = ('billing_amount', 'billing_hours', 'currency')
+    billing_amount: int
+    billing_hours: float
+    currency: str
+
+
+@dataclass(frozen=True)
+class PaymentIntentCreated:
+    """/api/create-payment-intent の成功時（カード入力フォームに渡す client_secret と金額）"""
+
+    __slots__ = ('success', 'payment_id', 'client_secret', 'amount', 'currency', 'status', 'billing_info')
+    success: bool
+    payment_id: str
+    client_secret: str
+    amount: int
+    currency: str
+    status: str
+    billing_info: BillingAmount
+
+
+@dataclass(frozen=True)
+class PaymentStatus:
+    """/api/payment-status の成功時"""
+
+    __slots__ = ('success', 'payment_intent_id', 'status', 'amount', 'currency')
+    success: bool
+    payment_intent_id: str
+    status: str
+    amount: int
+    currency: str
+
+
+@dataclass(frozen=True)
+class Failure:
+    """失敗時（retry_after はStripeを呼ばずに断ったときだけ値が入る）"""
+
+    __slots__ = ('success', 'error', 'retry_after')
+    success: bool
+    error: str
+    retry_after: Optional[float]
+
+
+def failure_response(result: Dict) -> Failure:
+    return Failure(False, result['error'], result.get('retry_after'))
+
+
+def payment_intent_response(result: Dict) -> Union[PaymentIntentCreated, Failure]:
+    """決済作成の結果を画面用に絞る"""
+    if not result['success']:
+        return failure_response(result)
+    intent = result['payment_intent']
+    billing_info = result['billing_info']
+    return PaymentIntentCreated(
+        success=True,
+        payment_id=intent['id'],
+        client_secret=result['client_secret'],
+        amount=intent['amount'],
+        currency=intent['currency'],
+        status=intent['status'],
+        billing_info=BillingAmount(billing_info['billing_amount'], billing_info['billing_hours'],
+                                   billing_info['currency']),
+    )
+
+
+def payment_status_response(result: Dict) -> Union[PaymentStatus, Failure]:
+    """決済の状態を画面用に絞る"""
+    if not result['success']:
+        return failure_response(result)
+    return PaymentStatus(True, result['payment_intent_id'], result['status'], result['amount'], result['currency'])
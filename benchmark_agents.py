@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+ノードエージェントのベンチマーク
+数千台のノードのエージェント（node_agent.HeartbeatAgent）を1プロセス内で模擬し、
+10秒ごとのハートビートを60秒ごとにまとめて web_app.py の /api/agent/heartbeats へ送る。
+時刻は模擬するので、数時間分の送信を数秒で流せる。
+
+- コレクター: 1回の送信の処理時間と、全ノードの1回分の送信を受け切るまでの時間
+- 送信量: 1ハートビートあたりのバイト数（同じ内容の JSON との比較）
+- 一部のノードは同じ本文を2回送り（応答が失われた再送）、二重に数えないことを確認する
+- 実際のエージェントをサブプロセスで動かし、常駐メモリ・CPU時間と、
+  標準ライブラリ以外を読み込んでいないことを確認する
+"""
+
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from urllib.parse import urlsplit
+
+from fake_stripe import FakeStripeServer, run_app_in_thread
+from node_agent import CONTENT_TYPE, HeartbeatAgent, encode_batch
+
+AGENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'node_agent.py')
+
+# node_agent が読み込むモジュールのうち標準ライブラリ以外のもの（起動時に site が読むものは除く）
+IMPORT_CHECK = """
+import json
+import sys
+before = set(sys.modules)
+import node_agent
+print(json.dumps(sorted(name for name in set(sys.modules) - before
+                        if name.split('.')[0] not in sys.stdlib_module_names and name != 'node_agent')))
+"""
+
+
+def process_usage(pid: int) -> Dict:
+    """常駐メモリ（MB）とCPU時間（秒）"""
+    with open(f'/proc/{pid}/status') as f:
+        rss_kb = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {'rss_mb': rss_kb / 1024, 'cpu_seconds': (int(fields[11]) + int(fields[12])) / ticks}
+
+
+def resend(base_url: str, frames: List[bytes]) -> int:
+    """応答が失われたときの再送と同じ本文をもう一度送る"""
+    parts = urlsplit(base_url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port, timeout=10)
+    try:
+        body = encode_batch(frames)
+        connection.request('POST', '/api/agent/heartbeats', body, {'Content-Type': CONTENT_TYPE})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def simulate_fleet(base_url: str, args) -> Dict:
+    """模擬時刻で nodes 台 x rounds 回の送信を流す"""
+    rng = random.Random(3)
+    beats_per_ship = int(args.ship_every / args.interval)
+    start = time.time() - args.rounds * args.ship_every
+    agents = [HeartbeatAgent(base_url, f"node-{index:05d}", args.interval, args.ship_every,
+                             boot_time=start - rng.uniform(0, 86400)) for index in range(args.nodes)]
+    resent = set(rng.sample(range(args.nodes), max(1, args.nodes * args.resend_percent // 100)))
+    latencies: List[float] = []
+    round_seconds: List[float] = []
+    encode_seconds = 0.0
+    json_bytes = 0
+    resends = 0
+
+    def ship(index: int):
+        nonlocal encode_seconds, resends
+        agent = agents[index]
+        began = time.thread_time()
+        agent.seal()
+        encode_seconds += time.thread_time() - began
+        frames = [frame for _, _, frame in agent.pending]
+        sent = time.perf_counter()
+        agent.ship()
+        latencies.append(time.perf_counter() - sent)
+        if index in resent and resend(base_url, frames) == 200:
+            resends += 1
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for round_index in range(args.rounds):
+            for index, agent in enumerate(agents):
+                base = start + round_index * args.ship_every
+                for beat in range(beats_per_ship):
+                    at = base + beat * args.interval + rng.uniform(0, 0.05)
+                    agent.beat(at)
+                    json_bytes += len(json.dumps({'node_id': agent.node_id, 'timestamp': at,
+                                                  'uptime_seconds': at - agent.boot_time}))
+            began = time.perf_counter()
+            list(pool.map(ship, range(args.nodes)))
+            round_seconds.append(time.perf_counter() - began)
+
+    latencies.sort()
+    heartbeats = args.nodes * args.rounds * beats_per_ship
+    return {
+        'agents': agents,
+        'heartbeats': heartbeats,
+        'resends': resends,
+        'round_seconds': round_seconds,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000,
+        'bytes': sum(agent.bytes_sent for agent in agents),
+        'json_bytes': json_bytes,
+        'encode_us': encode_seconds / (args.nodes * args.rounds) * 1e6,
+    }
+
+
+def run_real_agent(base_url: str, args) -> Dict:
+    """node_agent.py を実際に起動し、短い間隔で動かしたときのメモリとCPU時間"""
+    env = {**os.environ, 'PYTHONDONTWRITEBYTECODE': '1'}
+    imports = subprocess.run([sys.executable, '-c', IMPORT_CHECK], capture_output=True, text=True,
+                             env=env, cwd=os.path.dirname(AGENT_PATH), check=True)
+    process = subprocess.Popen([sys.executable, AGENT_PATH, base_url, '--node-id', 'real-agent',
+                                '--interval', str(args.real_interval), '--ship-every', str(args.real_ship_every)],
+                               env=env, stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(args.real_seconds)
+        usage = process_usage(process.pid)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait(timeout=10)
+    return {**usage, 'non_stdlib': json.loads(imports.stdout)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Thousands of simulated node agents shipping heartbeats to one collector")
+    parser.add_argument('--nodes', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=10, help="ship intervals to simulate")
+    parser.add_argument('--interval', type=float, default=10.0, help="seconds between heartbeats")
+    parser.add_argument('--ship-every', type=float, default=60.0, help="seconds between batches")
+    parser.add_argument('--concurrency', type=int, default=32, help="agents shipping at the same moment")
+    parser.add_argument('--resend-percent', type=int, default=5, help="agents whose batch is sent twice")
+    parser.add_argument('--real-seconds', type=float, default=5.0, help="how long the real agent process runs")
+    parser.add_argument('--real-interval', type=float, default=0.1)
+    parser.add_argument('--real-ship-every', type=float, default=1.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp, FakeStripeServer() as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        os.environ['JOB_QUEUE_PATH'] = os.path.join(tmp, 'jobs.db')
+        import web_app
+
+        server, thread, base_url = run_app_in_thread(web_app.app)
+        try:
+            fleet = simulate_fleet(base_url, args)
+            real = run_real_agent(base_url, args)
+            registry = web_app.get_node_registry()
+            stats = registry.stats()
+            real_node = registry.get('real-agent')
+            nodes = [registry.get(agent.node_id) for agent in fleet['agents']]
+        finally:
+            server.should_exit = True
+            thread.join(timeout=10)
+
+    per_ship = fleet['bytes'] / (args.nodes * args.rounds)
+    print("\n" + "=" * 72)
+    print(f"  ノード {args.nodes:,} 台 x {args.rounds} 回の送信（{args.interval:g}秒ごと、{args.ship_every:g}秒ごとに送信）")
+    print("=" * 72)
+    print(f"  全ノード1回分の送信を受け切るまで: 中央値 {statistics.median(fleet['round_seconds']):.2f}秒"
+          f"（{args.nodes / statistics.median(fleet['round_seconds']):,.0f} batches/s）")
+    print(f"  1回の送信: p50 {fleet['p50_ms']:.1f} ms, p99 {fleet['p99_ms']:.1f} ms, "
+          f"{per_ship:.0f} bytes, エンコード {fleet['encode_us']:.0f} µs")
+    print(f"  1ハートビートあたり: {fleet['bytes'] / fleet['heartbeats']:.1f} bytes "
+          f"（JSON {fleet['json_bytes'] / fleet['heartbeats']:.1f} bytes, "
+          f"{fleet['json_bytes'] / fleet['bytes']:.0f}x）")
+    print(f"  コレクター: {stats}")
+    print(f"  実エージェント: RSS {real['rss_mb']:.1f} MB, CPU {real['cpu_seconds']:.2f}秒 / "
+          f"{args.real_seconds:g}秒（{args.real_interval:g}秒ごとのハートビート）, "
+          f"標準ライブラリ以外: {real['non_stdlib'] or 'なし'}")
+    print("=" * 72)
+
+    beats_per_node = args.rounds * int(args.ship_every / args.interval)
+    errors = []
+    if stats['heartbeats'] - (real_node or {}).get('heartbeats', 0) != fleet['heartbeats']:
+        errors.append("コレクターが数えたハートビートが送った数と一致しません")
+    if any(node is None or node['heartbeats'] != beats_per_node for node in nodes):
+        errors.append("ハートビートの数が合わないノードがあります")
+    if stats['duplicates'] != fleet['resends']:
+        errors.append(f"再送 {fleet['resends']} 件のうち重複として捨てたのは {stats['duplicates']} 件です")
+    if any(node['gaps'] for node in nodes):
+        errors.append("途切れていないノードに途切れが記録されています")
+    if real['non_stdlib']:
+        errors.append(f"エージェントが標準ライブラリ以外を読み込んでいます: {real['non_stdlib']}")
+    if real_node is None or not real_node['heartbeats']:
+        errors.append("実エージェントのハートビートが届いていません")
+    for message in errors:
+        print(f"❌ {message}")
+    if errors:
+        raise SystemExit(1)
+    print("✅ 全ノードのハートビートを過不足なく集計し、再送は二重に数えなかった")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Stripeオブジェクトキャッシュのベンチマーク
+フェイクStripeに顧客・価格を作り、偏りのある（一部のIDに集中する）参照を毎回Stripeから取る場合と
+読み取りキャッシュ経由の場合で、1件あたりのレイテンシとStripeへの取得リクエスト数を比べる。
+存在しないIDの参照（ネガティブキャッシュ）、同じIDへの同時参照の合流、Webhookでの無効化も確認する。
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import time
+from typing import Dict, List, Tuple
+
+from fake_stripe import FakeStripeServer
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+def make_lookups(customers: List[str], prices: List[str], count: int, missing_rate: float,
+                 seed: int = 0) -> List[Tuple[str, str]]:
+    """Zipf風に偏った参照列（順位 r のIDが 1/r の重み）。missing_rate の割合で存在しないIDを混ぜる"""
+    rng = random.Random(seed)
+    lookups = []
+    for _ in range(count):
+        if rng.random() < missing_rate:
+            lookups.append(('customer', f"cus_missing_{rng.randrange(20)}"))
+            continue
+        kind, ids = ('customer', customers) if rng.random() < 0.7 else ('price', prices)
+        weights = [1 / rank for rank in range(1, len(ids) + 1)]
+        lookups.append((kind, rng.choices(ids, weights)[0]))
+    return lookups
+
+
+async def replay(manager, lookups: List[Tuple[str, str]], concurrency: int, cached: bool) -> List[float]:
+    latencies: List[float] = []
+    queue = iter(lookups)
+
+    async def direct(kind: str, object_id: str):
+        try:
+            await manager._retrieve_async(kind, object_id)
+        except Exception:
+            pass  # 404（存在しないID）
+
+    lookup = manager.get_stripe_object if cached else direct
+
+    async def worker():
+        for kind, object_id in queue:
+            start = time.perf_counter()
+            await lookup(kind, object_id)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies
+
+
+async def run(args, fake: FakeStripeServer) -> Dict:
+    from server_billing import AsyncServerBillingManager
+
+    manager = AsyncServerBillingManager(max_connections=args.concurrency)
+    await asyncio.to_thread(manager.warm_up)
+    v1 = manager.client.v1
+    report: Dict = {}
+    try:
+        customers = [(await v1.customers.create_async(params={'email': f"user{i}@example.com"})).id
+                     for i in range(args.customers)]
+        prices = [(await v1.prices.create_async(params={'currency': 'jpy', 'unit_amount': 100 + i})).id
+                  for i in range(args.prices)]
+        lookups = make_lookups(customers, prices, args.lookups, args.missing_rate)
+
+        for cached in (False, True):
+            fake.reset()
+            started = time.perf_counter()
+            latencies = await replay(manager, lookups, args.concurrency, cached)
+            report['cached' if cached else 'direct'] = {
+                'elapsed': time.perf_counter() - started,
+                'p50_us': statistics.median(latencies) * 1e6,
+                'p99_us': percentile(latencies, 0.99) * 1e6,
+                'stripe_requests': sum(fake.retrieved.values()),
+            }
+        report['cache'] = manager.object_cache.stats()
+
+        # キャッシュに乗っている状態での参照だけの所要時間
+        hot = [(kind, object_id) for kind, object_id in lookups[:10000]
+               if not object_id.startswith('cus_missing')]
+        started = time.perf_counter()
+        for kind, object_id in hot:
+            await manager.get_stripe_object(kind, object_id)
+        report['hit_us'] = (time.perf_counter() - started) / len(hot) * 1e6
+
+        # 同じIDへの同時参照は1回の取得にまとまる
+        fake.reset()
+        manager.object_cache.clear()
+        results = await asyncio.gather(*(manager.get_stripe_object('customer', customers[0])
+                                         for _ in range(args.burst)))
+        report['burst_ok'] = sum(result['success'] for result in results)
+        report['burst_stripe_requests'] = fake.retrieved['customer']
+
+        # 作成した決済は直後の状態表示でStripeを呼ばず、Webhookで無効化したら取り直す
+        fake.reset()
+        payment = await manager.create_test_payment(idempotency_key='cache-bench')
+        intent_id = payment['payment_id']
+        await manager.get_payment_status(intent_id)
+        report['status_after_create_requests'] = fake.retrieved['payment_intent']
+        manager.object_cache.invalidate_event({'type': 'payment_intent.succeeded',
+                                               'data': {'object': fake.objects[intent_id]}})
+        await manager.get_payment_status(intent_id)
+        report['status_after_webhook_requests'] = fake.retrieved['payment_intent']
+    finally:
+        await manager.aclose()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stripe reads with and without the read-through object cache")
+    parser.add_argument('--customers', type=int, default=200)
+    parser.add_argument('--prices', type=int, default=20)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--missing-rate', type=float, default=0.05, help="fraction of lookups for unknown IDs")
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--burst', type=int, default=100, help="concurrent lookups of one uncached customer")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Stripe latency")
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency, seed=1) as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        report = asyncio.run(run(args, fake))
+
+    print("\n" + "=" * 72)
+    print(f"{'mode':>8}{'elapsed s':>12}{'lookups/s':>12}{'p50 µs':>12}{'p99 µs':>12}{'stripe reqs':>14}")
+    print("=" * 72)
+    for mode in ('direct', 'cached'):
+        row = report[mode]
+        print(f"{mode:>8}{row['elapsed']:>12.2f}{args.lookups / row['elapsed']:>12,.0f}"
+              f"{row['p50_us']:>12,.1f}{row['p99_us']:>12,.1f}{row['stripe_requests']:>14,}")
+    print("=" * 72)
+    for kind, stats in report['cache'].items():
+        if stats['hits'] or stats['misses']:
+            print(f"  {kind:>15}: hit ratio {stats['hit_ratio']:.1%} (hits {stats['hits']}, "
+                  f"negative {stats['negative_hits']}, misses {stats['misses']}, coalesced {stats['coalesced']})")
+    print(f"  キャッシュヒット時の参照: {report['hit_us']:.1f} µs/件")
+    print(f"  同じ顧客への同時参照 {args.burst}件 -> Stripeへの取得 {report['burst_stripe_requests']}回 "
+          f"({report['burst_ok']}件成功)")
+    print(f"  決済作成直後の状態表示: Stripeへの取得 {report['status_after_create_requests']}回、"
+          f"Webhook受信後: {report['status_after_webhook_requests']}回")
+
+    ok = (report['burst_stripe_requests'] == 1 and report['burst_ok'] == args.burst
+          and report['status_after_create_requests'] == 0 and report['status_after_webhook_requests'] == 1)
+    if not ok:
+        print("❌ 合流・書き込み時のキャッシュ・無効化のいずれかが期待どおりではありません")
+        raise SystemExit(1)
+    print("✅ 同時参照は1回の取得にまとまり、作成済みの決済はWebhookまでキャッシュから返る")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+履歴エクスポートのベンチマーク
+数百万件の過去履歴を持つフェイクStripeから PaymentIntent を書き出し、形式ごとの1秒あたりの行数と
+実行中のメモリ増加（RSSのピーク − 開始時）を測る。件数を10倍にしてもメモリが増えないこと、
+2回目の実行では新しく作成した分だけが書き出されること、HTTPのチャンク転送でも同じ行数が届くことを確認する。
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+import psutil
+
+from fake_stripe import FakeStripeServer, run_app_in_thread
+
+
+def measure(func: Callable[[], object]) -> Tuple[object, float, float]:
+    """func() の (戻り値, 所要秒, RSSのピーク増加MB)。RSSは別スレッドで10msごとに測る"""
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    try:
+        result = func()
+    finally:
+        elapsed = time.perf_counter() - started
+        done.set()
+        sampler.join()
+    return result, elapsed, (peak[0] - baseline) / 2 ** 20
+
+
+def count_lines_over_http(base_url: str, path: str) -> Tuple[int, float, int]:
+    """チャンク転送の応答を読み捨てながら (行数, 最初のチャンクまでの秒, チャンク数) を数える"""
+    import httpx
+
+    started = time.perf_counter()
+    first_chunk = None
+    lines = chunks = 0
+    with httpx.stream('GET', base_url + path, timeout=None) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw():
+            if first_chunk is None:
+                first_chunk = time.perf_counter() - started
+            lines += chunk.count(b'\n')
+            chunks += 1
+    return lines, first_chunk or 0.0, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incremental billing history export from a fake Stripe API")
+    parser.add_argument('--objects', type=int, default=1_000_000, help="payment intents in the fake history")
+    parser.add_argument('--formats', nargs='+', default=['ndjson', 'csv', 'parquet'])
+    parser.add_argument('--row-group-size', type=int, default=10000)
+    parser.add_argument('--new-objects', type=int, default=250, help="created before the incremental run")
+    args = parser.parse_args()
+
+    with FakeStripeServer() as fake, tempfile.TemporaryDirectory() as tmp:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        import billing_export
+        from server_billing import ServerBillingManager
+
+        manager = ServerBillingManager()
+        formats = [fmt for fmt in args.formats if fmt in ('ndjson', 'csv') or billing_export.pyarrow is not None]
+        if formats != args.formats:
+            print("⚠️ pyarrow がないので Parquet / Arrow は省略します")
+
+        rows: Dict[str, Dict] = {}
+        for size in (args.objects // 10, args.objects):
+            fake.seed_history('payment_intent', size)
+            for fmt in formats:
+                out_dir = os.path.join(tmp, f"{fmt}-{size}")
+                report, elapsed, memory = measure(lambda: billing_export.export_to_file(
+                    manager, 'payment_intent', out_dir, fmt, row_group_size=args.row_group_size))
+                rows[f"{fmt} {size:,}"] = {'rows': report['rows'], 'elapsed': elapsed, 'memory_mb': memory,
+                                           'bytes': os.path.getsize(report['path']), 'out_dir': out_dir}
+                print(f"  {fmt} {size:,}: {report['rows']:,} rows in {elapsed:.1f}s")
+
+        # 2回目: カーソルより新しいものだけ
+        for index in range(args.new_objects):
+            manager.create_test_payment(idempotency_key=f"export-bench-{index}")
+        last = rows[f"{formats[0]} {args.objects:,}"]
+        incremental, incremental_elapsed, _ = measure(lambda: billing_export.export_to_file(
+            manager, 'payment_intent', last['out_dir'], formats[0], row_group_size=args.row_group_size))
+
+        # HTTP: 同じジェネレーターをチャンク転送で流す
+        os.environ['JOB_QUEUE_PATH'] = os.path.join(tmp, 'jobs.db')
+        import web_app
+
+        server, thread, base_url = run_app_in_thread(web_app.app)
+        try:
+            (lines, first_chunk, chunks), http_elapsed, http_memory = measure(lambda: count_lines_over_http(
+                base_url, f"/api/export/payment_intents?format=ndjson&row_group_size={args.row_group_size}"))
+        finally:
+            server.should_exit = True
+            thread.join(timeout=5)
+
+    print("\n" + "=" * 78)
+    print(f"{'export':>20}{'rows':>12}{'rows/s':>10}{'MB/s':>8}{'file MB':>10}{'RSS +MB':>10}")
+    print("=" * 78)
+    for name, row in rows.items():
+        print(f"{name:>20}{row['rows']:>12,}{row['rows'] / row['elapsed']:>10,.0f}"
+              f"{row['bytes'] / row['elapsed'] / 2 ** 20:>8.1f}{row['bytes'] / 2 ** 20:>10.1f}{row['memory_mb']:>10.1f}")
+    print("=" * 78)
+    print(f"  2回目（カーソル以降）: {incremental['rows']:,}行 in {incremental_elapsed * 1000:.0f} ms")
+    print(f"  HTTP ndjson: {lines:,}行, {chunks:,}チャンク, 最初のチャンクまで {first_chunk * 1000:.0f} ms, "
+          f"{lines / http_elapsed:,.0f} rows/s, RSS +{http_memory:.1f} MB")
+
+    expected = args.objects + args.new_objects
+    ok = (incremental['rows'] == args.new_objects and lines == expected
+          and all(row['rows'] == int(name.split()[1].replace(',', '')) for name, row in rows.items()))
+    if not ok:
+        print("❌ 書き出した行数が履歴の件数と一致しません")
+        raise SystemExit(1)
+    print("✅ 全件・増分・HTTPとも件数一致")
+
+
+if __name__ == "__main__":
+    main()
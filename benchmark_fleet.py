@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+フリート課金のベンチマーク
+FleetBillingEngine の一括計算と、ServerBillingManager.calculate_billing_amount を
+サーバーごとにループで呼ぶ従来方式を比較し、結果が一致することも確認する。
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from fleet_billing import FleetBillingEngine
+from pricing import FlatRate
+from server_billing import ServerBillingManager
+
+
+def make_fleet(servers: int, rates: int, seed: int = 0):
+    """ランダムな稼働区間と料金IDを生成（1分未満の短い区間も含める）"""
+    rng = np.random.default_rng(seed)
+    now = time.time()
+    stop_times = now - rng.uniform(0, 3600, servers)
+    uptime = np.where(rng.random(servers) < 0.05,
+                      rng.uniform(0, 60, servers),          # 1分未満
+                      rng.uniform(60, 30 * 24 * 3600, servers))
+    start_times = stop_times - uptime
+    rate_ids = rng.integers(0, rates, servers)
+    return start_times, stop_times, rate_ids
+
+
+def loop_billing(manager: ServerBillingManager, hourly_rates, start_times, stop_times, rate_ids):
+    """従来方式: 1サーバーずつ calculate_billing_amount を呼ぶ"""
+    schedules = [FlatRate(rate, manager.currency) for rate in hourly_rates]
+    amounts = []
+    for start, stop, rate_id in zip(start_times.tolist(), stop_times.tolist(), rate_ids.tolist()):
+        manager.rate_schedule = schedules[rate_id]
+        billing_info = manager.calculate_billing_amount(manager.format_uptime(stop - start))
+        amounts.append(billing_info['billing_amount'])
+    return amounts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vectorized fleet billing vs per-server loop")
+    parser.add_argument('--servers', type=int, default=100_000)
+    parser.add_argument('--rates', type=int, default=8, help="number of distinct hourly rates")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    hourly_rates = [50 * (i + 1) for i in range(args.rates)]
+    start_times, stop_times, rate_ids = make_fleet(args.servers, args.rates)
+
+    engine = FleetBillingEngine(hourly_rates)
+    manager = ServerBillingManager()
+
+    vector_times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = engine.calculate(start_times, stop_times, rate_ids)
+        vector_times.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    loop_amounts = loop_billing(manager, hourly_rates, start_times, stop_times, rate_ids)
+    loop_time = time.perf_counter() - start
+
+    mismatches = int(np.count_nonzero(result['billing_amount'] != np.asarray(loop_amounts)))
+    vector_time = min(vector_times)
+
+    print("\n" + "=" * 50)
+    print(f"🧮 フリート課金ベンチマーク ({args.servers:,}サーバー, {args.rates}料金)")
+    print("=" * 50)
+    print(f"ループ (ServerBillingManager): {loop_time * 1000:.1f} ms")
+    print(f"一括 (FleetBillingEngine):     {vector_time * 1000:.1f} ms")
+    print(f"高速化: {loop_time / vector_time:.0f}x")
+    print(f"課金額の不一致: {mismatches}件")
+    print(f"合計課金額: {int(result['billing_amount'].sum()):,}円")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
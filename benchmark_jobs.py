@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+ジョブキューのベンチマーク
+インボイス作成をその場でStripeに送る場合と、永続キューに積んですぐ返す場合の1リクエストあたりの
+レイテンシを比べ、積んだジョブをワーカープールがフェイクStripeに流し切るスループットを測る。
+途中でワーカーが落ちた（取り出したまま終わらない）ジョブもリース切れ後に再実行され、
+エラー注入下でもインボイスがジョブ数ちょうど作成されること（重複・取りこぼしなし）を確認する。
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import os
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+from fake_stripe import FakeStripeServer
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)]
+
+
+async def run(args, queue_path: str, fake: FakeStripeServer) -> Dict:
+    from job_queue import JobWorker
+    from server_billing import AsyncServerBillingManager
+    from settings import get_settings
+
+    settings = dataclasses.replace(get_settings(), job_queue_path=queue_path, job_queue_durable=args.durable)
+    manager = AsyncServerBillingManager(max_connections=args.concurrency, settings=settings)
+    await asyncio.to_thread(manager.warm_up)
+    report: Dict = {}
+    try:
+        # その場でStripeに送る場合のレイテンシ（比較用）
+        inline = []
+        for index in range(args.inline):
+            start = time.perf_counter()
+            await manager.create_invoice(f"cus_inline_{index}", idempotency_key=f"inline-{index}")
+            inline.append(time.perf_counter() - start)
+        report['inline_p50_ms'] = statistics.median(inline) * 1000
+        report['inline_p99_ms'] = percentile(inline, 0.99) * 1000
+
+        # 積むだけ（Stripeは呼ばない）
+        fake.reset()
+        fake.error_rate = args.error_rate
+        enqueue = []
+        for index in range(args.jobs):
+            start = time.perf_counter()
+            manager.enqueue_invoice(f"cus_{index % 500:04d}", idempotency_key=f"bench-{index}")
+            enqueue.append(time.perf_counter() - start)
+        report['enqueue_p50_us'] = statistics.median(enqueue) * 1e6
+        report['enqueue_p99_us'] = percentile(enqueue, 0.99) * 1e6
+        report['enqueue_per_s'] = args.jobs / sum(enqueue)
+
+        # クラッシュ: ワーカーが1バッチ取り出したまま落ちる → リース切れ後に別のワーカーが再実行
+        crashed = manager.job_queue.claim(args.batch_size, lease=1.0)
+        report['crashed_jobs'] = len(crashed)
+
+        worker = JobWorker(manager.job_queue, manager, concurrency=args.concurrency, batch_size=args.batch_size,
+                           max_attempts=10, poll_interval=0.1, max_backoff=0.5)
+        started = time.perf_counter()
+        while True:
+            counts = manager.job_queue.counts()
+            if counts['queued'] == 0 and counts['running'] == 0:
+                break
+            if await worker.run_once() == 0:
+                await asyncio.sleep(0.05)
+        report['drain_seconds'] = time.perf_counter() - started
+        report['drain_per_s'] = args.jobs / report['drain_seconds']
+        report['counts'] = manager.job_queue.counts()
+        report['worker'] = worker.stats()
+    finally:
+        await manager.aclose()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enqueue latency and drain throughput of the durable job queue")
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--inline', type=int, default=50, help="invoices created inline for comparison")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Stripe latency (s)")
+    parser.add_argument('--error-rate', type=float, default=0.05, help="fake Stripe 500 rate while draining")
+    parser.add_argument('--durable', action='store_true', help="fsync every enqueue (synchronous=FULL)")
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency, seed=1) as fake, tempfile.TemporaryDirectory() as tmp:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        report = asyncio.run(run(args, os.path.join(tmp, 'jobs.db'), fake))
+        invoices = fake.created['invoice']
+        stats = fake.stats()
+
+    print("\n" + "=" * 60)
+    print(f"その場でStripeに送る  : p50 {report['inline_p50_ms']:.1f}ms  p99 {report['inline_p99_ms']:.1f}ms")
+    print(f"キューに積む          : p50 {report['enqueue_p50_us']:.0f}µs  p99 {report['enqueue_p99_us']:.0f}µs "
+          f"({report['enqueue_per_s']:,.0f} 件/秒{', fsync' if args.durable else ''})")
+    print(f"流し切り              : {args.jobs:,} 件 / {report['drain_seconds']:.2f}s "
+          f"= {report['drain_per_s']:,.0f} 件/秒 (並列 {args.concurrency}, 遅延 {args.latency * 1000:.0f}ms)")
+    print(f"再試行                : {report['worker']['retried']} 件 (500応答 {stats['statuses'].get(500, 0)} 件)")
+    print(f"クラッシュで放置      : {report['crashed_jobs']} 件 → リース切れ後に再実行")
+    print(f"ジョブの状態          : {report['counts']}")
+    print(f"作成されたインボイス  : {invoices:,} (ジョブ {args.jobs:,})")
+    print("=" * 60)
+    if report['counts']['succeeded'] != args.jobs or invoices != args.jobs:
+        print("❌ 成功したジョブ数・作成されたインボイス数がジョブ数と一致しません")
+        raise SystemExit(1)
+    print("✅ すべてのジョブがちょうど1回ずつ作成された")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+従量課金メーターのベンチマーク
+サーバー S 台が M 分間、毎分の稼働秒数を使用量として記録する状況をフェイクStripeに対して再現し、
+1件ずつ送った場合と比べたAPI呼び出し数、Stripe側の合計が記録と一致するか、
+途中でクラッシュ（未送信・送信途中）しても合計が変わらないかを確認する。
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections import Counter
+
+from fake_stripe import FakeStripeServer
+
+
+async def simulate(args, wal_dir: str) -> Counter:
+    from server_billing import AsyncServerBillingManager
+    from usage_meter import UsageMeter
+
+    manager = AsyncServerBillingManager(max_connections=16)
+    expected: Counter = Counter()
+    meter = UsageMeter(manager, wal_dir, flush_size=10 ** 9, fsync_interval=args.fsync_interval)
+    start_time = time.time() - args.minutes * 60
+    record_seconds = 0.0
+
+    try:
+        for minute in range(args.minutes):
+            timestamp = start_time + minute * 60
+            record_start = time.perf_counter()
+            for server in range(args.servers):
+                customer_id = f"cus_{server % args.customers:05d}"
+                meter.record(customer_id, 60, args.event_name, timestamp=timestamp)
+                expected[(customer_id, args.event_name)] += 60
+            record_seconds += time.perf_counter() - record_start
+
+            if minute == args.minutes // 3:
+                # クラッシュ1: 未送信の使用量を残したままプロセスが落ちる → 再起動後にWALから復元
+                meter.wal.close()
+                meter = UsageMeter(manager, wal_dir, flush_size=10 ** 9, fsync_interval=args.fsync_interval)
+                print(f"💥 {minute}分目: 未送信 {meter.wal.pending_records} 件を残してクラッシュ → WALから復元")
+            elif minute == 2 * args.minutes // 3:
+                # クラッシュ2: バッチの半分を送ったところで落ちる → 再起動後にバッチごと再送（重複は弾かれる）
+                batch_no = meter.wal.begin_batch()
+                items = meter.wal.batches[batch_no]
+                for customer_id, event_name, value, identifier, timestamp_ in items[:len(items) // 2]:
+                    await manager.create_meter_event(customer_id, event_name, value, identifier, timestamp_)
+                meter.wal.close()
+                meter = UsageMeter(manager, wal_dir, flush_size=10 ** 9, fsync_interval=args.fsync_interval)
+                print(f"💥 {minute}分目: バッチ送信途中でクラッシュ → 未確定バッチ {len(meter.wal.batches)} 件を再送")
+            elif (minute + 1) % args.flush_every == 0:
+                await meter.flush()
+        await meter.flush()
+    finally:
+        meter.wal.close()
+        await manager.aclose()
+
+    records = args.servers * args.minutes
+    print(f"📝 記録: {records:,} 件, {records / record_seconds:,.0f} 件/秒 "
+          f"(fsync間隔 {args.fsync_interval}s)")
+    return expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Coalesced metering vs one API call per usage record")
+    parser.add_argument('--servers', type=int, default=1000)
+    parser.add_argument('--customers', type=int, default=50)
+    parser.add_argument('--minutes', type=int, default=180, help="simulated minutes of per-minute usage")
+    parser.add_argument('--flush-every', type=int, default=60, help="flush every N simulated minutes")
+    parser.add_argument('--fsync-interval', type=float, default=0.05)
+    parser.add_argument('--event-name', default='server_uptime_seconds')
+    args = parser.parse_args()
+
+    with FakeStripeServer() as fake, tempfile.TemporaryDirectory() as wal_dir:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        started = time.perf_counter()
+        expected = asyncio.run(simulate(args, wal_dir))
+        elapsed = time.perf_counter() - started
+        reported = Counter({key: value for key, value in fake.meter_totals.items() if value})
+        api_calls = fake.request_count
+        accepted = len(fake.meter_identifiers)
+
+    naive_calls = args.servers * args.minutes
+    print("\n" + "=" * 60)
+    print(f"1件ずつ送った場合のAPI呼び出し : {naive_calls:,}")
+    print(f"まとめて送ったAPI呼び出し      : {api_calls:,} (受理 {accepted:,} イベント)")
+    print(f"削減率                         : {naive_calls / max(api_calls, 1):,.0f}倍")
+    print(f"記録した合計                   : {sum(expected.values()):,}")
+    print(f"Stripe側の合計                 : {sum(reported.values()):,}")
+    print(f"所要時間                       : {elapsed:.2f}s")
+    print("=" * 60)
+    if reported == expected:
+        print("✅ 顧客 × メーターごとの合計がすべて一致")
+    else:
+        mismatched = [key for key in expected.keys() | reported.keys() if expected[key] != reported[key]]
+        print(f"❌ 合計が一致しない組み合わせ: {len(mismatched)} 件 (例: {mismatched[:3]})")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
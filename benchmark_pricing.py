@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+料金エンジンのベンチマーク
+定額・段階・ボリューム・時間帯別の各料金表について1秒あたりの価格計算回数を測り、
+Fraction で1ミリ秒ずつ積み上げた参照値と結果が完全に一致するかを確認する。
+従来の浮動小数点計算（秒 / 60 / 60 × 単価 → round）との差も数える。
+"""
+
+import argparse
+import random
+import time
+from fractions import Fraction
+from typing import Callable, Dict, List, Tuple
+
+from pricing import (MINIMUM_BILLABLE_MS, MS_PER_DAY, MS_PER_HOUR, RATE_SCALE, RateSchedule,
+                     compile_schedule, round_half_even, to_ms)
+
+SCHEDULES: Dict[str, Dict] = {
+    'flat': {'type': 'flat', 'rate': '100'},
+    'graduated': {'type': 'graduated', 'tiers': [
+        {'up_to': 24, 'rate': '120'}, {'up_to': 168, 'rate': '100'},
+        {'up_to': 720, 'rate': '80'}, {'up_to': None, 'rate': '60'}]},
+    'volume': {'type': 'volume', 'tiers': [
+        {'up_to': 24, 'rate': '120'}, {'up_to': 168, 'rate': '100'},
+        {'up_to': 720, 'rate': '80'}, {'up_to': None, 'rate': '60'}]},
+    'time_of_day': {'type': 'time_of_day', 'utc_offset': 540, 'bands': [
+        {'from': '00:00', 'rate': '60'}, {'from': '08:00', 'rate': '120'},
+        {'from': '18:00', 'rate': '150'}, {'from': '22:00', 'rate': '80'}]},
+    'flat_usd': {'type': 'flat', 'rate': '0.125', 'currency': 'usd'},
+}
+
+
+def make_intervals(count: int, seed: int = 0) -> List[Tuple[float, float]]:
+    """ランダムな稼働区間（1分未満〜60日、開始時刻もばらばら）"""
+    rng = random.Random(seed)
+    now = time.time()
+    intervals = []
+    for _ in range(count):
+        length = rng.uniform(0, 60) if rng.random() < 0.05 else rng.uniform(60, 60 * 24 * 3600)
+        start = now - rng.uniform(0, 365 * 24 * 3600)
+        intervals.append((start, start + length))
+    return intervals
+
+
+def reference_price(schedule: RateSchedule, start: float, end: float) -> int:
+    """定義どおりの素朴な計算（Fraction で区切りごとに積み上げる）"""
+    start_ms, end_ms = to_ms(start), to_ms(end)
+    billable_ms = max(end_ms - start_ms, MINIMUM_BILLABLE_MS)
+    end_ms = start_ms + billable_ms
+    total = Fraction(0)
+    if schedule.kind == 'flat':
+        total = Fraction(billable_ms * schedule.rate)
+    elif schedule.kind == 'volume':
+        rate = next(rate for upper, rate in zip(schedule.upper_ms + [None], schedule.rates)
+                    if upper is None or billable_ms <= upper)
+        total = Fraction(billable_ms * rate)
+    elif schedule.kind == 'graduated':
+        lower = 0
+        for upper, rate in zip(schedule.upper_ms + [None], schedule.rates):
+            top = billable_ms if upper is None else min(upper, billable_ms)
+            if top > lower:
+                total += (top - lower) * rate
+            lower = upper if upper is not None else lower
+    else:
+        position = start_ms
+        while position < end_ms:
+            offset = (position + schedule.offset_ms) % MS_PER_DAY
+            index = max(i for i, band_start in enumerate(schedule.starts_ms) if band_start <= offset)
+            band_end = schedule.starts_ms[index + 1] if index + 1 < len(schedule.starts_ms) else MS_PER_DAY
+            step = min(end_ms - position, band_end - offset)
+            total += step * schedule.rates[index]
+            position += step
+    return round_half_even(total.numerator, total.denominator * MS_PER_HOUR * RATE_SCALE)
+
+
+def float_price(hourly_rate: float, start: float, end: float) -> int:
+    """従来の計算（ServerBillingManager の旧実装と同じ浮動小数点演算）"""
+    total_minutes = (end - start) / 60
+    if total_minutes < 1:
+        return round(hourly_rate / 60)
+    return round(total_minutes / 60 * hourly_rate)
+
+
+def measure(func: Callable[[], object], repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pricing operations per second for compiled rate schedules")
+    parser.add_argument('--intervals', type=int, default=100_000)
+    parser.add_argument('--verify', type=int, default=2_000, help="intervals checked against the reference")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    intervals = make_intervals(args.intervals)
+    print(f"🧮 {args.intervals:,}区間 (1分未満〜60日)")
+    print("\n" + "=" * 80)
+    print(f"{'schedule':>12}{'price() ops/s':>16}{'price_many ops/s':>19}{'vs reference':>15}{'sum':>18}")
+    print("=" * 80)
+    failed = False
+    for name, spec in SCHEDULES.items():
+        schedule = compile_schedule(spec, spec.get('currency', 'jpy'))
+
+        def single():
+            price = schedule.price
+            for start, end in intervals:
+                price(end - start, start, end)
+
+        single_time = measure(single, args.repeat)
+        bulk_time = measure(lambda: schedule.price_many(intervals), args.repeat)
+        amounts = schedule.price_many(intervals)
+
+        sample = intervals[:args.verify]
+        mismatches = sum(1 for (start, end), amount in zip(sample, amounts)
+                         if reference_price(schedule, start, end) != amount)
+        failed |= mismatches > 0
+        print(f"{name:>12}{args.intervals / single_time:>16,.0f}{args.intervals / bulk_time:>19,.0f}"
+              f"{f'{mismatches} 不一致':>15}{sum(amounts):>18,}")
+    print("=" * 80)
+
+    # 従来の浮動小数点計算は丸め境界付近で結果が変わる（整数演算は入力が同じなら常に同じ値）
+    drift = sum(1 for start, end in intervals
+                if float_price(100, start, end) != round_half_even(
+                    max(to_ms(end - start), MINIMUM_BILLABLE_MS) * 100, MS_PER_HOUR))
+    print(f"従来の浮動小数点計算との差: {drift}件 / {args.intervals:,}区間（丸め境界付近のみ）")
+
+    if failed:
+        print("❌ 参照実装と一致しない価格があります")
+        raise SystemExit(1)
+    print("✅ すべての料金表で参照実装と一致")
+
+
+if __name__ == "__main__":
+    main()
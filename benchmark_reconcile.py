@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+突き合わせのベンチマーク
+サーバー × 課金期間の計算上の請求と、それに対応するStripe側の記録（請求漏れ・二重請求・金額違い・
+稼働時間違い・計算にない請求を一定の割合で混ぜたもの）を生成して突き合わせ、1秒あたりの件数と
+実行中のメモリ増加を測る。件数を10倍にしてもメモリがほとんど増えないこと、見つけた問題の件数が
+混ぜた件数と一致すること、次の期間の分だけを渡した2回目は触るパーティションが少なく速いことを確認する。
+期間の数（--periods）を固定し、件数に合わせてサーバー数を決める（期間が1つだと全件と2回目が同じ量になる）。
+"""
+
+import argparse
+import datetime
+import shutil
+import tempfile
+from typing import Dict, Iterator, List, Tuple
+
+from benchmark_export import measure
+from reconciliation import ISSUE_TYPES, ChargeRecord, Reconciler
+
+# キー番号 i（期間 × サーバー）を1000で割った余りで混ぜる問題
+MISSING, DUPLICATE, AMOUNT, HOURS = 1, 2, 3, 4
+UNEXPECTED_EVERY = 10  # この期間ごとに1件、台帳にないサーバーへの請求
+
+
+class Workload:
+    """period_range の期間 × servers 台分の両側の記録"""
+
+    def __init__(self, servers: int, periods: int):
+        self.servers = [f"server-{index:05d}" for index in range(servers)]
+        start = datetime.datetime(2025, 1, 1)
+        self.labels = [f"{start + datetime.timedelta(hours=p)} - {start + datetime.timedelta(hours=p + 1)}"
+                       for p in range(periods + 1)]
+
+    def expected(self, periods: range) -> Iterator[ChargeRecord]:
+        servers = self.servers
+        for p in periods:
+            label, base = self.labels[p], p * len(servers)
+            for s, server_name in enumerate(servers):
+                i = base + s
+                yield (server_name, label, 100 + i % 5000, 1.0, None)
+
+    def actual(self, periods: range) -> Iterator[ChargeRecord]:
+        servers = self.servers
+        for p in periods:
+            label, base = self.labels[p], p * len(servers)
+            for s, server_name in enumerate(servers):
+                i = base + s
+                kind = i % 1000
+                if kind == MISSING:
+                    continue
+                amount, hours = 100 + i % 5000, 1.0
+                if kind == AMOUNT:
+                    amount += 1
+                elif kind == HOURS:
+                    hours += 0.5
+                yield (server_name, label, amount, hours, f"pi_{i:012d}")
+                if kind == DUPLICATE:
+                    yield (server_name, label, amount, hours, f"pi_{i:012d}_retry")
+            if p % UNEXPECTED_EVERY == 0:
+                yield ('server-unknown', label, 100, 1.0, f"pi_unknown_{p:08d}")
+
+    def injected(self, periods: range) -> Dict[str, int]:
+        """periods に混ぜた問題の種類ごとの件数"""
+        counts = dict.fromkeys(ISSUE_TYPES, 0)
+        for p in periods:
+            base = p * len(self.servers)
+            for i in range(base, base + len(self.servers)):
+                kind = i % 1000
+                if kind == MISSING:
+                    counts['missing'] += 1
+                elif kind == DUPLICATE:
+                    counts['duplicate'] += 1
+                elif kind == AMOUNT:
+                    counts['amount_mismatch'] += 1
+                elif kind == HOURS:
+                    counts['hours_mismatch'] += 1
+            if p % UNEXPECTED_EVERY == 0:
+                counts['unexpected'] += 1
+        return counts
+
+
+def run(records: int, periods: int, partitions: int, server_partitions: int) -> Tuple[Dict, Dict]:
+    """records 件（両側の合計）を periods 期間に分けた全件突き合わせと、次の期間だけの2回目"""
+    servers = max(1, records // (2 * periods))
+    workload = Workload(servers, periods)
+    state_dir = tempfile.mkdtemp(prefix='reconcile-')
+    try:
+        reconciler = Reconciler(state_dir, partitions, server_partitions=server_partitions)
+        full, elapsed, memory = measure(lambda: reconciler.reconcile(
+            workload.expected(range(periods)), workload.actual(range(periods))))
+        full.update(elapsed=elapsed, memory_mb=memory, expected_issues=workload.injected(range(periods)))
+
+        # 2回目: 次の期間の記録だけ（状態は前回のものを再利用）
+        latest = range(periods, periods + 1)
+        reconciler = Reconciler(state_dir)
+        delta, elapsed, memory = measure(lambda: reconciler.reconcile(
+            workload.expected(latest), workload.actual(latest)))
+        delta.update(elapsed=elapsed, memory_mb=memory, expected_issues=workload.injected(range(periods + 1)))
+        delta['sample'] = next(reconciler.issues(['duplicate']), None)
+    finally:
+        shutil.rmtree(state_dir, ignore_errors=True)
+    return full, delta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hash-partitioned reconciliation of computed charges and Stripe records")
+    parser.add_argument('--records', type=int, default=10_000_000, help="records on both sides together")
+    parser.add_argument('--periods', type=int, default=200, help="billing periods in the full run")
+    parser.add_argument('--partitions', type=int, default=256)
+    parser.add_argument('--server-partitions', type=int, default=16)
+    parser.add_argument('--max-delta-ratio', type=float, default=0.1,
+                        help="the next-period run must take at most this fraction of the full run's time")
+    args = parser.parse_args()
+
+    rows: List[Tuple[str, Dict]] = []
+    for records in (args.records // 10, args.records):
+        full, delta = run(records, args.periods, args.partitions, args.server_partitions)
+        rows.append((f"full {records:,}", full))
+        rows.append((f"delta {records:,}", delta))
+        print(f"  {records:,}: {full['records']:,} records in {full['elapsed']:.1f}s, "
+              f"delta {delta['records']:,} in {delta['elapsed']:.2f}s")
+
+    print("\n" + "=" * 84)
+    print(f"{'run':>18}{'records':>13}{'records/s':>12}{'partitions':>12}{'RSS +MB':>10}{'issues':>10}  ok")
+    print("=" * 84)
+    ok = True
+    for name, row in rows:
+        matched = row['issues'] == row['expected_issues']
+        ok = ok and matched
+        print(f"{name:>18}{row['records']:>13,}{row['records'] / row['elapsed']:>12,.0f}"
+              f"{row['partitions_touched']:>12}{row['memory_mb']:>10.1f}{sum(row['issues'].values()):>10,}"
+              f"  {'✓' if matched else '✗'}")
+    print("=" * 84)
+    full, delta = rows[-2][1], rows[-1][1]
+    print(f"  見つけた問題: {full['issues']}")
+    print(f"  二重請求の例: {delta['sample']}")
+    print(f"  {args.periods}期間 x {args.records // (2 * args.periods):,}台, "
+          f"2回目（次の期間だけ）: 全件の {delta['elapsed'] / full['elapsed']:.2%} の時間, "
+          f"{delta['partitions_touched']} / {full['partitions_touched']} パーティション")
+
+    errors = []
+    if not ok:
+        errors.append("見つけた問題の件数が混ぜた件数と一致しません")
+    for name, row in rows:
+        if name.startswith('delta') and row['partitions_touched'] > args.server_partitions:
+            errors.append(f"{name}: 2回目が {row['partitions_touched']} パーティションを処理しました"
+                          f"（1期間は最大 {args.server_partitions}）")
+    if delta['elapsed'] > full['elapsed'] * args.max_delta_ratio:
+        errors.append(f"2回目が全件の {delta['elapsed'] / full['elapsed']:.2%} の時間かかりました"
+                      f"（上限 {args.max_delta_ratio:.0%}）")
+    for message in errors:
+        print(f"❌ {message}")
+    if errors:
+        raise SystemExit(1)
+    print("✅ 混ぜた問題をすべて検出し、2回目は新しい期間のパーティションだけを処理")
+
+
+if __name__ == "__main__":
+    main()
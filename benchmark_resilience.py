@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Stripe呼び出しの耐障害性ベンチマーク
+フェイクStripeに遅延・5xx・429・ネットワークの詰まり・全面障害を注入し、
+期限・再試行・ヘッジ・サーキットブレーカーあり／なしで決済作成の成功率とレイテンシ、
+Stripeに送ったリクエスト数を比べる。同じ冪等キーで二重に作成されていないかも確認する。
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import os
+import statistics
+import time
+from typing import Dict, List
+
+from fake_stripe import FakeStripeServer
+
+SCENARIOS: Dict[str, Dict] = {
+    'healthy': {},
+    '5xx 20%': {'error_rate': 0.2},
+    '429 10%': {'rate_limit_rate': 0.1},
+    'stalls 5%': {'stall_rate': 0.05, 'stall_seconds': 5.0},
+    'outage': {'error_rate': 1.0},
+}
+
+
+def make_settings(resilient: bool, args):
+    from settings import get_settings
+
+    settings = get_settings()
+    if resilient:
+        return dataclasses.replace(settings, stripe_timeout=args.timeout, stripe_deadline=args.deadline,
+                                   stripe_hedge_after=args.hedge_after, stripe_max_attempts=3)
+    # 比較用: 1回だけ・タイムアウトは長め・ブレーカーなし（従来の呼び出し方）
+    return dataclasses.replace(settings, stripe_timeout=30.0, stripe_deadline=30.0, stripe_hedge_after=0.0,
+                               stripe_max_attempts=1, stripe_breaker_threshold=10 ** 9)
+
+
+async def run_scenario(fake: FakeStripeServer, resilient: bool, args) -> Dict:
+    from server_billing import AsyncServerBillingManager
+
+    manager = AsyncServerBillingManager(max_connections=args.concurrency, settings=make_settings(resilient, args))
+    await asyncio.to_thread(manager.warm_up)
+    latencies: List[float] = []
+    outcomes = {'ok': 0, 'failed': 0, 'fast_fail': 0}
+    queue = iter(range(args.requests))
+
+    async def worker():
+        for index in queue:
+            start = time.perf_counter()
+            result = await manager.create_payment_intent(idempotency_key=f"bench-{resilient}-{index}")
+            latencies.append(time.perf_counter() - start)
+            if result['success']:
+                outcomes['ok'] += 1
+            elif 'retry_after' in result:
+                outcomes['fast_fail'] += 1
+            else:
+                outcomes['failed'] += 1
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    finally:
+        await manager.aclose()
+    latencies.sort()
+    return {
+        **outcomes,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'breaker_opened': manager.resilience.breaker.times_opened,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payment creation under injected Stripe faults, with and without resilience")
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.05, help="fake Stripe base latency")
+    parser.add_argument('--timeout', type=float, default=1.0, help="per-attempt timeout")
+    parser.add_argument('--deadline', type=float, default=3.0, help="overall deadline per call")
+    parser.add_argument('--hedge-after', type=float, default=0.25)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    args = parser.parse_args()
+
+    rows = []
+    with FakeStripeServer(latency=args.latency, seed=1) as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        for name in args.scenarios:
+            for resilient in (False, True):
+                fake.reset()
+                for attribute, value in {'error_rate': 0.0, 'rate_limit_rate': 0.0, 'stall_rate': 0.0,
+                                         'stall_seconds': 5.0, **SCENARIOS[name]}.items():
+                    setattr(fake, attribute, value)
+                started = time.perf_counter()
+                row = asyncio.run(run_scenario(fake, resilient, args))
+                row.update(scenario=name, mode='resilient' if resilient else 'plain',
+                           elapsed=time.perf_counter() - started, stripe_requests=fake.request_count,
+                           duplicates=fake.created['payment_intent'] - len(fake.idempotent_responses))
+                rows.append(row)
+                print(f"  {name} / {row['mode']}: {row['ok']}/{args.requests} ok in {row['elapsed']:.1f}s")
+
+    print("\n" + "=" * 100)
+    print(f"{'scenario':>10}{'mode':>11}{'ok':>6}{'failed':>8}{'fast fail':>11}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}{'stripe reqs':>13}{'opened':>8}{'dupes':>7}")
+    print("=" * 100)
+    for row in rows:
+        print(f"{row['scenario']:>10}{row['mode']:>11}{row['ok']:>6}{row['failed']:>8}{row['fast_fail']:>11}"
+              f"{row['p50_ms']:>9.1f}{row['p99_ms']:>9.1f}{row['max_ms']:>9.1f}{row['stripe_requests']:>13}"
+              f"{row['breaker_opened']:>8}{row['duplicates']:>7}")
+    print("=" * 100)
+    if any(row['duplicates'] for row in rows):
+        print("❌ 同じ冪等キーで二重に作成された決済があります")
+        raise SystemExit(1)
+    print("✅ 再試行・ヘッジによる二重作成なし")
+
+
+if __name__ == "__main__":
+    main()
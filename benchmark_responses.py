@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+API応答のベンチマーク
+/api/create-payment-intent の応答を、従来どおり結果の dict（PaymentIntent 全体 + 計算の内訳）を
+標準の JSONResponse で返す場合と、画面が使うフィールドだけのモデルを FastJSONResponse で返す場合で、
+応答のバイト数と1件あたりのエンコード時間（モデルへの詰め替えを含む）を比べる。
+
+フェイクStripeの PaymentIntent はフィールドが少ないので、本物のAPIが返すフィールド構成
+（未使用のフィールドは null / 既定値）に広げてから測る。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Dict
+
+from fastapi.responses import JSONResponse
+
+from fake_stripe import FakeStripeServer
+
+# Stripe API の PaymentIntent が返すフィールドのうち、フェイクにないもの
+STRIPE_PAYMENT_INTENT_FIELDS = {
+    'amount_capturable': 0,
+    'amount_details': {'tip': {}},
+    'amount_received': 0,
+    'application': None,
+    'application_fee_amount': None,
+    'automatic_payment_methods': {'allow_redirects': 'always', 'enabled': True},
+    'canceled_at': None,
+    'cancellation_reason': None,
+    'capture_method': 'automatic_async',
+    'confirmation_method': 'automatic',
+    'customer': None,
+    'description': None,
+    'invoice': None,
+    'last_payment_error': None,
+    'latest_charge': None,
+    'next_action': None,
+    'on_behalf_of': None,
+    'payment_method_configuration_details': {'id': 'pmc_1PlQbK2eZvKYlo2CNsJtYbcR', 'parent': None},
+    'payment_method_options': {
+        'card': {'installments': None, 'mandate_options': None, 'network': None,
+                 'request_three_d_secure': 'automatic'},
+        'link': {'persistent_token': None},
+    },
+    'payment_method_types': ['card', 'link'],
+    'processing': None,
+    'receipt_email': None,
+    'review': None,
+    'setup_future_usage': None,
+    'shipping': None,
+    'source': None,
+    'statement_descriptor': None,
+    'statement_descriptor_suffix': None,
+    'transfer_data': None,
+    'transfer_group': None,
+}
+
+
+def per_call_us(func: Callable[[], object], iterations: int) -> float:
+    func()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+async def create_result() -> Dict:
+    from server_billing import AsyncServerBillingManager
+
+    manager = AsyncServerBillingManager()
+    try:
+        result = await manager.create_payment_intent(idempotency_key='response-bench')
+    finally:
+        await manager.aclose()
+    if not result['success']:
+        raise SystemExit(f"❌ 決済の作成に失敗: {result['error']}")
+    result['payment_intent'] = {**STRIPE_PAYMENT_INTENT_FIELDS, **result['payment_intent']}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Payload size and encode time of payment responses")
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    with FakeStripeServer() as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        result = asyncio.run(create_result())
+
+    import api_responses
+    from api_responses import FastJSONResponse, payment_intent_response
+
+    orjson = api_responses.orjson
+    cases = {
+        'full dict, JSONResponse': lambda: JSONResponse(content=result).body,
+        'slim model, stdlib json': None,
+        'slim model, FastJSONResponse': lambda: FastJSONResponse(payment_intent_response(result)).body,
+    }
+    rows = {}
+    for name, func in cases.items():
+        if func is None:
+            api_responses.orjson = None  # 同じモデルを標準の json で（詰め替えの効果だけを見る）
+            func = cases['slim model, FastJSONResponse']
+        body = func()
+        rows[name] = {'bytes': len(body), 'us': per_call_us(func, args.iterations), 'body': body}
+        api_responses.orjson = orjson
+
+    print("\n" + "=" * 64)
+    print(f"{'response':>30}{'bytes':>10}{'µs/encode':>12}{'speedup':>10}")
+    print("=" * 64)
+    baseline = rows['full dict, JSONResponse']
+    for name, row in rows.items():
+        print(f"{name:>30}{row['bytes']:>10,}{row['us']:>12.2f}{baseline['us'] / row['us']:>9.1f}x")
+    print("=" * 64)
+    if orjson is None:
+        print("  ⚠️ orjson がないので FastJSONResponse も標準の json でエンコードしています")
+
+    # 画面が使うフィールドは同じ値で残り、メタデータなどの内部情報は出ない
+    before, after = json.loads(baseline['body']), json.loads(rows['slim model, FastJSONResponse']['body'])
+    used = (after['client_secret'] == before['client_secret'] and after['success'] is True
+            and after['billing_info']['billing_amount'] == before['billing_info']['billing_amount'])
+    leaked = 'metadata' in json.dumps(after)
+    print(f"  削減: {1 - rows['slim model, FastJSONResponse']['bytes'] / baseline['bytes']:.0%} のバイト数")
+    if not used or leaked:
+        print("❌ 画面が使うフィールドが欠けているか、内部のフィールドが残っています")
+        raise SystemExit(1)
+    print("✅ 画面が使うフィールドだけを返し、応答は小さく速くなった")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+/proc サンプラーのベンチマーク
+1件の記録にかかるCPU時間、サンプラーをバックグラウンドで動かしたときのCPU使用率
+（1コアに対する割合。目標は 0.1% 未満）、記録を続けてもメモリが増えないこと、
+リングバッファが一杯のときの期間集計の速さ、CPUを使い切るスレッドの使用秒数を測れることを確認する。
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from resource_sampler import ResourceSampler, available
+
+TARGET_CORE_FRACTION = 0.001  # 1コアの 0.1%
+
+
+def burn(seconds: float) -> float:
+    """seconds の間CPUを使い切る（使ったCPU時間を返す）"""
+    started = time.thread_time()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+    return time.thread_time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU and memory cost of the /proc resource sampler")
+    parser.add_argument('--samples', type=int, default=20000, help="direct samples for the per-sample cost")
+    parser.add_argument('--interval', type=float, default=5.0, help="production sampling interval")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run the background sampler")
+    parser.add_argument('--fast-interval', type=float, default=0.1,
+                        help="interval used for the background run (shorter = more samples to measure)")
+    args = parser.parse_args()
+    if not available():
+        print("❌ /proc が読めない環境です（Linux専用）")
+        raise SystemExit(1)
+
+    # 1件あたりのCPU時間（開いたファイル・バッファ・配列を使い回す）
+    sampler = ResourceSampler(interval=args.interval, capacity=17280)
+    sampler.sample()
+    started_cpu, started = time.thread_time(), time.perf_counter()
+    for _ in range(args.samples):
+        sampler.sample()
+    per_sample_cpu = (time.thread_time() - started_cpu) / args.samples
+    per_sample_wall = (time.perf_counter() - started) / args.samples
+
+    # 記録を続けてもメモリは増えない（リングバッファを一周以上させてから測る）
+    tracemalloc.start()
+    for _ in range(sampler.capacity):
+        sampler.sample()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(args.samples):
+        sampler.sample()
+    growth = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    # リングバッファが一杯の状態での期間集計
+    first = sampler.timestamps[sampler._count % sampler.capacity]
+    last = sampler.latest()['timestamp']
+    queries = 10000
+    started = time.perf_counter()
+    for index in range(queries):
+        sampler.usage(first + (last - first) * index / queries, last)
+    query_us = (time.perf_counter() - started) / queries * 1e6
+    sampler.close()
+
+    # バックグラウンド実行: 他に何もしていないプロセスのCPU時間（スレッドの起床も含む）/ 経過時間
+    background = ResourceSampler(interval=args.fast_interval, capacity=1024)
+    background.start()
+    started, started_cpu = time.time(), time.process_time()
+    time.sleep(args.duration)
+    elapsed, process_cpu = time.time() - started, time.process_time() - started_cpu
+    samples = background.stats()['samples']
+    burn_started = time.time()
+    burned = burn(1.0)  # 使用秒数の確認用に1コアを1秒使い切る
+    time.sleep(args.fast_interval * 2)
+    background.stop()
+    usage = background.usage(burn_started)
+    background.close()
+    fast_fraction = process_cpu / elapsed
+    production_fraction = process_cpu / samples / args.interval
+
+    print("\n" + "=" * 72)
+    print(f"  1件の記録: CPU {per_sample_cpu * 1e6:.1f} µs（経過 {per_sample_wall * 1e6:.1f} µs）")
+    print(f"  記録 {args.samples:,}件でのメモリ増加: {growth:,} bytes")
+    print(f"  期間集計（{sampler.capacity:,}件のリングバッファ）: {query_us:.1f} µs/回")
+    print(f"  {args.fast_interval}s 間隔で {elapsed:.1f}s 実行: {samples}件, "
+          f"プロセスのCPU {fast_fraction:.4%} of a core")
+    print(f"  {args.interval}s 間隔（本番設定）換算: {production_fraction:.5%} of a core "
+          f"（目標 < {TARGET_CORE_FRACTION:.1%}）")
+    print(f"  CPUを1秒使い切ったスレッド: 使用秒数 {usage['cpu_seconds']:.2f}s（実測 {burned:.2f}s、他プロセス分を含む）")
+    print("=" * 72)
+
+    ok = (production_fraction < TARGET_CORE_FRACTION and growth < 4096
+          and usage['cpu_seconds'] >= burned * 0.9)
+    if not ok:
+        print("❌ サンプラーのコスト・メモリ・使用秒数のいずれかが期待どおりではありません")
+        raise SystemExit(1)
+    print("✅ サンプラーのコストは1コアの0.1%未満で、記録を続けてもメモリは増えない")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+送信スケジューラーのベンチマーク
+1秒あたりのリクエスト数を制限したフェイクStripe（超えた分は429）に、バックグラウンドの
+インボイス作成を同時に大量に流しつつ、画面からの決済作成をポアソン到着で混ぜる。
+スケジューラーなし（429を再試行で吸収するだけ）とあり（レート制限に合わせて送信し、
+決済を優先する）で、決済のレイテンシと失敗数・429の数・インボイスの処理量を比べる。
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import os
+import random
+import statistics
+import time
+from typing import Dict, List
+
+from fake_stripe import FakeStripeServer
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[max(0, int(len(values) * fraction) - 1)] if values else 0.0
+
+
+async def run_mode(rate_limit: float, args) -> Dict:
+    from server_billing import AsyncServerBillingManager
+    from settings import get_settings
+
+    settings = dataclasses.replace(get_settings(), stripe_rate_limit=rate_limit)
+    manager = AsyncServerBillingManager(max_connections=args.workers + 32, settings=settings)
+    await asyncio.to_thread(manager.warm_up)
+    stop_at = time.perf_counter() + args.duration
+    invoices = {'ok': 0, 'failed': 0}
+    payments: List[float] = []
+    payment_failures = 0
+
+    async def invoice_worker(worker: int):
+        index = 0
+        while time.perf_counter() < stop_at:
+            result = await manager.create_invoice('cus_bench', idempotency_key=f"sched-{rate_limit}-{worker}-{index}")
+            invoices['ok' if result['success'] else 'failed'] += 1
+            index += 1
+
+    async def payment(index: int):
+        nonlocal payment_failures
+        start = time.perf_counter()
+        result = await manager.create_payment_intent(idempotency_key=f"sched-pay-{rate_limit}-{index}")
+        if result['success']:
+            payments.append(time.perf_counter() - start)
+        else:
+            payment_failures += 1
+
+    async def payment_arrivals():
+        rng = random.Random(7)
+        tasks = []
+        while True:
+            await asyncio.sleep(rng.expovariate(args.payment_rate))
+            if time.perf_counter() >= stop_at:
+                break
+            tasks.append(asyncio.ensure_future(payment(len(tasks))))
+        await asyncio.gather(*tasks)
+
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(payment_arrivals(), *(invoice_worker(worker) for worker in range(args.workers)))
+    finally:
+        await manager.aclose()
+    elapsed = time.perf_counter() - started
+    scheduler = manager.resilience.scheduler
+    return {
+        'payments': len(payments),
+        'payment_failures': payment_failures,
+        'p50_ms': statistics.median(payments) * 1000 if payments else 0.0,
+        'p99_ms': percentile(payments, 0.99) * 1000,
+        'invoices_per_s': invoices['ok'] / elapsed,
+        'invoice_failures': invoices['failed'],
+        'scheduler': scheduler.stats() if scheduler is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Interactive payments mixed with background invoices under a Stripe rate limit")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of load per mode")
+    parser.add_argument('--fake-rate-limit', type=float, default=50.0, help="requests/s the fake Stripe accepts")
+    parser.add_argument('--rate-limit', type=float, default=50.0, help="STRIPE_RATE_LIMIT for the scheduled run")
+    parser.add_argument('--workers', type=int, default=64, help="concurrent background invoice workers")
+    parser.add_argument('--payment-rate', type=float, default=5.0, help="interactive payments per second (Poisson)")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Stripe base latency")
+    args = parser.parse_args()
+
+    rows = {}
+    with FakeStripeServer(latency=args.latency, rate_limit=args.fake_rate_limit, seed=1) as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        for name, rate_limit in (('no scheduler', 0.0), ('scheduler', args.rate_limit)):
+            fake.reset()
+            row = asyncio.run(run_mode(rate_limit, args))
+            row['rate_limited'] = fake.status_counts[429]
+            row['stripe_requests'] = fake.request_count
+            rows[name] = row
+            print(f"  {name}: {row['payments']} payments, {row['invoices_per_s']:.1f} invoices/s, "
+                  f"{row['rate_limited']} x 429")
+
+    print("\n" + "=" * 104)
+    print(f"{'mode':>14}{'payments':>10}{'pay fail':>10}{'p50 ms':>9}{'p99 ms':>9}{'inv/s':>8}{'inv fail':>10}"
+          f"{'stripe reqs':>13}{'429s':>8}")
+    print("=" * 104)
+    for name, row in rows.items():
+        print(f"{name:>14}{row['payments']:>10}{row['payment_failures']:>10}{row['p50_ms']:>9.1f}"
+              f"{row['p99_ms']:>9.1f}{row['invoices_per_s']:>8.1f}{row['invoice_failures']:>10}"
+              f"{row['stripe_requests']:>13}{row['rate_limited']:>8}")
+    print("=" * 104)
+    stats = rows['scheduler']['scheduler']
+    for lane, lane_stats in stats['lanes'].items():
+        print(f"  {lane:>11}: granted {lane_stats['granted']}, queued {lane_stats['queued']}, "
+              f"mean wait {lane_stats['mean_wait_ms']}ms, max wait {lane_stats['max_wait_ms']}ms, "
+              f"timeouts {lane_stats['timeouts']}")
+    print(f"  global rate now {stats['buckets']['global']['rate']}/s "
+          f"(configured {stats['buckets']['global']['max_rate']}/s), throttled {stats['throttled']}")
+
+    plain, scheduled = rows['no scheduler'], rows['scheduler']
+    if scheduled['payment_failures'] > plain['payment_failures'] or scheduled['p99_ms'] > plain['p99_ms']:
+        print("❌ スケジューラーありで決済のレイテンシか失敗数が悪化しました")
+        raise SystemExit(1)
+    if scheduled['rate_limited'] > plain['rate_limited']:
+        print("❌ スケジューラーありで429が増えました")
+        raise SystemExit(1)
+    print("✅ レート制限内に送信し、画面からの決済はバックグラウンドの処理より先に送られた")
+
+
+if __name__ == "__main__":
+    main()
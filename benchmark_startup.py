@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+起動時間ベンチマーク
+新しいPythonプロセスで各モジュールの import 時間（python -X importtime）と、
+Webアプリの起動〜最初のリクエスト（ステータス取得・初回の決済 = stripe の読み込み込み）までの時間を測る。
+結果をベースラインとして保存しておけば、重い import が紛れ込んだときに検出できる。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Dict, List
+
+from fake_stripe import FakeStripeServer
+
+MODULES = ['settings', 'server_billing', 'webhooks', 'web_app']
+
+# 子プロセスで実行する計測コード（import 前に時刻を取るため文字列で渡す）
+FIRST_REQUEST_SCRIPT = r'''
+import time
+t0 = time.perf_counter()
+import web_app
+t_import = time.perf_counter()
+
+import json, urllib.request
+from fake_stripe import run_app_in_thread
+
+server, thread, base_url = run_app_in_thread(web_app.app)
+t_ready = time.perf_counter()
+urllib.request.urlopen(base_url + "/api/billing-status").read()
+t_status = time.perf_counter()
+request = urllib.request.Request(base_url + "/api/create-payment-intent", data=b"", method="POST")
+body = json.loads(urllib.request.urlopen(request).read())
+t_payment = time.perf_counter()
+server.should_exit = True
+thread.join(timeout=10)
+print(json.dumps({
+    "import_ms": (t_import - t0) * 1000,
+    "startup_ms": (t_ready - t_import) * 1000,
+    "first_status_ms": (t_status - t_ready) * 1000,
+    "first_payment_ms": (t_payment - t_status) * 1000,
+    "ready_to_first_response_ms": (t_status - t0) * 1000,
+    "payment_success": body.get("success"),
+}))
+'''
+
+
+def import_time_ms(module: str, env: Dict[str, str]) -> float:
+    """新しいプロセスで module を import したときの累積 import 時間（ミリ秒）"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=env, check=True)
+    for line in result.stderr.splitlines():
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"no importtime entry for {module}")
+
+
+def slowest_imports(module: str, env: Dict[str, str], top: int) -> List[tuple]:
+    """module の import 中で自己時間の大きいモジュール上位 top 件"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, env=env, check=True)
+    entries = []
+    for line in result.stderr.splitlines()[1:]:
+        parts = [part.strip() for part in line.split('|')]
+        if len(parts) == 3 and parts[0].startswith('import time:'):
+            entries.append((parts[2].strip(), int(parts[0].split(':')[1]) / 1000))
+    return sorted(entries, key=lambda entry: entry[1], reverse=True)[:top]
+
+
+def first_request(env: Dict[str, str]) -> Dict:
+    result = subprocess.run([sys.executable, '-c', FIRST_REQUEST_SCRIPT],
+                            capture_output=True, text=True, env=env, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run_benchmark(runs: int, top: int, env: Dict[str, str]) -> Dict:
+    results: Dict[str, float] = {}
+    for module in MODULES:
+        samples = [import_time_ms(module, env) for _ in range(runs)]
+        results[f'import_{module}_ms'] = round(statistics.median(samples), 1)
+
+    samples = [first_request(env) for _ in range(runs)]
+    for key in ('import_ms', 'startup_ms', 'first_status_ms', 'first_payment_ms', 'ready_to_first_response_ms'):
+        results[f'web_app_{key}'] = round(statistics.median(sample[key] for sample in samples), 1)
+    if not all(sample['payment_success'] for sample in samples):
+        print("⚠️  初回の決済リクエストが失敗しました（フェイクStripeの設定を確認してください）")
+
+    print("\n🐢 web_app の import で自己時間の大きいモジュール:")
+    for name, ms in slowest_imports('web_app', env, top):
+        print(f"  {ms:8.1f} ms  {name}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure import time and first-request latency in fresh processes")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes per measurement (median is reported)")
+    parser.add_argument('--top', type=int, default=10, help="slowest imports to list")
+    parser.add_argument('--baseline', default='benchmark_startup_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed regression (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    with FakeStripeServer() as fake:
+        env = dict(os.environ, STRIPE_API_BASE=fake.base_url, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+        env.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        results = run_benchmark(args.runs, args.top, env)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    print("\n" + "=" * 60)
+    print(f"{'measurement':<40}{'ms':>10}{'Δ':>10}")
+    print("=" * 60)
+    regressions = []
+    for name, value in results.items():
+        delta = ''
+        if baseline and baseline.get(name):
+            delta = f"{(value / baseline[name] - 1) * 100:+.0f}%"
+            if value > baseline[name] * (1 + args.tolerance):
+                regressions.append(f"{name}: {baseline[name]}ms -> {value}ms")
+        print(f"{name:<40}{value:>10}{delta:>10}")
+    print("=" * 60)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\n💾 ベースラインを保存しました: {args.baseline}")
+    elif regressions:
+        print(f"\n❌ ベースラインからの劣化 ({args.tolerance:.0%} 超):")
+        for line in regressions:
+            print(f"  - {line}")
+        sys.exit(1)
+    elif baseline:
+        print(f"\n✅ ベースライン ({args.baseline}) からの劣化なし")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+課金ストリーム配信のベンチマーク
+BillingStreamHub に多数の購読者（既定 10,000）をぶら下げ、
+1購読者あたりのメモリと、1ティック（全員への配信）あたりのCPU時間を計測する。
+HTTP層を除いたハブ単体のファンアウトコストを測るため、各購読者は
+/api/billing-stream と同じ stream() ジェネレーターを消費するタスクとして動かす。
+"""
+
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from billing_stream import BillingStreamHub
+from server_billing import ServerBillingManager
+
+
+async def consume(hub: BillingStreamHub, subscriber, counter: list):
+    """stream() を最後まで読み進める購読者"""
+    async for _ in hub.stream(subscriber):
+        counter[0] += 1
+
+
+async def run_benchmark(clients: int, ticks: int, slow_clients: int, interval: float) -> dict:
+    manager = ServerBillingManager(snapshot_resolution=0)
+    # ティックは下で直接呼ぶ。interval は購読開始時に直近のフレームを使い回す条件にだけ効くので、
+    # 実運用と同じ値にしておく（0 だと購読のたびにフレームを作り直すことになる）
+    hub = BillingStreamHub(manager, interval=interval, max_queue=8)
+    hub.tick()  # スナップショットを温めておく
+    counter = [0]
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    tasks = [asyncio.create_task(consume(hub, hub.subscribe(), counter)) for _ in range(clients)]
+    # 読まない（遅い）クライアントはタスクを持たない
+    for _ in range(slow_clients):
+        hub.subscribe()
+    await asyncio.sleep(0)
+
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # ティックごとの配信CPU時間（配信 + 全購読者のキュー消化まで）
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    for _ in range(ticks):
+        hub.tick()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+    cpu_elapsed = time.process_time() - cpu_start
+    wall_elapsed = time.perf_counter() - wall_start
+
+    stats = hub.stats()
+    await hub.stop()
+    await asyncio.gather(*tasks)
+
+    return {
+        'clients': clients,
+        'slow_clients': slow_clients,
+        'memory_total_mb': (after - before) / 1024 / 1024,
+        'memory_per_client_bytes': (after - before) / (clients + slow_clients),
+        'cpu_per_tick_ms': cpu_elapsed / ticks * 1000,
+        'wall_per_tick_ms': wall_elapsed / ticks * 1000,
+        'frames_delivered': counter[0],
+        'dropped': stats['dropped'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="BillingStreamHub fan-out benchmark")
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--ticks', type=int, default=50)
+    parser.add_argument('--slow-clients', type=int, default=100, help="subscribers that never read")
+    parser.add_argument('--interval', type=float, default=1.0, help="hub interval (STREAM_INTERVAL)")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_benchmark(args.clients, args.ticks, args.slow_clients, args.interval))
+
+    print("\n" + "=" * 50)
+    print(f"📡 ストリーム配信ベンチマーク ({result['clients']}クライアント)")
+    print("=" * 50)
+    print(f"メモリ合計: {result['memory_total_mb']:.2f} MB "
+          f"({result['memory_per_client_bytes']:.0f} bytes/クライアント)")
+    print(f"CPU/ティック: {result['cpu_per_tick_ms']:.2f} ms "
+          f"(wall {result['wall_per_tick_ms']:.2f} ms)")
+    print(f"配信フレーム数: {result['frames_delivered']}")
+    print(f"切断した遅いクライアント: {result['dropped']}/{result['slow_clients']}")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
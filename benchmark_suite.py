@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+エンドツーエンド レイテンシ ベンチマーク
+フェイクStripeサーバーとWebアプリを起動し、/ /api/billing-status /api/uptime
+/api/create-payment-intent を指定の同時実行数で叩いて p50/p95/p99 とスループットを測る。
+結果をベースラインとして保存しておけば、次回以降の実行で性能の劣化を検出できる。
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+from fake_stripe import FakeStripeServer, run_app_in_thread
+
+ENDPOINTS = {
+    'index': ('GET', '/'),
+    'billing_status': ('GET', '/api/billing-status'),
+    'uptime': ('GET', '/api/uptime'),
+    'create_payment_intent': ('POST', '/api/create-payment-intent'),
+}
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    """ソート済みサンプルのパーセンタイル（nearest-rank法）"""
+    if not ordered:
+        return 0.0
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> Dict:
+    """レイテンシ（秒）からミリ秒単位の統計を作る"""
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'errors': errors,
+        'throughput_rps': round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p95_ms': round(percentile(ordered, 95) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+async def run_endpoint(client: httpx.AsyncClient, method: str, path: str,
+                       requests: int, concurrency: int) -> Dict:
+    """1エンドポイントを requests 回、同時 concurrency で叩く"""
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            response = await client.request(method, path)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+            elif method == 'POST' and not response.json().get('success', True):
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+async def run_suite(base_url: str, endpoints: List[str], requests: int, concurrency: int,
+                    warmup: int) -> Dict[str, Dict]:
+    results = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        for name in endpoints:
+            method, path = ENDPOINTS[name]
+            if warmup:
+                await run_endpoint(client, method, path, warmup, min(concurrency, warmup))
+            results[name] = await run_endpoint(client, method, path, requests, concurrency)
+    return results
+
+
+def compare_with_baseline(results: Dict[str, Dict], baseline: Dict[str, Dict],
+                          tolerance: float) -> List[str]:
+    """ベースラインより p95 が悪化、またはスループットが低下したエンドポイントを列挙"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {previous['p95_ms']}ms -> {current['p95_ms']}ms")
+        if current['throughput_rps'] < previous['throughput_rps'] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {previous['throughput_rps']} -> {current['throughput_rps']} req/s")
+    return regressions
+
+
+def print_results(results: Dict[str, Dict], baseline: Optional[Dict[str, Dict]] = None):
+    print("\n" + "=" * 78)
+    print(f"{'endpoint':<24}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}{'Δp95':>6}")
+    print("=" * 78)
+    for name, stats in results.items():
+        delta = ''
+        if baseline and name in baseline and baseline[name]['p95_ms']:
+            delta = f"{(stats['p95_ms'] / baseline[name]['p95_ms'] - 1) * 100:+.0f}%"
+        print(f"{name:<24}{stats['throughput_rps']:>10}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['p99_ms']:>10}{stats['errors']:>8}{delta:>6}")
+    print("=" * 78)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end latency benchmark against a local fake Stripe API")
+    parser.add_argument('--url', help="benchmark an already running app instead of starting one")
+    parser.add_argument('--endpoints', nargs='+', choices=list(ENDPOINTS), default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=1000, help="requests per endpoint")
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--stripe-latency', type=float, default=0.05)
+    parser.add_argument('--stripe-jitter', type=float, default=0.0)
+    parser.add_argument('--stripe-error-rate', type=float, default=0.0)
+    parser.add_argument('--stripe-rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed regression (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    fake = server = thread = None
+    base_url = args.url
+    if base_url is None:
+        fake = FakeStripeServer(latency=args.stripe_latency, latency_jitter=args.stripe_jitter,
+                                error_rate=args.stripe_error_rate,
+                                rate_limit_rate=args.stripe_rate_limit_rate, seed=0)
+        os.environ['STRIPE_API_BASE'] = fake.start()
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+        import web_app
+
+        server, thread, base_url = run_app_in_thread(web_app.app)
+
+    try:
+        results = asyncio.run(run_suite(base_url, args.endpoints, args.requests,
+                                        args.concurrency, args.warmup))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=10)
+        if fake is not None:
+            fake.stop()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    print_results(results, baseline)
+    if fake is not None:
+        print(f"🧪 Fake Stripe: {fake.stats()}")
+
+    exit_code = 0
+    if baseline and not args.save_baseline:
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ ベースラインからの劣化 ({args.tolerance:.0%} 超):")
+            for line in regressions:
+                print(f"  - {line}")
+            exit_code = 1
+        else:
+            print(f"\n✅ ベースライン ({args.baseline}) からの劣化なし")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': datetime.datetime.now().isoformat(),
+                'config': {k: v for k, v in vars(args).items() if k not in ('save_baseline', 'baseline')},
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 ベースラインを保存しました: {args.baseline}")
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+ワーカー数スループットベンチマーク
+`web_app.py --workers N` を N = 1..最大数 で起動し、複数の負荷生成プロセスから
+/api/billing-status を叩いてスループットとレイテンシを測る。
+同じETagのレスポンスがすべて同じ内容か（全ワーカーが同じ共有スナップショットを返しているか）と、
+リーダーがちょうど1つであることも確認する。
+"""
+
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Set
+
+import httpx
+
+from fake_stripe import find_free_port
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web_app.py')
+
+
+def wait_until_ready(base_url: str, workers: int, timeout: float = 60.0) -> Set[int]:
+    """全ワーカーが応答するまで待ち、応答したPIDを返す"""
+    deadline = time.time() + timeout
+    pids: Set[int] = set()
+    while time.time() < deadline:
+        try:
+            # keep-aliveを使わず毎回新しい接続にして、各ワーカーに振り分けさせる
+            pids.add(httpx.get(f"{base_url}/api/cluster-status", timeout=2).json()['pid'])
+            if len(pids) >= workers:
+                return pids
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"only {len(pids)} of {workers} workers answered")
+
+
+def count_leaders(base_url: str, probes: int = 50) -> int:
+    leaders = set()
+    for _ in range(probes):
+        status = httpx.get(f"{base_url}/api/cluster-status", timeout=5).json()
+        if status['is_leader']:
+            leaders.add(status['pid'])
+    return len(leaders)
+
+
+def run_client(base_url: str, duration: float, concurrency: int) -> Dict:
+    """負荷生成プロセス1つ分: duration 秒間 /api/billing-status を叩き続ける"""
+
+    async def main():
+        latencies: List[float] = []
+        bodies: Dict[str, Set[str]] = defaultdict(set)
+        errors = 0
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=base_url, timeout=30, limits=limits) as client:
+            deadline = time.perf_counter() + duration
+
+            async def worker():
+                nonlocal errors
+                while time.perf_counter() < deadline:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.get('/api/billing-status')
+                    except httpx.HTTPError:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - start)
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                    bodies[response.headers['etag']].add(hashlib.sha1(response.content).hexdigest())
+
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return {'latencies': latencies, 'errors': errors, 'bodies': {k: list(v) for k, v in bodies.items()}}
+
+    return asyncio.run(main())
+
+
+def benchmark(workers: int, clients: int, concurrency: int, duration: float) -> Dict:
+    port = find_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, PORT=str(port), SHARED_STATE_PATH=os.path.join(tmp, 'billing_state.bin'))
+        process = subprocess.Popen([sys.executable, APP_PATH, '--workers', str(workers), '--host', '127.0.0.1'],
+                                   env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(base_url, workers)
+            leaders = count_leaders(base_url)
+            with multiprocessing.Pool(clients) as pool:
+                results = pool.starmap(run_client, [(base_url, duration, concurrency)] * clients)
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+    latencies = sorted(latency for result in results for latency in result['latencies'])
+    bodies: Dict[str, Set[str]] = defaultdict(set)
+    for result in results:
+        for etag, digests in result['bodies'].items():
+            bodies[etag].update(digests)
+    return {
+        'workers': workers,
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else 0.0,
+        'p99_ms': round(latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000, 2) if latencies else 0.0,
+        'errors': sum(result['errors'] for result in results),
+        'inconsistent_etags': sum(1 for digests in bodies.values() if len(digests) > 1),
+        'leaders': leaders,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of /api/billing-status from 1 to N worker processes")
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--clients', type=int, default=max(2, (os.cpu_count() or 1) // 2),
+                        help="load generator processes")
+    parser.add_argument('--concurrency', type=int, default=32, help="connections per load generator")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per worker count")
+    args = parser.parse_args()
+
+    print(f"🖥️  CPU: {os.cpu_count()}  負荷生成: {args.clients}プロセス x {args.concurrency}接続")
+    rows = []
+    for workers in range(1, args.max_workers + 1):
+        row = benchmark(workers, args.clients, args.concurrency, args.duration)
+        rows.append(row)
+        print(f"  workers={workers}: {row['throughput_rps']} req/s (p50 {row['p50_ms']}ms)")
+
+    print("\n" + "=" * 78)
+    print(f"{'workers':>8}{'req/s':>10}{'speedup':>9}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}{'leaders':>9}{'mismatch':>10}")
+    print("=" * 78)
+    base = rows[0]['throughput_rps'] or 1
+    for row in rows:
+        print(f"{row['workers']:>8}{row['throughput_rps']:>10}{row['throughput_rps'] / base:>8.2f}x"
+              f"{row['p50_ms']:>9}{row['p99_ms']:>9}{row['errors']:>8}{row['leaders']:>9}{row['inconsistent_etags']:>10}")
+    print("=" * 78)
+    print("mismatch: 同じETagで内容が異なったレスポンスの数（0であるべき） / leaders: 1であるべき")
+
+
+if __name__ == "__main__":
+    main()
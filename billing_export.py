@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+# billing_export.py
+Billing History Export
+Stripe上の PaymentIntent / インボイスの履歴をページ単位で順に取り出し（自動ページングのジェネレーター）、
+NDJSON / CSV / Parquet / Arrow に行グループ単位で書き出す。取り出したページはすぐ行に変換して捨てるので、
+履歴が何百万件でもメモリ使用量は行グループ1つ分で一定。
+
+前回どこまで書き出したか（最新オブジェクトのID）をカーソルファイルに残し、次回はそれより新しいものだけを
+古い順に取り出す。Webアプリの /api/export/{kind} は同じジェネレーターをチャンク転送でそのまま流す。
+
+Parquet / Arrow は pyarrow がインストールされている場合のみ使える。
+"""
+import csv
+import datetime
+import io
+import json
+import os
+import time
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+try:
+    import pyarrow  # Optional: Parquet / Arrow 出力
+except ImportError:
+    pyarrow = None
+
+# 種別 -> (一覧APIのパス, URL・ファイル名に使う複数形)
+EXPORT_OBJECTS: Dict[str, Tuple[str, str]] = {
+    'payment_intent': ('/v1/payment_intents', 'payment_intents'),
+    'invoice': ('/v1/invoices', 'invoices'),
+}
+
+# 種別ごとの列（列名, 型）。型は str / int / float / timestamp
+EXPORT_COLUMNS: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    'payment_intent': (
+        ('id', 'str'), ('created', 'timestamp'), ('amount', 'int'), ('amount_received', 'int'),
+        ('currency', 'str'), ('status', 'str'), ('customer', 'str'), ('server_name', 'str'),
+        ('uptime_hours', 'float'), ('billing_period', 'str'), ('test_payment', 'str'),
+    ),
+    'invoice': (
+        ('id', 'str'), ('created', 'timestamp'), ('customer', 'str'), ('status', 'str'),
+        ('amount_due', 'int'), ('amount_paid', 'int'), ('currency', 'str'), ('server_name', 'str'),
+        ('uptime_hours', 'float'), ('billing_period', 'str'),
+    ),
+}
+
+METADATA_COLUMNS = ('server_name', 'uptime_hours', 'billing_period', 'test_payment')
+
+FORMATS = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8',
+           'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+EXTENSIONS = {'ndjson': 'ndjson', 'csv': 'csv', 'parquet': 'parquet', 'arrow': 'arrows'}
+
+
+def to_row(kind: str, obj) -> Tuple:
+    """APIが返したオブジェクト（dict）を列の順のタプルにする（metadata の値は列の型に変換）"""
+    metadata = obj.get('metadata') or {}
+    row = []
+    for name, column_type in EXPORT_COLUMNS[kind]:
+        value = metadata.get(name) if name in METADATA_COLUMNS else obj.get(name)
+        if value is not None and column_type == 'float':
+            try:
+                value = float(value)
+            except ValueError:
+                value = None
+        row.append(value)
+    return tuple(row)
+
+
+# ---- 取り出し ----
+
+def iter_objects(billing_manager, kind: str, cursor: Optional[Dict] = None, since: Optional[float] = None,
+                 page_size: int = 100, progress: Optional[Dict] = None) -> Iterator:
+    """オブジェクトを1件ずつ返すジェネレーター（1ページずつStripeから取り、ページごとに再試行する）
+
+    応答はStripeObjectに変換せずdictのまま使う（変換が取り出し時間の大半を占めるため）。
+    cursor（前回の最新オブジェクト）があればそれより新しいものを古い順に、なければ新しい順に返す。
+    since（UNIX時刻）を渡すとそれより後に作成されたものだけ。progress['cursor'] には次回のカーソルが入る。
+    """
+    from stripe_cache import is_not_found
+
+    client, path = billing_manager.raw_client, EXPORT_OBJECTS[kind][0]
+    operation = f"{kind}.list"
+
+    def fetch_page(params: Dict) -> Dict:
+        return billing_manager._read_stripe(operation, client.raw_request, 'get', path, **params).data
+    progress = progress if progress is not None else {}
+    progress['cursor'] = cursor
+    params: Dict = {'limit': page_size}
+    if since is not None:
+        params['created'] = {'gt': int(since)}
+
+    if cursor is not None:
+        # ending_before: カーソルの直後から新しい方へ。ページ内は新しい順なので逆順に返す
+        params['ending_before'] = cursor['id']
+        while True:
+            try:
+                page = fetch_page(params)
+            except Exception as e:
+                if not is_not_found(e) or params['ending_before'] != cursor['id']:
+                    raise
+                # カーソルのオブジェクトが削除されていたら作成時刻で続きを探す（新しい順）
+                del params['ending_before']
+                params['created'] = {'gt': max(cursor['created'], int(since or 0))}
+                break
+            if page['data']:
+                progress['cursor'] = {'id': page['data'][0]['id'], 'created': page['data'][0]['created']}
+            yield from reversed(page['data'])
+            if not page['has_more'] or not page['data']:
+                return
+            params['ending_before'] = page['data'][0]['id']
+
+    while True:
+        page = fetch_page(params)
+        if page['data'] and 'starting_after' not in params:
+            progress['cursor'] = {'id': page['data'][0]['id'], 'created': page['data'][0]['created']}
+        yield from page['data']
+        if not page['has_more'] or not page['data']:
+            return
+        params['starting_after'] = page['data'][-1]['id']
+
+
+def iter_rows(billing_manager, kind: str, cursor: Optional[Dict] = None, since: Optional[float] = None,
+              page_size: int = 100, progress: Optional[Dict] = None) -> Iterator[Tuple]:
+    """iter_objects() のオブジェクトを列の順のタプルに変換し、件数を progress['rows'] に数える"""
+    progress = progress if progress is not None else {}
+    progress['rows'] = 0
+    for obj in iter_objects(billing_manager, kind, cursor, since, page_size, progress):
+        progress['rows'] += 1
+        yield to_row(kind, obj)
+
+
+# ---- 書き出し ----
+
+class RowWriter:
+    """行を row_group_size 件ずつまとめてバイナリの出力先へ書く"""
+
+    def __init__(self, out, columns: Sequence[Tuple[str, str]], row_group_size: int = 10000):
+        self.out = out
+        self.columns = tuple(columns)
+        self.names = [name for name, _ in self.columns]
+        self.row_group_size = row_group_size
+        self._rows: List[Tuple] = []
+        self.row_groups = 0
+
+    def write(self, row: Tuple) -> bool:
+        """1行追加（行グループを書き出したら True）"""
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if self._rows:
+            self._write_rows(self._rows)
+            self._rows = []
+            self.row_groups += 1
+
+    def _write_rows(self, rows: List[Tuple]):
+        raise NotImplementedError
+
+    def close(self):
+        self.flush()
+
+
+class NdjsonWriter(RowWriter):
+    def _write_rows(self, rows: List[Tuple]):
+        names = self.names
+        self.out.write(''.join(json.dumps(dict(zip(names, row)), ensure_ascii=False, separators=(',', ':')) + "\n"
+                               for row in rows).encode('utf-8'))
+
+
+class CsvWriter(RowWriter):
+    def __init__(self, out, columns, row_group_size: int = 10000):
+        super().__init__(out, columns, row_group_size)
+        self._text = io.TextIOWrapper(out, encoding='utf-8', newline='', write_through=True)
+        self._csv = csv.writer(self._text)
+        self._csv.writerow(self.names)
+
+    def _write_rows(self, rows: List[Tuple]):
+        self._csv.writerows(rows)
+
+    def close(self):
+        super().close()
+        self._text.detach()  # 出力先は閉じない
+
+
+class ArrowRowWriter(RowWriter):
+    """Parquet（行グループ）/ Arrow IPC ストリーム（レコードバッチ）"""
+
+    def __init__(self, out, columns, row_group_size: int = 10000, parquet: bool = True):
+        if pyarrow is None:
+            raise RuntimeError("Parquet / Arrow export requires pyarrow (pip install pyarrow)")
+        super().__init__(out, columns, row_group_size)
+        types = {'str': pyarrow.string(), 'int': pyarrow.int64(), 'float': pyarrow.float64(),
+                 'timestamp': pyarrow.timestamp('s', tz='UTC')}
+        self.schema = pyarrow.schema([(name, types[column_type]) for name, column_type in self.columns])
+        if parquet:
+            import pyarrow.parquet
+
+            self._writer = pyarrow.parquet.ParquetWriter(out, self.schema, compression='zstd')
+        else:
+            import pyarrow.ipc
+
+            self._writer = pyarrow.ipc.new_stream(out, self.schema)
+
+    def _write_rows(self, rows: List[Tuple]):
+        arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows), self.schema)]
+        self._writer.write_batch(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        super().close()
+        self._writer.close()
+
+
+def open_writer(fmt: str, out, kind: str, row_group_size: int = 10000) -> RowWriter:
+    columns = EXPORT_COLUMNS[kind]
+    if fmt == 'ndjson':
+        return NdjsonWriter(out, columns, row_group_size)
+    if fmt == 'csv':
+        return CsvWriter(out, columns, row_group_size)
+    if fmt in ('parquet', 'arrow'):
+        return ArrowRowWriter(out, columns, row_group_size, parquet=fmt == 'parquet')
+    raise ValueError(f"unknown export format {fmt!r} (choose from {', '.join(FORMATS)})")
+
+
+class ChunkBuffer(io.RawIOBase):
+    """書き込まれたバイト列を溜め、drain() で取り出す出力先（チャンク転送用）"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b''.join(self._chunks), []
+        return data
+
+
+def stream_export(billing_manager, kind: str, fmt: str = 'ndjson', since: Optional[float] = None,
+                  row_group_size: int = 10000, page_size: int = 100) -> Iterator[bytes]:
+    """エクスポートを行グループごとのバイト列として返すジェネレーター（HTTPのチャンク転送用）"""
+    buffer = ChunkBuffer()
+    writer = open_writer(fmt, buffer, kind, row_group_size)
+    for row in iter_rows(billing_manager, kind, since=since, page_size=page_size):
+        if writer.write(row):
+            yield buffer.drain()
+    writer.close()
+    tail = buffer.drain()
+    if tail:
+        yield tail
+
+
+# ---- カーソル付きのファイル出力 ----
+
+def load_cursors(path: str) -> Dict[str, Dict]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_cursors(path: str, cursors: Dict[str, Dict]):
+    """カーソルを書き換える（一時ファイルに書いてから置き換えるので途中で落ちても壊れない）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(cursors, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def export_to_file(billing_manager, kind: str, out_dir: str, fmt: str = 'ndjson',
+                   state_path: Optional[str] = None, since: Optional[float] = None,
+                   row_group_size: int = 10000, page_size: int = 100) -> Dict:
+    """前回のカーソルより新しいオブジェクトを1ファイルに書き出し、書き終えたらカーソルを進める
+
+    ファイルは書き終えるまで .tmp のままにしておくので、途中で落ちた実行は次回やり直しになる（重複しない）。
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    state_path = state_path or os.path.join(out_dir, 'export_cursor.json')
+    cursors = load_cursors(state_path)
+    cursor = cursors.get(kind)
+    started = time.perf_counter()
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(out_dir, f"{EXPORT_OBJECTS[kind][1]}-{stamp}.{EXTENSIONS[fmt]}")
+    progress: Dict = {}
+
+    with open(f"{path}.tmp", 'wb') as out:
+        writer = open_writer(fmt, out, kind, row_group_size)
+        for row in iter_rows(billing_manager, kind, cursor, since, page_size, progress):
+            writer.write(row)
+        writer.close()
+    rows = progress['rows']
+    if rows:
+        os.replace(f"{path}.tmp", path)
+        cursors[kind] = {**progress['cursor'], 'exported_at': time.time()}
+        save_cursors(state_path, cursors)
+    else:
+        os.remove(f"{path}.tmp")
+        path = None
+    return {
+        'success': True,
+        'kind': kind,
+        'format': fmt,
+        'path': path,
+        'rows': rows,
+        'row_groups': writer.row_groups,
+        'cursor': cursors.get(kind),
+        'elapsed': time.perf_counter() - started,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export Stripe billing history incrementally to columnar files")
+    parser.add_argument('kinds', nargs='*', choices=[plural for _, plural in EXPORT_OBJECTS.values()],
+                        default=[plural for _, plural in EXPORT_OBJECTS.values()])
+    parser.add_argument('--format', choices=list(FORMATS), default='ndjson')
+    parser.add_argument('--out', default='exports', help="output directory")
+    parser.add_argument('--state', help="cursor file (default: <out>/export_cursor.json)")
+    parser.add_argument('--since', help="only objects created after this ISO date (first run)")
+    parser.add_argument('--row-group-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    from server_billing import ServerBillingManager
+
+    manager = ServerBillingManager()
+    since = datetime.datetime.fromisoformat(args.since).timestamp() if args.since else None
+    kinds = {plural: kind for kind, (_, plural) in EXPORT_OBJECTS.items()}
+    for plural in args.kinds:
+        report = export_to_file(manager, kinds[plural], args.out, args.format, args.state, since,
+                                args.row_group_size)
+        if report['path']:
+            print(f"📦 {plural}: {report['rows']:,}件 -> {report['path']} ({report['elapsed']:.1f}s)")
+        else:
+            print(f"✅ {plural}: 新しいオブジェクトはありません")
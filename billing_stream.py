@@ -0,0 +1,136 @@
+"""
+# billing_stream.py
+Billing Status Stream Hub
+1つのティッカーで課金サマリーを計算・シリアライズし、接続中の全クライアントへSSEで配信する。
+"""
+import asyncio
+import time
+from typing import AsyncIterator, Optional, Set
+
+from settings import get_settings
+
+
+class Subscriber:
+    """1クライアント分の送信キュー"""
+
+    __slots__ = ('queue', 'dropped')
+
+    def __init__(self, max_queue: int):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.dropped = False
+
+
+class BillingStreamHub:
+    """課金サマリーをティックごとに一度だけ生成し、全購読者にファンアウトする"""
+
+    def __init__(self, billing_manager, interval: Optional[float] = None, max_queue: int = 8):
+        self.billing_manager = billing_manager
+        if interval is None:
+            interval = get_settings().stream_interval
+        self.interval = interval  # 配信間隔（秒）
+        self.max_queue = max_queue  # これ以上溜まった遅いクライアントは切断する
+        self.subscribers: Set[Subscriber] = set()
+        self.latest_frame: Optional[bytes] = None
+        self.latest_frame_at = 0.0  # latest_frame を作った時刻（time.monotonic）
+        self.ticks = 0
+        self.dropped_count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def subscribe(self) -> Subscriber:
+        """購読を開始（最初のフレームをすぐに受け取れるようにする）
+
+        ティッカーは購読者がいる間しか動かないので、しばらく誰もいなかった後の直近のフレームは
+        古い稼働時間・金額のままになっている。他に購読者がいない（ティッカーが止まっていた）ときに
+        1間隔より古ければ作り直してから渡す。購読者がいる間はティッカーが毎間隔作り直している。
+        """
+        subscriber = Subscriber(self.max_queue)
+        frame = self.latest_frame
+        if frame is None or (not self.subscribers
+                             and time.monotonic() - self.latest_frame_at > self.interval):
+            frame = self._build_frame()
+        subscriber.queue.put_nowait(frame)
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        """購読を終了"""
+        self.subscribers.discard(subscriber)
+
+    def _drop(self, subscriber: Subscriber):
+        """キューが溢れた遅いクライアントを切り離す"""
+        self.subscribers.discard(subscriber)
+        subscriber.dropped = True
+        self.dropped_count += 1
+        # 溜まったフレームを捨てて終了の合図(None)を入れる
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(None)
+
+    def _build_frame(self) -> bytes:
+        """最新のサマリーをSSEフレームにする"""
+        snapshot = self.billing_manager.get_billing_snapshot()
+        self.ticks += 1
+        frame = b'id: %d\ndata: %s\n\n' % (self.ticks, snapshot['summary_json'])
+        self.latest_frame = frame
+        self.latest_frame_at = time.monotonic()
+        return frame
+
+    def tick(self) -> bytes:
+        """サマリーを一度だけSSEフレームにして全購読者へ配る"""
+        frame = self._build_frame()
+
+        for subscriber in tuple(self.subscribers):
+            try:
+                subscriber.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                self._drop(subscriber)
+        return frame
+
+    async def run(self):
+        """購読者がいる間だけ interval 秒ごとに tick する"""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            if self.subscribers:
+                self.tick()
+            next_tick += self.interval
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+    def start(self):
+        """ティッカーを起動"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        """ティッカーを停止し、全購読者を切断"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for subscriber in tuple(self.subscribers):
+            self._drop(subscriber)
+
+    async def stream(self, subscriber: Subscriber) -> AsyncIterator[bytes]:
+        """購読者キューからSSEフレームを取り出して返すジェネレーター"""
+        try:
+            # 再接続間隔をクライアントに伝える
+            yield b'retry: %d\n\n' % int(self.interval * 1000 * 3)
+            while True:
+                frame = await subscriber.queue.get()
+                if frame is None:
+                    break
+                yield frame
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self) -> dict:
+        """配信状況"""
+        return {
+            'subscribers': len(self.subscribers),
+            'ticks': self.ticks,
+            'dropped': self.dropped_count,
+            'interval': self.interval,
+        }
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+# bulk_invoicing.py
+Bulk Invoicing Pipeline
+顧客リストに対して InvoiceItem / Invoice の作成を同時実行数を制限して流す。
+顧客ごとに冪等キーを付け、完了状況をチェックポイントファイル（JSON Lines）に記録するので、
+中断した実行は同じ run_id で再開すれば重複なく続きから処理される。
+請求する期間は実行を作った時点で確定してチェックポイントの先頭に書き、再開時はそれを使う
+（再開で金額が変わると、同じ冪等キーのリクエストがStripeに 400 で拒否されるため）。
+"""
+import asyncio
+import json
+import os
+import statistics
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class BulkInvoiceRun:
+    """1回分の一括請求（run_id 単位）"""
+
+    def __init__(self, billing_manager, run_id: str, checkpoint_path: Optional[str] = None,
+                 concurrency: int = 8, period_start: Optional[float] = None,
+                 period_end: Optional[float] = None):
+        self.billing_manager = billing_manager  # AsyncServerBillingManager
+        self.run_id = run_id
+        self.checkpoint_path = checkpoint_path or f"bulk_invoices_{run_id}.jsonl"
+        self.concurrency = concurrency
+        self.period_start = period_start
+        self.period_end = period_end
+        self.billed_until: Optional[float] = None  # 期間を省略した実行で請求する稼働の終わり
+        self._period_saved = False  # 期間をチェックポイントに書いたか
+
+        self.completed: Dict[str, Dict] = {}  # customer_id -> チェックポイントレコード
+        self.failed: Dict[str, str] = {}  # customer_id -> エラー
+        self.latencies: List[float] = []
+        self.total = 0
+        self.skipped = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._load_checkpoint()
+        if not self._period_saved:
+            self._fix_period()
+
+    def idempotency_key(self, customer_id: str) -> str:
+        """顧客ごとの冪等キー（同じ run_id で再実行しても同じキーになる）"""
+        return f"bulk-invoice:{self.run_id}:{customer_id}"
+
+    def _fix_period(self):
+        """新しい実行の請求期間を確定する（省略時は起動から今までの稼働を billed_until で固定）"""
+        if self.period_start is None and self.period_end is None:
+            self.billed_until = time.time()
+        else:
+            self.period_start, self.period_end = self.billing_manager.resolve_period(
+                self.period_start, self.period_end)
+
+    def _restore_period(self, record: Dict):
+        """チェックポイントに書いた期間を使う（別の期間を指定しての再開は ValueError）"""
+        for name in ('period_start', 'period_end'):
+            requested = getattr(self, name)
+            if requested is not None and requested != record[name]:
+                raise ValueError(f"run {self.run_id} was started with {name}={record[name]}, not {requested}")
+        self.period_start = record['period_start']
+        self.period_end = record['period_end']
+        self.billed_until = record['billed_until']
+        self._period_saved = True
+
+    def _load_checkpoint(self):
+        """チェックポイントから請求期間と完了済みの顧客を読み込む（書きかけの最終行は無視）"""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'customer_id' not in record:
+                    if not self._period_saved:
+                        self._restore_period(record)
+                elif record.get('status') == 'succeeded':
+                    self.completed[record['customer_id']] = record
+
+    def _write_checkpoint(self, checkpoint, record: Dict):
+        checkpoint.write(json.dumps(record, ensure_ascii=False) + "\n")
+        checkpoint.flush()
+        os.fsync(checkpoint.fileno())
+
+    async def _invoice_customer(self, customer_id: str, checkpoint):
+        start = time.perf_counter()
+        result = await self.billing_manager.create_invoice(
+            customer_id,
+            period_start=self.period_start,
+            period_end=self.period_end,
+            idempotency_key=self.idempotency_key(customer_id),
+            billed_until=self.billed_until,
+        )
+        latency = time.perf_counter() - start
+        self.latencies.append(latency)
+
+        record = {
+            'customer_id': customer_id,
+            'status': 'succeeded' if result['success'] else 'failed',
+            'latency_ms': round(latency * 1000, 2),
+            'finished_at': time.time(),
+        }
+        if result['success']:
+            record['invoice_id'] = result['invoice']['id']
+            record['invoice_item_id'] = result['invoice_item']['id']
+            record['amount'] = result['billing_info']['billing_amount']
+            self.completed[customer_id] = record
+            self.failed.pop(customer_id, None)
+        else:
+            record['error'] = result['error']
+            self.failed[customer_id] = result['error']
+        self._write_checkpoint(checkpoint, record)
+
+    async def run(self, customer_ids: Iterable[str]) -> Dict:
+        """未完了の顧客だけを同時実行数 concurrency で請求する"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for customer_id in dict.fromkeys(customer_ids):  # 重複を除いて順序を保つ
+            self.total += 1
+            if customer_id in self.completed:
+                self.skipped += 1
+            else:
+                queue.put_nowait(customer_id)
+
+        self.started_at = time.time()
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+            if not self._period_saved:
+                self._write_checkpoint(checkpoint, {
+                    'run_id': self.run_id,
+                    'period_start': self.period_start,
+                    'period_end': self.period_end,
+                    'billed_until': self.billed_until,
+                })
+                self._period_saved = True
+
+            async def worker():
+                while True:
+                    try:
+                        customer_id = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    await self._invoice_customer(customer_id, checkpoint)
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        self.finished_at = time.time()
+        return self.report()
+
+    def report(self) -> Dict:
+        """進捗とスループット・レイテンシ"""
+        processed = len(self.latencies)
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        report = {
+            'run_id': self.run_id,
+            'period_start': self.period_start,
+            'period_end': self.period_end,
+            'billed_until': self.billed_until,
+            'total': self.total,
+            'succeeded': len(self.completed),
+            'failed': len(self.failed),
+            'skipped': self.skipped,
+            'processed': processed,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_second': round(processed / elapsed, 2) if elapsed > 0 else 0.0,
+            'finished': self.finished_at is not None,
+            'checkpoint_path': self.checkpoint_path,
+        }
+        if self.latencies:
+            ordered = sorted(self.latencies)
+            report['latency_ms'] = {
+                'p50': round(statistics.median(ordered) * 1000, 2),
+                'p95': round(ordered[max(0, int(len(ordered) * 0.95) - 1)] * 1000, 2),
+                'p99': round(ordered[max(0, int(len(ordered) * 0.99) - 1)] * 1000, 2),
+                'max': round(ordered[-1] * 1000, 2),
+            }
+        return report
+
+
+def read_customer_ids(path: str) -> List[str]:
+    """1行1顧客IDのファイルを読む（空行と # コメントは無視）"""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Invoice many customers with bounded concurrency")
+    parser.add_argument('customers', help="file with one Stripe customer ID per line")
+    parser.add_argument('--run-id', required=True, help="stable ID for this run (e.g. 2026-10)")
+    parser.add_argument('--checkpoint', help="checkpoint file (default: bulk_invoices_<run-id>.jsonl)")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--period-start', help="bill uptime from this time (ISO 8601, needs the uptime ledger)")
+    parser.add_argument('--period-end', help="bill uptime until this time (ISO 8601; default: when the run "
+                                             "was first started, kept in the checkpoint for resumes)")
+    parser.add_argument('--fake-stripe', type=float, metavar='LATENCY',
+                        help="run against a local fake Stripe API with this latency (seconds)")
+    args = parser.parse_args()
+
+    fake = None
+    if args.fake_stripe is not None:
+        from fake_stripe import FakeStripeServer
+
+        fake = FakeStripeServer(latency=args.fake_stripe)
+        os.environ['STRIPE_API_BASE'] = fake.start()
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+
+    import datetime
+
+    from server_billing import AsyncServerBillingManager
+
+    def timestamp(value: Optional[str]) -> Optional[float]:
+        return datetime.datetime.fromisoformat(value).timestamp() if value else None
+
+    async def main():
+        manager = AsyncServerBillingManager(max_connections=args.concurrency)
+        try:
+            bulk_run = BulkInvoiceRun(manager, args.run_id, args.checkpoint, args.concurrency,
+                                      timestamp(args.period_start), timestamp(args.period_end))
+        except ValueError as e:
+            await manager.aclose()
+            parser.error(str(e))
+        try:
+            return await bulk_run.run(read_customer_ids(args.customers))
+        finally:
+            await manager.aclose()
+
+    try:
+        report = asyncio.run(main())
+    finally:
+        if fake is not None:
+            fake.stop()
+
+    print("\n📋 一括請求結果 (JSON):")
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if fake is not None:
+        print(f"🧪 フェイクStripeで作成されたオブジェクト: {dict(fake.created)}")
@@ -0,0 +1,554 @@
+"""
+# fake_stripe.py
+Local Fake Stripe API Server
+ローカルで動くStripe APIのスタンドイン。負荷試験・ベンチマーク用に応答遅延・エラー率・
+レート制限（429）・ネットワークの詰まり（一部のリクエストだけ大きく遅れる）を指定できる。
+設定は属性なので実行中に変更してもよい。本物と同じく、同じ冪等キーのリクエストが処理中なら409を、
+既出の冪等キーで内容の違うリクエストが来たら400 idempotency_error を返す。
+一覧APIのベンチマーク用に、添字から組み立てる数百万件の過去履歴を seed_history() で持たせられる。
+"""
+import asyncio
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+
+def parse_stripe_form(body: bytes) -> Dict:
+    """Stripeのフォームエンコード（metadata[key]=value形式）を辞書に変換"""
+    params: Dict = {}
+    for key, value in parse_qsl(body.decode(), keep_blank_values=True):
+        if '[' in key:
+            parent, child = key.rstrip(']').split('[', 1)
+            params.setdefault(parent, {})[child] = value
+        else:
+            params[key] = value
+    return params
+
+
+class SyntheticHistory:
+    """添字から組み立てる過去のオブジェクト列（件数だけ持つので数百万件でもメモリを使わない）
+
+    添字 i は作成時刻の古い順。IDは "<prefix>_hist<i:010d>"、作成時刻は start〜end に等間隔。
+    """
+
+    PREFIXES = {'payment_intent': 'pi', 'invoice': 'in'}
+
+    def __init__(self, object_type: str, count: int, start: float, end: float, servers: int = 50):
+        self.object_type = object_type
+        self.count = count
+        self.start = start
+        self.step = (end - start) / max(count, 1)
+        self.servers = servers
+        self.prefix = f"{self.PREFIXES[object_type]}_hist"
+
+    def created(self, index: int) -> int:
+        return int(self.start + index * self.step)
+
+    def object_id(self, index: int) -> str:
+        return f"{self.prefix}{index:010d}"
+
+    def index_of(self, object_id: str) -> Optional[int]:
+        if not object_id.startswith(self.prefix):
+            return None
+        index = int(object_id[len(self.prefix):])
+        return index if index < self.count else None
+
+    def build(self, index: int) -> Dict:
+        created = self.created(index)
+        hours = (index * 7919) % 720 + 1
+        metadata = {
+            'server_name': f"server-{index % self.servers:03d}",
+            'uptime_hours': f"{hours:.2f}",
+            'billing_period': time.strftime('%Y-%m', time.gmtime(created)),
+        }
+        obj = {'id': self.object_id(index), 'object': self.object_type, 'created': created,
+               'currency': 'jpy', 'metadata': metadata, 'livemode': False}
+        if self.object_type == 'payment_intent':
+            obj.update(amount=hours * 100, amount_received=hours * 100, status='succeeded', customer=None)
+        else:
+            obj.update(customer=f"cus_{index % 1000:06d}", status='paid', amount_due=hours * 100,
+                       amount_paid=hours * 100)
+        return obj
+
+
+def find_free_port(host: str = '127.0.0.1') -> int:
+    """空いているTCPポートを取得"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def run_app_in_thread(app, host: str = '127.0.0.1', port: Optional[int] = None) -> Tuple[uvicorn.Server, threading.Thread, str]:
+    """ASGIアプリをバックグラウンドスレッドのuvicornで起動し、(server, thread, base_url)を返す"""
+    port = port or find_free_port(host)
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    # 起動完了を待つ
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError(f"server on {host}:{port} did not start")
+        time.sleep(0.01)
+
+    return server, thread, f"http://{host}:{port}"
+
+
+class FakeStripeServer:
+    """PaymentIntent / InvoiceItem / Invoice / Customer / Price / MeterEvent / Account を返すフェイクStripeサーバー"""
+
+    def __init__(self, latency: float = 0.0, host: str = '127.0.0.1', port: Optional[int] = None,
+                 latency_jitter: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 stall_rate: float = 0.0, stall_seconds: float = 5.0, seed: Optional[int] = None,
+                 rate_limit: float = 0.0, rate_limit_burst: Optional[float] = None):
+        self.latency = latency  # 各APIリクエストの応答遅延（秒）
+        self.latency_jitter = latency_jitter  # 遅延に加える一様乱数の幅（秒）
+        self.error_rate = error_rate  # 500 api_error を返す割合
+        self.rate_limit_rate = rate_limit_rate  # 429 rate_limit を返す割合
+        self.stall_rate = stall_rate  # 届く前に stall_seconds 詰まるリクエストの割合
+        self.stall_seconds = stall_seconds
+        # 本物のAPIと同じように1秒あたりのリクエスト数を制限する（トークンバケット。0 なら制限しない）
+        self.rate_limit = rate_limit
+        self.rate_limit_burst = rate_limit_burst if rate_limit_burst is not None else rate_limit
+        self._rate_tokens = self.rate_limit_burst
+        self._rate_updated = time.monotonic()
+        self.host = host
+        self.port = port
+        self.random = random.Random(seed)
+        self.request_count = 0
+        self.status_counts: Counter = Counter()  # 返したHTTPステータスごとの件数
+        self.created: Counter = Counter()  # 作成されたオブジェクト数（object種別ごと）
+        self.retrieved: Counter = Counter()  # 取得リクエスト数（object種別ごと。404も含む）
+        self.objects: Dict[str, Dict] = {}  # ID -> 作成したオブジェクト（取得用）
+        self.live_order: Dict[str, List[str]] = {}  # object種別 -> 作成順のID（一覧用）
+        self.histories: Dict[str, SyntheticHistory] = {}  # object種別 -> 作成済みの過去履歴
+        self.idempotent_responses: Dict[str, Dict] = {}  # Idempotency-Key -> 応答
+        self.idempotent_params: Dict[str, str] = {}  # Idempotency-Key -> 最初のリクエストのパスと内容のハッシュ
+        self.keys_in_progress: set = set()  # 処理中の Idempotency-Key
+        self.meter_identifiers: set = set()  # 受け付けたメーターイベントの identifier
+        self.meter_totals: Counter = Counter()  # (customer, event_name) -> 合計値
+        self.base_url: Optional[str] = None
+        self._server: Optional[uvicorn.Server] = None
+        self._thread: Optional[threading.Thread] = None
+        self.app = self._build_app()
+
+    def _over_rate_limit(self) -> bool:
+        """rate_limit を超えたリクエストか（イベントループ上でだけ呼ぶのでロックは不要）"""
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        self._rate_tokens = min(self.rate_limit_burst, self._rate_tokens + (now - self._rate_updated) * self.rate_limit)
+        self._rate_updated = now
+        if self._rate_tokens < 1.0:
+            return True
+        self._rate_tokens -= 1.0
+        return False
+
+    async def _create(self, request: Request, build: Callable[[Dict], Dict]) -> JSONResponse:
+        """Idempotency-Key が既出なら同じ応答を返し、なければオブジェクトを作成する
+
+        本物と同じく、既出のキーでもパスか内容が最初のリクエストと違えば 400 idempotency_error。
+        """
+        key = request.headers.get('idempotency-key')
+        params = parse_stripe_form(await request.body())
+        digest = hashlib.sha256(json.dumps([request.url.path, params], sort_keys=True).encode()).hexdigest()
+        if key and key in self.idempotent_responses:
+            if self.idempotent_params[key] != digest:
+                return JSONResponse(status_code=400, content={'error': {
+                    'type': 'idempotency_error',
+                    'message': f"Keys for idempotent requests can only be used with the same parameters "
+                               f"they were first used with. Try using a key other than '{key}' if you meant "
+                               f"to execute a different request.",
+                }})
+            return JSONResponse(content=self.idempotent_responses[key],
+                                headers={'Idempotent-Replayed': 'true'})
+        obj = build(params)
+        self.created[obj['object']] += 1
+        if 'id' in obj:
+            self.objects[obj['id']] = obj
+            self.live_order.setdefault(obj['object'], []).append(obj['id'])
+        if key:
+            self.idempotent_responses[key] = obj
+            self.idempotent_params[key] = digest
+        return JSONResponse(content=obj)
+
+    def seed_history(self, object_type: str, count: int, days: float = 365.0):
+        """過去 days 日に count 件作成されていたことにする（payment_intent / invoice）"""
+        end = time.time() - 1
+        self.histories[object_type] = SyntheticHistory(object_type, count, end - days * 86400, end)
+
+    def _list(self, object_type: str, query: Dict) -> JSONResponse:
+        """一覧（新しい順。limit / starting_after / ending_before / created[gt|gte|lt|lte]）
+
+        過去履歴（添字順）のあとにAPIで作成したオブジェクトが続く1本の列として扱う。
+        """
+        history = self.histories.get(object_type)
+        history_count = history.count if history else 0
+        live = self.live_order.get(object_type, [])
+        total = history_count + len(live)
+
+        def created_at(position: int) -> int:
+            if position < history_count:
+                return history.created(position)
+            return self.objects[live[position - history_count]]['created']
+
+        def position_of(object_id: str) -> Optional[int]:
+            index = history.index_of(object_id) if history else None
+            if index is not None:
+                return index
+            if object_id in self.objects and self.objects[object_id]['object'] == object_type:
+                return history_count + live.index(object_id)
+            return None
+
+        def first_position(predicate) -> int:
+            """created_at が predicate を満たす最初の位置（作成時刻は単調増加なので二分探索）"""
+            lo, hi = 0, total
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if predicate(created_at(mid)):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return lo
+
+        lo, hi = 0, total
+        created = query.get('created')
+        if isinstance(created, dict):
+            if 'gt' in created:
+                lo = max(lo, first_position(lambda c: c > int(created['gt'])))
+            if 'gte' in created:
+                lo = max(lo, first_position(lambda c: c >= int(created['gte'])))
+            if 'lt' in created:
+                hi = min(hi, first_position(lambda c: c >= int(created['lt'])))
+            if 'lte' in created:
+                hi = min(hi, first_position(lambda c: c > int(created['lte'])))
+
+        limit = min(int(query.get('limit', 10)), 100)
+        for param in ('starting_after', 'ending_before'):
+            if query.get(param) and position_of(query[param]) is None:
+                return JSONResponse(status_code=404, content={'error': {
+                    'type': 'invalid_request_error',
+                    'code': 'resource_missing',
+                    'message': f"No such {object_type}: '{query[param]}'",
+                    'param': param,
+                }})
+        if query.get('ending_before'):
+            lo = max(lo, position_of(query['ending_before']) + 1)
+            top = min(hi, lo + limit)
+            positions = range(top - 1, lo - 1, -1)
+            has_more = top < hi
+        else:
+            if query.get('starting_after'):
+                hi = min(hi, position_of(query['starting_after']))
+            bottom = max(lo, hi - limit)
+            positions = range(hi - 1, bottom - 1, -1)
+            has_more = bottom > lo
+
+        data = [history.build(p) if p < history_count else self.objects[live[p - history_count]]
+                for p in positions]
+        return JSONResponse(content={'object': 'list', 'url': f"/v1/{object_type}s", 'has_more': has_more,
+                                     'data': data})
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI(title="Fake Stripe API")
+
+        @app.middleware("http")
+        async def simulate_conditions(request: Request, call_next):
+            self.request_count += 1
+            if self.stall_rate and self.random.random() < self.stall_rate:
+                # 接続・ネットワークでの詰まり（サーバーに届くまでに時間がかかる）
+                self.status_counts['stalled'] += 1
+                await asyncio.sleep(self.stall_seconds)
+
+            if self._over_rate_limit():
+                # 本物のAPIは Retry-After を付けず、理由をヘッダーで返す
+                response = JSONResponse(status_code=429, headers={'Stripe-Rate-Limited-Reason': 'global-rate'},
+                                        content={'error': {
+                                            'type': 'invalid_request_error',
+                                            'code': 'rate_limit',
+                                            'message': 'Too many requests hit the API too quickly.',
+                                        }})
+                self.status_counts[response.status_code] += 1
+                return response
+
+            key = request.headers.get('idempotency-key')
+            if key and key in self.keys_in_progress:
+                response = JSONResponse(status_code=409, content={'error': {
+                    'type': 'idempotency_error',
+                    'code': 'idempotency_key_in_use',
+                    'message': 'There is currently another in-progress request using this Idempotent Key.',
+                }})
+                self.status_counts[response.status_code] += 1
+                return response
+            if key:
+                self.keys_in_progress.add(key)
+            try:
+                response = await _simulate_response(request, call_next)
+            finally:
+                if key:
+                    self.keys_in_progress.discard(key)
+            self.status_counts[response.status_code] += 1
+            return response
+
+        async def _simulate_response(request: Request, call_next):
+            delay = self.latency + (self.random.uniform(0, self.latency_jitter) if self.latency_jitter else 0.0)
+            if delay:
+                await asyncio.sleep(delay)
+
+            roll = self.random.random()
+            if roll < self.rate_limit_rate:
+                response = JSONResponse(status_code=429, headers={'Retry-After': '1'}, content={'error': {
+                    'type': 'invalid_request_error',
+                    'code': 'rate_limit',
+                    'message': 'Too many requests hit the API too quickly.',
+                }})
+            elif roll < self.rate_limit_rate + self.error_rate:
+                response = JSONResponse(status_code=500, content={'error': {
+                    'type': 'api_error',
+                    'message': 'Simulated internal server error.',
+                }})
+            else:
+                response = await call_next(request)
+            return response
+
+        def build_payment_intent(params: Dict) -> Dict:
+            intent_id = f"pi_{uuid.uuid4().hex[:24]}"
+            confirmed = params.get('confirm') == 'true'
+            return {
+                'id': intent_id,
+                'object': 'payment_intent',
+                'amount': int(params.get('amount', 0)),
+                'currency': params.get('currency', 'jpy'),
+                'client_secret': f"{intent_id}_secret_{uuid.uuid4().hex[:16]}",
+                'status': 'succeeded' if confirmed else 'requires_payment_method',
+                'payment_method': params.get('payment_method'),
+                'metadata': params.get('metadata', {}),
+                'created': int(time.time()),
+                'livemode': False,
+            }
+
+        def build_invoice_item(params: Dict) -> Dict:
+            return {
+                'id': f"ii_{uuid.uuid4().hex[:24]}",
+                'object': 'invoiceitem',
+                'customer': params.get('customer'),
+                'amount': int(params.get('amount', 0)),
+                'currency': params.get('currency', 'jpy'),
+                'description': params.get('description'),
+                'livemode': False,
+            }
+
+        def build_invoice(params: Dict) -> Dict:
+            return {
+                'id': f"in_{uuid.uuid4().hex[:24]}",
+                'object': 'invoice',
+                'customer': params.get('customer'),
+                'status': 'draft',
+                'metadata': params.get('metadata', {}),
+                'created': int(time.time()),
+                'livemode': False,
+            }
+
+        def build_customer(params: Dict) -> Dict:
+            return {
+                'id': f"cus_{uuid.uuid4().hex[:14]}",
+                'object': 'customer',
+                'email': params.get('email'),
+                'name': params.get('name'),
+                'metadata': params.get('metadata', {}),
+                'created': int(time.time()),
+                'livemode': False,
+            }
+
+        def build_price(params: Dict) -> Dict:
+            return {
+                'id': f"price_{uuid.uuid4().hex[:24]}",
+                'object': 'price',
+                'currency': params.get('currency', 'jpy'),
+                'unit_amount': int(params.get('unit_amount', 0)),
+                'product': params.get('product'),
+                'active': True,
+                'metadata': params.get('metadata', {}),
+                'created': int(time.time()),
+                'livemode': False,
+            }
+
+        def build_meter_event(params: Dict) -> Dict:
+            payload = params.get('payload', {})
+            return {
+                'object': 'billing.meter_event',
+                'event_name': params.get('event_name'),
+                'identifier': params.get('identifier') or uuid.uuid4().hex,
+                'payload': payload,
+                'timestamp': int(params.get('timestamp', time.time())),
+                'created': int(time.time()),
+                'livemode': False,
+            }
+
+        @app.post("/v1/billing/meter_events")
+        async def create_meter_event(request: Request):
+            key = request.headers.get('idempotency-key')
+            if not (key and key in self.idempotent_responses):
+                params = parse_stripe_form(await request.body())
+                identifier = params.get('identifier')
+                if identifier and identifier in self.meter_identifiers:
+                    # 本物と同じく identifier の重複は受け付けない（集計にも入れない）
+                    return JSONResponse(status_code=400, content={'error': {
+                        'type': 'invalid_request_error',
+                        'message': f"An event with identifier {identifier} already exists.",
+                    }})
+            response = await self._create(request, build_meter_event)
+            if response.headers.get('Idempotent-Replayed') is None:
+                event = json.loads(response.body)
+                self.meter_identifiers.add(event['identifier'])
+                self.meter_totals[(event['payload'].get('stripe_customer_id'), event['event_name'])] += \
+                    int(event['payload'].get('value', 0))
+            return response
+
+        @app.post("/v1/payment_intents")
+        async def create_payment_intent(request: Request):
+            return await self._create(request, build_payment_intent)
+
+        @app.post("/v1/invoiceitems")
+        async def create_invoice_item(request: Request):
+            return await self._create(request, build_invoice_item)
+
+        @app.post("/v1/invoices")
+        async def create_invoice(request: Request):
+            return await self._create(request, build_invoice)
+
+        @app.post("/v1/customers")
+        async def create_customer(request: Request):
+            return await self._create(request, build_customer)
+
+        @app.post("/v1/prices")
+        async def create_price(request: Request):
+            return await self._create(request, build_price)
+
+        def retrieve(object_type: str, object_id: str) -> JSONResponse:
+            self.retrieved[object_type] += 1
+            obj = self.objects.get(object_id)
+            history = self.histories.get(object_type)
+            if obj is None and history is not None and history.index_of(object_id) is not None:
+                obj = history.build(history.index_of(object_id))
+            if obj is None or obj['object'] != object_type:
+                return JSONResponse(status_code=404, content={'error': {
+                    'type': 'invalid_request_error',
+                    'code': 'resource_missing',
+                    'message': f"No such {object_type}: '{object_id}'",
+                }})
+            return JSONResponse(content=obj)
+
+        @app.get("/v1/payment_intents")
+        async def list_payment_intents(request: Request):
+            return self._list('payment_intent', parse_stripe_form(request.url.query.encode()))
+
+        @app.get("/v1/invoices")
+        async def list_invoices(request: Request):
+            return self._list('invoice', parse_stripe_form(request.url.query.encode()))
+
+        @app.get("/v1/customers/{object_id}")
+        async def retrieve_customer(object_id: str):
+            return retrieve('customer', object_id)
+
+        @app.get("/v1/prices/{object_id}")
+        async def retrieve_price(object_id: str):
+            return retrieve('price', object_id)
+
+        @app.get("/v1/payment_intents/{object_id}")
+        async def retrieve_payment_intent(object_id: str):
+            return retrieve('payment_intent', object_id)
+
+        @app.get("/v1/invoices/{object_id}")
+        async def retrieve_invoice(object_id: str):
+            return retrieve('invoice', object_id)
+
+        @app.get("/v1/account")
+        async def retrieve_account():
+            return JSONResponse(content={
+                'id': 'acct_fake',
+                'object': 'account',
+                'country': 'JP',
+                'default_currency': 'jpy',
+                'business_profile': {'name': 'Fake Stripe'},
+            })
+
+        return app
+
+    def reset(self):
+        """カウンターと冪等キーの記録をクリア"""
+        self.request_count = 0
+        self.status_counts.clear()
+        self.created.clear()
+        self.retrieved.clear()
+        self.idempotent_responses.clear()
+        self.idempotent_params.clear()
+        self.keys_in_progress.clear()
+        self.meter_identifiers.clear()
+        self.meter_totals.clear()
+        self._rate_tokens = self.rate_limit_burst
+        self._rate_updated = time.monotonic()
+
+    def stats(self) -> Dict:
+        """受けたリクエストと応答の集計"""
+        return {
+            'requests': self.request_count,
+            'statuses': dict(self.status_counts),
+            'created': dict(self.created),
+            'retrieved': dict(self.retrieved),
+        }
+
+    def start(self) -> str:
+        """サーバーを起動してベースURLを返す"""
+        self._server, self._thread, self.base_url = run_app_in_thread(self.app, self.host, self.port)
+        return self.base_url
+
+    def stop(self):
+        """サーバーを停止"""
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+            self._server = None
+
+    def __enter__(self) -> "FakeStripeServer":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local fake Stripe API server")
+    parser.add_argument('--port', type=int, default=12111)
+    parser.add_argument('--latency', type=float, default=0.0, help="response latency in seconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of 500 responses")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of 429 responses")
+    parser.add_argument('--stall-rate', type=float, default=0.0, help="fraction of requests stalled in the network")
+    parser.add_argument('--stall-seconds', type=float, default=5.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="requests per second before 429 (0 = no limit)")
+    args = parser.parse_args()
+
+    fake = FakeStripeServer(latency=args.latency, latency_jitter=args.jitter,
+                            error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                            stall_rate=args.stall_rate, stall_seconds=args.stall_seconds,
+                            rate_limit=args.rate_limit)
+    print(f"🧪 Fake Stripe API: http://127.0.0.1:{args.port} (latency {args.latency}s, "
+          f"errors {args.error_rate:.0%}, 429 {args.rate_limit_rate:.0%}, stalls {args.stall_rate:.0%})")
+    print(f"💡 STRIPE_API_BASE=http://127.0.0.1:{args.port} python web_app.py")
+    uvicorn.run(fake.app, host='127.0.0.1', port=args.port)
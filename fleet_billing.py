@@ -0,0 +1,76 @@
+"""
+# fleet_billing.py
+Fleet Billing Engine
+複数サーバーの稼働区間を列指向の配列（NumPy）で受け取り、フリート全体の課金額を一括計算する。
+金額は pricing.FlatRate と同じく稼働ミリ秒 × 単価の整数演算で求め、最後に1回だけ偶数丸めする
+（最小課金時間1分も ServerBillingManager.calculate_billing_amount と同じルール）。
+"""
+from typing import Dict, Sequence
+
+from pricing import MINIMUM_BILLABLE_MS, MS_PER_HOUR, currency_exponent
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for fleet billing
+    np = None
+
+
+class FleetBillingEngine:
+    """サーバーごとの (開始, 終了, 料金ID) 配列からフリート全体を一括で課金計算する"""
+
+    def __init__(self, hourly_rates: Sequence[int], currency: str = 'jpy'):
+        """hourly_rates[rate_id] がその料金IDの時間単価（通貨の主単位の整数）"""
+        if np is None:
+            raise ImportError("FleetBillingEngine requires numpy (pip install numpy)")
+        self.hourly_rates = np.asarray(hourly_rates, dtype=np.int64)
+        self.currency = currency
+        # 最小単位での時間単価（稼働ミリ秒との積が int64 に収まる範囲で計算する）
+        self.minor_rates = self.hourly_rates * 10 ** currency_exponent(currency)
+
+    def calculate(self, start_times, stop_times, rate_ids) -> Dict:
+        """全サーバーの稼働秒数・課金分数・課金時間・課金額を1パスで計算
+
+        start_times / stop_times はUNIXタイムスタンプ（秒）、rate_ids は hourly_rates の添字。
+        戻り値は各列をNumPy配列で持つ辞書。
+        """
+        start_times = np.asarray(start_times, dtype=np.float64)
+        stop_times = np.asarray(stop_times, dtype=np.float64)
+        rate_ids = np.asarray(rate_ids, dtype=np.intp)
+
+        rates = self.minor_rates[rate_ids]
+        uptime_seconds = stop_times - start_times
+        total_minutes = uptime_seconds / 60
+        billing_hours = total_minutes / 60
+
+        # 最小課金時間は1分とする
+        billable_ms = np.maximum(np.rint(uptime_seconds * 1000).astype(np.int64), MINIMUM_BILLABLE_MS)
+        # 最小単位に偶数丸め（pricing.round_half_even と同じ規則）
+        quotient, remainder = np.divmod(billable_ms * rates, MS_PER_HOUR)
+        round_up = (2 * remainder > MS_PER_HOUR) | ((2 * remainder == MS_PER_HOUR) & (quotient % 2 == 1))
+        billing_amount = quotient + round_up
+
+        return {
+            'uptime_seconds': uptime_seconds,
+            'billed_minutes': np.maximum(total_minutes, 1.0),
+            'billing_hours': np.round(billing_hours, 2),
+            'billing_amount': billing_amount,
+        }
+
+    def totals_by_rate(self, billing_amount, rate_ids) -> 'np.ndarray':
+        """料金IDごとの課金額合計"""
+        return np.bincount(
+            np.asarray(rate_ids, dtype=np.intp),
+            weights=billing_amount,
+            minlength=len(self.hourly_rates),
+        ).astype(np.int64)
+
+    def summarize(self, start_times, stop_times, rate_ids) -> Dict:
+        """フリート全体の課金サマリー"""
+        result = self.calculate(start_times, stop_times, rate_ids)
+        return {
+            'servers': int(len(result['billing_amount'])),
+            'total_hours': float(result['uptime_seconds'].sum() / 3600),
+            'total_amount': int(result['billing_amount'].sum()),
+            'amount_by_rate': self.totals_by_rate(result['billing_amount'], rate_ids).tolist(),
+            'currency': self.currency,
+        }
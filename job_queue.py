@@ -0,0 +1,286 @@
+"""
+# job_queue.py
+Durable Job Queue
+インボイス作成・サーバーサイドのテスト決済など、その場で結果を返す必要のないStripe処理を
+SQLiteの永続キューに積み、すぐにジョブIDを返す（書き込みはWALモードで1回のINSERTだけ）。
+バックグラウンドのワーカーがまとめて取り出して同時実行数を制限して流し、失敗したものは
+バックオフを空けて再試行する。
+
+ジョブIDから決まる冪等キーでStripeを呼ぶので、再試行やワーカーのクラッシュ後の再実行でも
+作成は1回になる。キューファイルは複数のワーカープロセスで共有でき、取り出しはトランザクションで
+排他するので同じジョブを2つのプロセスが同時に実行することはない（リース切れは再実行）。
+"""
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+from stripe_resilience import classify
+from stripe_scheduler import BATCH, priority_lane
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    idempotency_key TEXT UNIQUE,
+    status TEXT NOT NULL,           -- queued / running / succeeded / failed
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL,       -- この時刻までは取り出さない（再試行のバックオフ）
+    lease_until REAL,               -- running のまま期限が切れたら取り出し直す
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, not_before);
+"""
+
+JOB_KINDS = ('invoice', 'test_payment')
+
+
+class JobQueue:
+    """SQLite上の永続ジョブキュー（スレッド・プロセス間で共有してよい）"""
+
+    def __init__(self, path: str, durable: bool = False):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # NORMAL: コミットはWALへの書き込みまで（プロセスが落ちても失われない）。FULL: 毎回fsync
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if durable else 'NORMAL'}")
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, callback: Callable[[], None]):
+        """ジョブが積まれたときに呼ぶコールバック（同じプロセスのワーカーを起こす）"""
+        self._listeners.append(callback)
+
+    def enqueue(self, kind: str, params: Dict, idempotency_key: Optional[str] = None) -> Dict:
+        """ジョブを積んでIDを返す（同じ冪等キーのジョブが既にあればそのジョブを返す）"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"unknown job kind {kind!r}")
+        job_id = f"job_{uuid.uuid4().hex[:24]}"
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (id, kind, params, idempotency_key, status, not_before, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'queued', ?, ?, ?) ON CONFLICT (idempotency_key) DO NOTHING",
+                (job_id, kind, json.dumps(params, separators=(',', ':')), idempotency_key, now, now, now))
+            if cursor.rowcount == 0:
+                job_id, status = self._conn.execute(
+                    "SELECT id, status FROM jobs WHERE idempotency_key = ?", (idempotency_key,)).fetchone()
+                return {'job_id': job_id, 'status': status, 'created': False}
+        for callback in self._listeners:
+            callback()
+        return {'job_id': job_id, 'status': 'queued', 'created': True}
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """ジョブの状態（なければ None）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, params, status, attempts, not_before, created_at, updated_at, result, error"
+                " FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job_id, kind, params, status, attempts, not_before, created_at, updated_at, result, error = row
+        return {
+            'job_id': job_id,
+            'kind': kind,
+            'params': json.loads(params),
+            'status': status,
+            'attempts': attempts,
+            'next_attempt_at': not_before if status == 'queued' and attempts else None,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'result': json.loads(result) if result else None,
+            'error': error,
+        }
+
+    def claim(self, limit: int, lease: float) -> List[Dict]:
+        """実行可能なジョブを最大 limit 件取り出して running にする（リース切れの running も含む）"""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                " WHERE id IN (SELECT id FROM jobs"
+                "   WHERE (status = 'queued' AND not_before <= ?) OR (status = 'running' AND lease_until < ?)"
+                "   ORDER BY not_before LIMIT ?)"
+                " RETURNING id, kind, params, attempts",
+                (now + lease, now, now, now, limit)).fetchall()
+        return [{'job_id': job_id, 'kind': kind, 'params': json.loads(params), 'attempts': attempts}
+                for job_id, kind, params, attempts in rows]
+
+    def finish(self, outcomes: List[Dict]):
+        """取り出したジョブの結果を1トランザクションでまとめて記録する
+
+        outcome: {'job_id', 'status': succeeded / failed / queued, 'result', 'error', 'not_before'}
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, not_before = ?, lease_until = NULL,"
+                    " updated_at = ? WHERE id = ?",
+                    [(outcome['status'],
+                      json.dumps(outcome['result'], separators=(',', ':')) if outcome.get('result') else None,
+                      outcome.get('error'), outcome.get('not_before', now), now, outcome['job_id'])
+                     for outcome in outcomes])
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def counts(self) -> Dict[str, int]:
+        """状態ごとのジョブ数"""
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {status: 0 for status in ('queued', 'running', 'succeeded', 'failed')}
+        counts.update(dict(rows))
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def summarize_result(kind: str, result: Dict) -> Dict:
+    """ジョブに保存する結果（Stripeオブジェクト全体ではなくIDと金額だけ）"""
+    billing_info = result.get('billing_info') or {}
+    summary = {'amount': billing_info.get('billing_amount'), 'currency': billing_info.get('currency')}
+    if kind == 'invoice':
+        summary['invoice_id'] = result['invoice']['id']
+        summary['invoice_item_id'] = result['invoice_item']['id']
+    else:
+        summary['payment_id'] = result['payment_id']
+        summary['status'] = result['status']
+    return summary
+
+
+class JobWorker:
+    """キューからジョブをまとめて取り出して実行するワーカープール"""
+
+    def __init__(self, queue: JobQueue, billing_manager, concurrency: int = 8, batch_size: int = 32,
+                 lease: float = 120.0, max_attempts: int = 5, poll_interval: float = 0.5,
+                 max_backoff: float = 300.0):
+        self.queue = queue
+        self.billing_manager = billing_manager  # AsyncServerBillingManager
+        self.concurrency = concurrency  # 同時に実行するジョブ数
+        self.batch_size = batch_size  # 1回の取り出し件数
+        self.lease = lease  # 実行中のジョブを他のワーカーが取り直すまでの時間（秒）
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval  # 他のプロセスが積んだジョブを探す間隔（秒）
+        self.max_backoff = max_backoff
+        self.random = random.Random()
+        self._wake: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+
+    async def _execute(self, job: Dict) -> Dict:
+        """ジョブ1件を実行（冪等キーはジョブIDから、金額は積んだときに確定した期間から決めるので再実行しても作成は1回）"""
+        params = job['params']
+        key = f"job:{job['job_id']}"
+        # バックグラウンドの処理なので、レート制限の送信枠は画面からの決済に譲る
+        with priority_lane(BATCH):
+            if job['kind'] == 'invoice':
+                result = await self.billing_manager.create_invoice(
+                    params['customer_id'], params.get('period_start'), params.get('period_end'),
+                    idempotency_key=key, billed_until=params.get('billed_until'))
+            else:
+                result = await self.billing_manager.create_test_payment(
+                    idempotency_key=key, billed_until=params.get('billed_until'))
+
+        if result['success']:
+            self.succeeded += 1
+            return {'job_id': job['job_id'], 'status': 'succeeded', 'result': summarize_result(job['kind'], result)}
+        return self._retry_or_fail(job, result['error'], result.get('retryable', True),
+                                   result.get('retry_after', 0.0))
+
+    def _retry_or_fail(self, job: Dict, error: str, retryable: bool, retry_after: float = 0.0) -> Dict:
+        """失敗したジョブを再試行に回すか、やり直しても成功しない・回数を使い切ったものは失敗にする"""
+        if not retryable or job['attempts'] >= self.max_attempts:
+            self.failed += 1
+            return {'job_id': job['job_id'], 'status': 'failed', 'error': error}
+        # 指数バックオフ（ジッター付き）。ブレーカーが開いていればその解除まで待つ
+        backoff = min(self.max_backoff, 2 ** job['attempts']) * (0.5 + self.random.random() / 2)
+        backoff = max(backoff, retry_after)
+        self.retried += 1
+        return {'job_id': job['job_id'], 'status': 'queued', 'error': error,
+                'not_before': time.time() + backoff}
+
+    async def run_once(self) -> int:
+        """1バッチ分を取り出して実行し、結果をまとめて記録する（取り出した件数を返す）"""
+        jobs = self.queue.claim(self.batch_size, self.lease)
+        if not jobs:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def execute(job: Dict) -> Dict:
+            async with semaphore:
+                try:
+                    return await self._execute(job)
+                except Exception as e:
+                    # 想定外のエラーでもワーカーは止めず、回数の上限とバックオフは同じにする
+                    # （毎回例外になるジョブを延々と再試行しない）
+                    return self._retry_or_fail(job, str(e), classify(e)[0])
+
+        outcomes = await asyncio.gather(*(execute(job) for job in jobs))
+        self.queue.finish(outcomes)
+        self.batches += 1
+        return len(jobs)
+
+    async def run(self):
+        while True:
+            self._wake.clear()  # 実行中に積まれた分は次の wait() ですぐ起きる
+            if await self.run_once() < self.batch_size:
+                # キューが空になったら、積まれるか poll_interval が経つまで待つ
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _notify(self):
+        self._loop.call_soon_threadsafe(self._wake.set)
+
+    def start(self):
+        """バックグラウンドでキューの処理を開始"""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wake = asyncio.Event()
+            self.queue.add_listener(self._notify)
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """処理を止める（実行中だったジョブはリース切れ後に再実行される）"""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def stats(self) -> Dict:
+        return {
+            'queue': self.queue.counts(),
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retried': self.retried,
+            'batches': self.batches,
+        }
+
+
+def open_queue(path: str, durable: bool = False) -> JobQueue:
+    """キューファイルを開く（ディレクトリがなければ作る）"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return JobQueue(path, durable)
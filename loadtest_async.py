@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+ステータスAPIの遅延負荷試験
+フェイクStripeサーバーの応答を遅くした状態で決済APIを同時に叩き、
+/api/billing-status と /api/uptime の応答時間が悪化しないことを確認する。
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import httpx
+
+from fake_stripe import FakeStripeServer, run_app_in_thread
+
+
+def summarize(samples: List[float]) -> Dict:
+    """レイテンシ（秒）のサンプルからp50/p95/maxをミリ秒で算出"""
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50_ms': round(statistics.median(ordered) * 1000, 2),
+        'p95_ms': round(ordered[int(len(ordered) * 0.95) - 1] * 1000, 2),
+        'max_ms': round(ordered[-1] * 1000, 2),
+    }
+
+
+async def probe_status(client: httpx.AsyncClient, count: int, interval: float) -> List[float]:
+    """ステータス系エンドポイントを一定間隔で叩いてレイテンシを計測"""
+    samples = []
+    for i in range(count):
+        path = '/api/billing-status' if i % 2 == 0 else '/api/uptime'
+        start = time.perf_counter()
+        response = await client.get(path)
+        samples.append(time.perf_counter() - start)
+        response.raise_for_status()
+        await asyncio.sleep(interval)
+    return samples
+
+
+async def create_payment(client: httpx.AsyncClient) -> float:
+    """決済APIを1回呼び出して所要時間を返す"""
+    start = time.perf_counter()
+    response = await client.post('/api/create-payment-intent')
+    elapsed = time.perf_counter() - start
+    if not response.json().get('success'):
+        raise RuntimeError(f"payment failed: {response.text}")
+    return elapsed
+
+
+async def run_load_test(base_url: str, payments: int, probes: int, interval: float) -> Dict:
+    limits = httpx.Limits(max_connections=payments + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as client:
+        # 負荷なしの基準値
+        baseline = await probe_status(client, probes, interval)
+
+        # 遅い決済を同時に流しながら計測
+        payment_tasks = [asyncio.create_task(create_payment(client)) for _ in range(payments)]
+        under_load = await probe_status(client, probes, interval)
+        payment_times = await asyncio.gather(*payment_tasks)
+
+    return {
+        'baseline': summarize(baseline),
+        'under_load': summarize(under_load),
+        'payments': summarize(payment_times),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Status endpoint latency under slow Stripe calls")
+    parser.add_argument('--latency', type=float, default=1.0, help="fake Stripe latency in seconds")
+    parser.add_argument('--payments', type=int, default=20, help="concurrent payment requests")
+    parser.add_argument('--probes', type=int, default=40, help="status requests per phase")
+    parser.add_argument('--interval', type=float, default=0.02, help="pause between status requests")
+    parser.add_argument('--blocking', action='store_true',
+                        help="call the blocking ServerBillingManager path for comparison")
+    args = parser.parse_args()
+
+    with FakeStripeServer(latency=args.latency) as fake:
+        os.environ['STRIPE_API_BASE'] = fake.base_url
+        os.environ.setdefault('STRIPE_SECRET_KEY', 'sk_test_fake')
+
+        import web_app
+        from server_billing import ServerBillingManager
+
+        if args.blocking:
+            # 比較用: 従来の同期呼び出しをイベントループ上で実行する
+            manager = web_app.get_billing_manager()
+
+            async def blocking_create_payment_intent(customer_email=None, **kwargs):
+                result = ServerBillingManager.create_payment_intent(manager, customer_email, **kwargs)
+                if result['success']:
+                    result['payment_intent'] = result['payment_intent'].to_dict()
+                return result
+
+            manager.create_payment_intent = blocking_create_payment_intent
+
+        server, thread, base_url = run_app_in_thread(web_app.app)
+        try:
+            result = asyncio.run(run_load_test(base_url, args.payments, args.probes, args.interval))
+        finally:
+            server.should_exit = True
+            thread.join(timeout=5)
+
+    mode = 'blocking' if args.blocking else 'async'
+    print("\n" + "=" * 50)
+    print(f"📈 負荷試験結果 ({mode}, Stripe遅延 {args.latency}s, 同時決済 {args.payments}件)")
+    print("=" * 50)
+    for phase in ('baseline', 'under_load', 'payments'):
+        stats = result[phase]
+        print(f"{phase:>10}: n={stats['count']:<4} p50={stats['p50_ms']}ms "
+              f"p95={stats['p95_ms']}ms max={stats['max_ms']}ms")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
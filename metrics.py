@@ -0,0 +1,339 @@
+"""
+# metrics.py
+Low-overhead Instrumentation
+レイテンシのヒストグラム・実行中ゲージ・カウンターをプロセス内に事前確保したバケットで記録し、
+Prometheusのテキスト形式で出力する。記録側はロックを取らず、整数の加算だけで済ませる。
+"""
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+_perf_counter = time.perf_counter
+
+# 既定のレイテンシバケット（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def dec(self, amount: float = 1.0):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramChild:
+    """事前確保したバケット配列に観測値を数えるヒストグラム"""
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最後は +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> "Timer":
+        """with文で囲んだ区間の所要時間を記録する"""
+        return Timer(self)
+
+
+class Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: HistogramChild):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = _perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = _perf_counter() - self.start
+        histogram = self.histogram
+        histogram.counts[bisect_left(histogram.bounds, elapsed)] += 1
+        histogram.sum += elapsed
+        return False
+
+
+class Metric:
+    """ラベル付きメトリクス。labels() で子を取得し、子はキャッシュして使い回す"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str, **kwargs: str):
+        """ラベル値に対応する子メトリクス（ホットパスでは事前に取得しておく）"""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self.children[()].inc(amount)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, values)} {child.value}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return HistogramChild(self.bounds)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            cumulative = 0
+            counts = list(child.counts)
+            for bound, count in zip(self.bounds + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % ('+Inf' if bound == float('inf') else repr(bound))
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, values, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, values)
+            yield f"{self.name}_sum{labels} {child.sum}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    """プロセス内のメトリクス一覧"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheusテキスト形式（text/plain; version=0.0.4）"""
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STRIPE_REQUEST_SECONDS = REGISTRY.histogram(
+    'stripe_request_duration_seconds', 'Latency of outbound Stripe API calls.', ['operation'])
+STRIPE_IN_FLIGHT = REGISTRY.gauge(
+    'stripe_requests_in_flight', 'Stripe API calls currently in progress.', ['operation'])
+STRIPE_ERRORS = REGISTRY.counter(
+    'stripe_errors_total', 'Failed Stripe API calls by error class.', ['operation', 'error_class'])
+STRIPE_RETRIES = REGISTRY.counter(
+    'stripe_retries_total', 'Stripe API attempts retried or hedged, by reason.', ['operation', 'reason'])
+STRIPE_SHED = REGISTRY.counter(
+    'stripe_shed_total', 'Stripe API calls failed fast without calling Stripe, by reason.', ['operation', 'reason'])
+STRIPE_CIRCUIT_OPEN = REGISTRY.gauge(
+    'stripe_circuit_open', 'Circuit breaker state for Stripe (0 closed, 0.5 half-open, 1 open).')
+STRIPE_QUEUE_DEPTH = REGISTRY.gauge(
+    'stripe_scheduler_queue_depth', 'Stripe calls waiting for a send slot, by priority lane.', ['lane'])
+STRIPE_QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    'stripe_scheduler_wait_seconds', 'Time Stripe calls waited for a send slot, by priority lane.', ['lane'])
+STRIPE_RATE_LIMIT = REGISTRY.gauge(
+    'stripe_scheduler_rate', 'Current adaptive send rate for Stripe calls (calls per second).')
+STRIPE_THROTTLED = REGISTRY.counter(
+    'stripe_scheduler_throttled_total', 'Send rate reductions after 429 responses, by bucket.', ['bucket'])
+STRIPE_CACHE_LOOKUPS = REGISTRY.counter(
+    'stripe_cache_lookups_total', 'Stripe object reads by object type and cache result.', ['object', 'result'])
+UPTIME_READ_SECONDS = REGISTRY.histogram(
+    'uptime_read_duration_seconds', 'Time spent reading server uptime.',
+    buckets=(0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.0001, 0.001))
+BILLED_AMOUNT = REGISTRY.counter(
+    'billed_amount_total', 'Amount billed through Stripe, in minor currency units.', ['kind', 'currency'])
+USAGE_RECORDED = REGISTRY.counter(
+    'usage_recorded_total', 'Metered usage accepted into the write-ahead log.', ['event_name'])
+USAGE_REPORTED = REGISTRY.counter(
+    'usage_reported_total', 'Metered usage confirmed by Stripe meter events.', ['event_name'])
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Latency of HTTP handlers.', ['handler', 'method'])
+HTTP_IN_FLIGHT = REGISTRY.gauge(
+    'http_requests_in_flight', 'HTTP requests currently being handled.')
+
+
+class StripeOperationMetrics:
+    """Stripe操作1種類分のレイテンシ・実行中数・エラー種別（操作ごとに1つだけ作って使い回す）
+
+    begin() の戻り値を end() に渡す形なので、同じ操作が並行して走っても状態を共有しない。
+    """
+
+    __slots__ = ('operation', 'histogram', 'in_flight')
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.histogram = STRIPE_REQUEST_SECONDS.labels(operation)
+        self.in_flight = STRIPE_IN_FLIGHT.labels(operation)
+
+    def begin(self) -> float:
+        self.in_flight.value += 1
+        return _perf_counter()
+
+    def end(self, start: float, error: Optional[BaseException] = None):
+        elapsed = _perf_counter() - start
+        histogram = self.histogram
+        histogram.counts[bisect_left(histogram.bounds, elapsed)] += 1
+        histogram.sum += elapsed
+        self.in_flight.value -= 1
+        if error is not None:
+            STRIPE_ERRORS.labels(self.operation, type(error).__name__).inc()
+
+
+_stripe_operations: Dict[str, StripeOperationMetrics] = {}
+
+
+def stripe_operation(operation: str) -> StripeOperationMetrics:
+    """操作名に対応する StripeOperationMetrics（初回のみ生成）"""
+    metrics = _stripe_operations.get(operation)
+    if metrics is None:
+        metrics = _stripe_operations.setdefault(operation, StripeOperationMetrics(operation))
+    return metrics
+
+
+class MetricsMiddleware:
+    """FastAPIハンドラーごとのレイテンシと実行中リクエスト数を記録するASGIミドルウェア"""
+
+    def __init__(self, app, exclude: Sequence[str] = ('/metrics',)):
+        self.app = app
+        self.exclude = frozenset(exclude)
+        self.in_flight = HTTP_IN_FLIGHT.labels()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in self.exclude:
+            await self.app(scope, receive, send)
+            return
+
+        self.in_flight.value += 1
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.in_flight.value -= 1
+            # ルーティング後に scope に入るエンドポイント名をラベルにする（パスを使わずカーディナリティを抑える）
+            endpoint = scope.get('endpoint')
+            handler = getattr(endpoint, '__name__', 'unmatched')
+            HTTP_REQUEST_SECONDS.labels(handler, scope['method']).observe(elapsed)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    # 計測区間1回あたりのオーバーヘッドを測る
+    parser = argparse.ArgumentParser(description="Per-section overhead of the metrics instrumentation")
+    parser.add_argument('--iterations', type=int, default=1_000_000, help="timed sections per measurement")
+    args = parser.parse_args()
+
+    iterations = args.iterations
+    histogram = REGISTRY.histogram('benchmark_seconds', 'benchmark').labels()
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        pass
+    empty = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        section_start = time.perf_counter()
+        histogram.observe(time.perf_counter() - section_start)
+    observe = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with histogram.time():
+            pass
+    timer = time.perf_counter() - start
+
+    operation = stripe_operation('benchmark')
+    start = time.perf_counter()
+    for _ in range(iterations):
+        section_start = operation.begin()
+        operation.end(section_start)
+    stripe_section = time.perf_counter() - start
+
+    print("⏱️  計測区間あたりのオーバーヘッド")
+    print(f"  perf_counter + observe : {(observe - empty) / iterations * 1e9:.0f} ns")
+    print(f"  with histogram.time()  : {(timer - empty) / iterations * 1e9:.0f} ns")
+    print(f"  stripe begin/end       : {(stripe_section - empty) / iterations * 1e9:.0f} ns")
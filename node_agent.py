@@ -0,0 +1,292 @@
+"""
+# node_agent.py
+Lightweight Node Agent
+各サーバーで FastAPI アプリや ServerBillingManager を動かさずに、稼働のハートビートだけを
+集めてまとめて圧縮し、定期的にコレクター（web_app.py の /api/agent/heartbeats）へ送る。
+
+標準ライブラリだけで動く（psutil・dotenv・stripe・FastAPI は読み込まない）。
+ハートビートは時刻だけを array('d') に溜め、送るときに前回からの差分（ミリ秒）の uint32 列にして
+zlib で圧縮する。間隔がほぼ一定なので差分はほとんど同じ値になり、1件あたり数バイトになる。
+
+送った単位（フレーム）には連番を付け、応答がなかったフレームは次の送信で一緒に送り直す。
+コレクターは連番で重複を捨てるので、タイムアウト後の再送でも二重に数えない。
+
+    python node_agent.py http://collector:8000 --node-id web-1
+    python server_billing.py agent http://collector:8000   # 同じもの
+"""
+import http.client
+import os
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+from array import array
+from typing import Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlsplit
+
+CONTENT_TYPE = 'application/x-heartbeat-batch'
+MAGIC = b'HBT1'
+# フレームのヘッダー: magic, ノード名の長さ, エージェントのセッションID, 連番, 起動時刻,
+# 最初のハートビートの時刻, 間隔（秒）, 件数
+FRAME_HEADER = struct.Struct('<4sHQIddfI')
+MAX_BODY_BYTES = 16 * 1024 * 1024  # 展開後の上限（圧縮爆弾よけ）
+BIG_ENDIAN = sys.byteorder == 'big'  # 差分列はリトルエンディアンの uint32 で送る
+
+
+class HeartbeatFrame(NamedTuple):
+    """1ノードの連続したハートビート（時刻は first_seen + 差分の累積）"""
+
+    node_id: str
+    session: int  # エージェントの起動ごとに変わるID（連番はセッション内で 1 から増える）
+    seq: int
+    boot_time: float
+    interval: float
+    first_seen: float
+    deltas_ms: array  # array('I'): 前のハートビートからの経過ミリ秒（先頭は 0）
+
+    @property
+    def count(self) -> int:
+        return len(self.deltas_ms)
+
+    @property
+    def last_seen(self) -> float:
+        return self.first_seen + sum(self.deltas_ms) / 1000.0
+
+    def covered_seconds(self, gap_factor: float = 2.5) -> float:
+        """ハートビートの間隔が interval * gap_factor 以下の区間の合計（途切れた区間は数えない）"""
+        limit = self.interval * gap_factor * 1000.0
+        return sum(delta for delta in self.deltas_ms if delta <= limit) / 1000.0
+
+
+def encode_frame(node_id: str, session: int, seq: int, boot_time: float, interval: float, timestamps) -> bytes:
+    """ハートビートの時刻列を1フレームにする（圧縮は encode_batch でまとめて行う）"""
+    name = node_id.encode('utf-8')
+    deltas = array('I', bytes(4 * len(timestamps)))
+    first_ms = previous_ms = round(timestamps[0] * 1000) if len(timestamps) else 0
+    for index in range(1, len(timestamps)):
+        current_ms = round(timestamps[index] * 1000)
+        deltas[index] = max(0, current_ms - previous_ms)
+        previous_ms = current_ms
+    if BIG_ENDIAN:
+        deltas.byteswap()
+    header = FRAME_HEADER.pack(MAGIC, len(name), session, seq, boot_time, first_ms / 1000.0, interval, len(deltas))
+    return header + name + deltas.tobytes()
+
+
+def encode_batch(frames: List[bytes]) -> bytes:
+    """フレームを連結して zlib で圧縮する（送信1回分の本文）"""
+    return zlib.compress(b''.join(frames), 6)
+
+
+def decode_batch(body: bytes) -> List[HeartbeatFrame]:
+    """送信1回分の本文をフレームに戻す（形式が壊れていれば ValueError）"""
+    inflater = zlib.decompressobj()
+    try:
+        data = inflater.decompress(body, MAX_BODY_BYTES)
+    except zlib.error as e:
+        raise ValueError(f"invalid heartbeat batch: {e}") from None
+    if inflater.unconsumed_tail:
+        raise ValueError(f"heartbeat batch expands beyond {MAX_BODY_BYTES} bytes")
+    frames = []
+    view = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < FRAME_HEADER.size:
+            raise ValueError("truncated heartbeat frame header")
+        magic, name_length, session, seq, boot_time, first_seen, interval, count = \
+            FRAME_HEADER.unpack_from(data, offset)
+        if magic != MAGIC:
+            raise ValueError(f"unknown heartbeat frame format {magic!r}")
+        offset += FRAME_HEADER.size
+        end = offset + name_length + count * 4
+        if end > len(data):
+            raise ValueError("truncated heartbeat frame")
+        node_id = bytes(view[offset:offset + name_length]).decode('utf-8')
+        deltas = array('I')
+        deltas.frombytes(view[offset + name_length:end])
+        if BIG_ENDIAN:
+            deltas.byteswap()
+        frames.append(HeartbeatFrame(node_id, session, seq, boot_time, interval, first_seen, deltas))
+        offset = end
+    return frames
+
+
+def read_boot_time() -> float:
+    """OSの起動時刻（Linux は /proc/stat の btime。psutil.boot_time() と同じ値）"""
+    try:
+        with open('/proc/stat', 'rb') as f:
+            for line in f:
+                if line.startswith(b'btime '):
+                    return float(line.split()[1])
+    except OSError:
+        pass
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return time.time() - time.clock_gettime(time.CLOCK_BOOTTIME)
+    return time.time() - time.monotonic()
+
+
+class HeartbeatAgent:
+    """ハートビートを溜めて定期的にコレクターへ送る（1スレッド・標準ライブラリのみ）"""
+
+    def __init__(self, collector_url: str, node_id: Optional[str] = None, interval: float = 10.0,
+                 ship_every: float = 60.0, max_buffer: int = 8640, token: Optional[str] = None,
+                 timeout: float = 10.0, clock: Callable[[], float] = time.time,
+                 boot_time: Optional[float] = None):
+        parts = urlsplit(collector_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"collector URL must be http(s)://host[:port]: {collector_url}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path.rstrip('/') or '') + '/api/agent/heartbeats'
+        self.node_id = node_id or socket.gethostname()
+        self.interval = interval  # ハートビートの間隔（秒）
+        self.ship_every = ship_every  # 送信の間隔（秒）
+        self.max_buffer = max_buffer  # 送れないときに溜めておくハートビートの上限（古いものから捨てる）
+        self.token = token
+        self.timeout = timeout
+        self.clock = clock
+        self.boot_time = boot_time if boot_time is not None else read_boot_time()
+
+        self.timestamps = array('d')  # まだフレームにしていないハートビート
+        self.pending: List[Tuple[int, int, bytes]] = []  # (連番, 件数, フレーム) 応答待ちのもの
+        self.session = random.getrandbits(64)
+        self.next_seq = 1
+        self._stop = threading.Event()
+
+        self.shipped = 0  # 受け付けられたハートビート数
+        self.dropped = 0  # 上限を超えて捨てたハートビート数
+        self.batches = 0
+        self.failures = 0
+        self.bytes_sent = 0
+
+    def beat(self, now: Optional[float] = None):
+        """ハートビートを1件記録する"""
+        self.timestamps.append(self.clock() if now is None else now)
+        overflow = self.buffered() - self.max_buffer
+        while overflow > 0 and self.pending:
+            _, count, _ = self.pending.pop(0)
+            self.dropped += count
+            overflow -= count
+        if overflow > 0:
+            del self.timestamps[:overflow]
+            self.dropped += overflow
+
+    def buffered(self) -> int:
+        return len(self.timestamps) + sum(count for _, count, _ in self.pending)
+
+    def seal(self):
+        """溜まったハートビートを連番付きのフレームにする（以後この中身は変えずに再送する）"""
+        if not self.timestamps:
+            return
+        frame = encode_frame(self.node_id, self.session, self.next_seq, self.boot_time, self.interval, self.timestamps)
+        self.pending.append((self.next_seq, len(self.timestamps), frame))
+        self.next_seq += 1
+        self.timestamps = array('d')
+
+    def _connect(self) -> http.client.HTTPConnection:
+        # 送信は数十秒に1回で、サーバーの keep-alive はそれより先に切れるので毎回つなぐ
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def ship(self) -> bool:
+        """応答待ちのフレームを送る（受け付けられたら捨て、失敗したら次の送信で送り直す）"""
+        self.seal()
+        if not self.pending:
+            return True
+        body = encode_batch([frame for _, _, frame in self.pending])
+        headers = {'Content-Type': CONTENT_TYPE, 'Content-Length': str(len(body))}
+        if self.token:
+            headers['Authorization'] = f"Bearer {self.token}"
+        connection = self._connect()
+        try:
+            connection.request('POST', self.path, body, headers)
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            self.failures += 1
+            print(f"⚠️ ハートビートの送信に失敗: {e} ({self.buffered()} 件を保持)")
+            return False
+        finally:
+            connection.close()
+        self.bytes_sent += len(body)
+        if response.status in (400, 413, 415):
+            # 形式・大きさが受け付けられない: 送り直しても同じなので捨てる
+            self.dropped += sum(count for _, count, _ in self.pending)
+            self.pending.clear()
+            print(f"❌ コレクターがハートビートを拒否しました (HTTP {response.status})")
+            return False
+        if response.status >= 300:
+            self.failures += 1
+            print(f"⚠️ コレクターの応答 HTTP {response.status} ({self.buffered()} 件を保持)")
+            return False
+        self.shipped += sum(count for _, count, _ in self.pending)
+        self.batches += 1
+        self.pending.clear()
+        return True
+
+    def run(self):
+        """stop() まで interval ごとに記録し、ship_every ごとに送る"""
+        # 多数のノードが同時に起動しても送信が揃わないよう、最初の送信をずらす
+        next_ship = time.monotonic() + random.uniform(0, self.ship_every)
+        next_beat = time.monotonic()
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= next_beat:
+                self.beat()
+                next_beat += self.interval
+            if now >= next_ship:
+                self.ship()
+                next_ship = now + self.ship_every
+            self._stop.wait(max(0.0, min(next_beat, next_ship) - time.monotonic()))
+        self.ship()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> dict:
+        return {
+            'node_id': self.node_id,
+            'buffered': self.buffered(),
+            'shipped': self.shipped,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'failures': self.failures,
+            'bytes_sent': self.bytes_sent,
+        }
+
+
+def main(argv: Optional[List[str]] = None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Ship uptime heartbeats to a billing collector (stdlib only)")
+    parser.add_argument('collector', nargs='?', default=os.getenv('AGENT_COLLECTOR_URL'),
+                        help="collector base URL, e.g. http://billing:8000 (or AGENT_COLLECTOR_URL)")
+    parser.add_argument('--node-id', default=os.getenv('SERVER_NAME') or socket.gethostname())
+    parser.add_argument('--interval', type=float, default=float(os.getenv('AGENT_INTERVAL', 10.0)),
+                        help="seconds between heartbeats")
+    parser.add_argument('--ship-every', type=float, default=float(os.getenv('AGENT_SHIP_EVERY', 60.0)),
+                        help="seconds between batches sent to the collector")
+    parser.add_argument('--max-buffer', type=int, default=8640, help="heartbeats kept while the collector is down")
+    args = parser.parse_args(argv)
+    if not args.collector:
+        parser.error("collector URL is required (argument or AGENT_COLLECTOR_URL)")
+
+    agent = HeartbeatAgent(args.collector, args.node_id, args.interval, args.ship_every,
+                           args.max_buffer, token=os.getenv('AGENT_TOKEN'))
+    print(f"📡 {agent.node_id}: {args.interval:g}秒ごとのハートビートを {args.ship_every:g}秒ごとに "
+          f"{args.collector} へ送信します")
+    try:
+        agent.run()
+    except KeyboardInterrupt:
+        agent.stop()
+        agent.ship()
+    print(f"📊 {agent.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+# node_registry.py
+Node Heartbeat Registry
+node_agent.py から届いたハートビートのバッチをノードごとの状態（起動時刻・最後に見た時刻・
+ハートビートで確認できた稼働秒数・再起動回数）にまとめるコレクター側の台帳。
+
+1回の送信に含まれるフレームはまとめて1回のロックで反映し、ノードの状態は __slots__ の
+小さなオブジェクトで持つ（数千ノードでもメモリは数MB）。同じセッションの連番が既に
+反映済みのフレームは再送とみなして捨てる。台帳のノード数には上限があり、超えた新しい
+ノードのフレームは反映しない（認証なしで公開したときに任意のノード名でメモリを食われないように）。
+"""
+import threading
+import time
+from typing import Dict, List, Optional
+
+from node_agent import HeartbeatFrame
+
+
+class NodeState:
+    """1ノードの状態"""
+
+    __slots__ = ('node_id', 'session', 'last_seq', 'boot_time', 'interval', 'first_seen', 'last_seen',
+                 'heartbeats', 'covered_seconds', 'restarts', 'gaps')
+
+    def __init__(self, node_id: str, frame: HeartbeatFrame):
+        self.node_id = node_id
+        self.session = frame.session
+        self.last_seq = 0
+        self.boot_time = frame.boot_time
+        self.interval = frame.interval
+        self.first_seen = frame.first_seen
+        self.last_seen = frame.first_seen
+        self.heartbeats = 0
+        self.covered_seconds = 0.0  # ハートビートで稼働が確認できた秒数（途切れた区間を除く）
+        self.restarts = 0  # OSの再起動を検知した回数
+        self.gaps = 0  # ハートビートが途切れた回数
+
+    def to_dict(self, now: float, stale_after: float) -> Dict:
+        return {
+            'node_id': self.node_id,
+            'online': now - self.last_seen <= stale_after,
+            'boot_time': self.boot_time,
+            'uptime_seconds': round(self.last_seen - self.boot_time, 3),
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+            'heartbeats': self.heartbeats,
+            'covered_seconds': round(self.covered_seconds, 3),
+            'restarts': self.restarts,
+            'gaps': self.gaps,
+        }
+
+
+class NodeRegistry:
+    """全ノードのハートビートの集計（スレッドセーフ）"""
+
+    def __init__(self, stale_after: float = 180.0, gap_factor: float = 2.5, max_nodes: int = 10000):
+        self.stale_after = stale_after  # これ以上ハートビートがなければオフライン扱い（秒）
+        self.gap_factor = gap_factor  # 間隔の何倍空いたら途切れとみなすか
+        self.max_nodes = max_nodes  # 台帳に載せるノード数の上限
+        self.nodes: Dict[str, NodeState] = {}
+        self._lock = threading.Lock()
+
+        self.batches = 0
+        self.frames = 0
+        self.heartbeats = 0
+        self.duplicates = 0  # 再送で届いた反映済みのフレーム
+        self.rejected = 0  # ノード数の上限を超えたため捨てたフレーム
+
+    def apply(self, frames: List[HeartbeatFrame]) -> Dict:
+        """1回の送信分のフレームをまとめて反映する（反映した件数と捨てた再送・上限超過の件数を返す）"""
+        accepted = duplicates = rejected = 0
+        with self._lock:
+            for frame in frames:
+                node = self.nodes.get(frame.node_id)
+                if node is None:
+                    if len(self.nodes) >= self.max_nodes:
+                        rejected += 1
+                        continue
+                    node = self.nodes[frame.node_id] = NodeState(frame.node_id, frame)
+                elif frame.session != node.session:
+                    # エージェントが再起動した: 連番が 1 からやり直しになる
+                    node.session = frame.session
+                    node.last_seq = 0
+                elif frame.seq <= node.last_seq:
+                    duplicates += 1
+                    continue
+                if frame.boot_time > node.boot_time + 1.0:
+                    node.restarts += 1
+                    node.boot_time = frame.boot_time
+                node.last_seq = frame.seq
+                node.interval = frame.interval
+                limit = frame.interval * self.gap_factor
+                if node.heartbeats:
+                    # 前回のフレームの最後からこのフレームの最初までも稼働区間に含める
+                    bridge = frame.first_seen - node.last_seen
+                    if 0 <= bridge <= limit:
+                        node.covered_seconds += bridge
+                    elif bridge > limit:
+                        node.gaps += 1
+                node.covered_seconds += frame.covered_seconds(self.gap_factor)
+                node.gaps += sum(1 for delta in frame.deltas_ms if delta > limit * 1000.0)
+                node.last_seen = max(node.last_seen, frame.last_seen)
+                node.heartbeats += frame.count
+                accepted += frame.count
+            self.batches += 1
+            self.frames += len(frames)
+            self.heartbeats += accepted
+            self.duplicates += duplicates
+            self.rejected += rejected
+        return {'accepted': accepted, 'duplicates': duplicates, 'rejected': rejected}
+
+    def get(self, node_id: str, now: Optional[float] = None) -> Optional[Dict]:
+        node = self.nodes.get(node_id)
+        return node.to_dict(now or time.time(), self.stale_after) if node is not None else None
+
+    def list(self, offset: int = 0, limit: int = 100, now: Optional[float] = None) -> List[Dict]:
+        """ノード名順のノードの状態"""
+        now = now or time.time()
+        with self._lock:
+            names = sorted(self.nodes)[offset:offset + limit]
+            return [self.nodes[name].to_dict(now, self.stale_after) for name in names]
+
+    def stats(self, now: Optional[float] = None) -> Dict:
+        now = now or time.time()
+        with self._lock:
+            online = sum(1 for node in self.nodes.values() if now - node.last_seen <= self.stale_after)
+            return {
+                'nodes': len(self.nodes),
+                'online': online,
+                'offline': len(self.nodes) - online,
+                'batches': self.batches,
+                'frames': self.frames,
+                'heartbeats': self.heartbeats,
+                'duplicates': self.duplicates,
+                'rejected': self.rejected,
+                'max_nodes': self.max_nodes,
+                'stale_after': self.stale_after,
+            }
@@ -0,0 +1,103 @@
+"""
+# periodic_billing.py
+Periodic Charging
+稼働時間台帳をもとに、interval 秒ごとに区切った確定済みの課金期間を古い順に1つずつ請求する。
+期間の境界はUNIX時刻で揃えるので、冪等キー（顧客 + 期間開始）は再試行しても変わらない。
+請求済みの終端（ウォーターマーク）は共有状態に置き、複数ワーカーでもリーダー1つだけが実行する。
+"""
+import asyncio
+import math
+import time
+from typing import Dict, List, Optional
+
+
+class PeriodicCharger:
+    """定期課金（確定した期間ごとにインボイスを作成）"""
+
+    def __init__(self, billing_manager, customer_id: str, interval: float = 3600.0,
+                 max_windows_per_tick: int = 24):
+        if billing_manager.ledger is None:
+            raise ValueError("periodic charging needs the uptime ledger (UPTIME_LEDGER_PATH)")
+        self.billing_manager = billing_manager  # AsyncServerBillingManager
+        self.customer_id = customer_id
+        self.interval = interval
+        self.max_windows_per_tick = max_windows_per_tick  # 1回に追いつく期間数の上限
+        self._charged_until = 0.0  # 共有状態がない場合のウォーターマーク
+
+        self.charged_windows = 0
+        self.skipped_windows = 0  # 稼働ゼロで請求しなかった期間
+        self.failures = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def charged_until(self) -> float:
+        state = self.billing_manager.shared_state
+        return state.charged_until if state is not None else self._charged_until
+
+    def _advance(self, timestamp: float):
+        state = self.billing_manager.shared_state
+        if state is not None:
+            state.set_charged_until(timestamp)
+        else:
+            self._charged_until = timestamp
+
+    def idempotency_key(self, window_start: float) -> str:
+        return f"periodic:{self.customer_id}:{int(window_start)}"
+
+    def first_window_start(self) -> float:
+        """未課金の最初の期間の開始（ウォーターマーク、なければ台帳の先頭を含む期間）"""
+        charged_until = self.charged_until
+        if charged_until > 0:
+            return charged_until
+        period_start, _ = self.billing_manager.resolve_period()
+        return math.floor(period_start / self.interval) * self.interval
+
+    async def charge_due(self, now: Optional[float] = None) -> List[Dict]:
+        """終わった期間を古い順に請求する（失敗したらそこで止めて次回に再試行）"""
+        now = time.time() if now is None else now
+        ledger = self.billing_manager.ledger
+        results = []
+        window_start = self.first_window_start()
+        while len(results) < self.max_windows_per_tick and window_start + self.interval <= now:
+            window_end = window_start + self.interval
+            if ledger.billable_seconds(window_start, window_end) <= 0:
+                # 稼働していない期間は最低料金を請求せずに進める
+                self.skipped_windows += 1
+                self._advance(window_end)
+                window_start = window_end
+                continue
+
+            result = await self.billing_manager.create_invoice(
+                self.customer_id,
+                period_start=window_start,
+                period_end=window_end,
+                idempotency_key=self.idempotency_key(window_start),
+            )
+            results.append(result)
+            if not result['success']:
+                self.failures += 1
+                self.last_error = result['error']
+                print(f"❌ 定期課金エラー ({self.customer_id}, {window_start:.0f}〜): {result['error']}")
+                break
+            self.charged_windows += 1
+            self._advance(window_end)
+            window_start = window_end
+        return results
+
+    async def run(self, check_interval: float = 60.0):
+        """リーダーの間だけ定期的に charge_due() を実行する"""
+        while True:
+            if self.billing_manager.try_lead():
+                await self.charge_due()
+            await asyncio.sleep(min(check_interval, self.interval))
+
+    def stats(self) -> Dict:
+        return {
+            'customer_id': self.customer_id,
+            'interval': self.interval,
+            'charged_until': self.charged_until,
+            'charged_windows': self.charged_windows,
+            'skipped_windows': self.skipped_windows,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
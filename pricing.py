@@ -0,0 +1,350 @@
+"""
+# pricing.py
+Pricing Engine
+料金表（定額・段階・ボリューム・時間帯別）を一度だけ整数の参照テーブルにコンパイルし、
+課金額を通貨の最小単位（円・セントなど）の整数で計算する。
+
+計算はすべて整数で行う。稼働時間はミリ秒、単価は「最小単位 × RATE_SCALE / 時間」で持ち、
+丸めは最後に1回だけ（偶数丸め）行うので浮動小数点の誤差は入らない。
+段階料金は区切りごとの累積額、時間帯別料金は1日分の累積額を前計算しておくので、
+どんな長さの区間でも二分探索1回（O(log 区切り数)）で価格が決まる。
+
+料金表の指定（JSON）
+    {"type": "flat", "rate": "100"}
+    {"type": "graduated", "tiers": [{"up_to": 100, "rate": "120"}, {"up_to": null, "rate": "90"}]}
+    {"type": "volume", "tiers": [{"up_to": 100, "rate": "120"}, {"up_to": null, "rate": "90"}]}
+    {"type": "time_of_day", "utc_offset": 540, "bands": [{"from": "00:00", "rate": "60"}, {"from": "08:00", "rate": "120"}]}
+rate は通貨の主単位での1時間あたりの料金（"1.25" ドルなど、文字列で書けば誤差なく読める）、
+up_to は段階の上限（稼働時間・時間）、utc_offset は時間帯の基準にする時差（分）。
+"""
+import json
+import os
+from bisect import bisect_left, bisect_right
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Stripeで小数点以下を持たない通貨（金額をそのまま最小単位で送る）
+ZERO_DECIMAL_CURRENCIES = frozenset({
+    'bif', 'clp', 'djf', 'gnf', 'jpy', 'kmf', 'krw', 'mga', 'pyg', 'rwf',
+    'ugx', 'vnd', 'vuv', 'xaf', 'xof', 'xpf',
+})
+# 小数点以下3桁の通貨
+THREE_DECIMAL_CURRENCIES = frozenset({'bhd', 'jod', 'kwd', 'omr', 'tnd'})
+
+RATE_SCALE = 10 ** 6  # 単価は最小単位の 1/10^6 まで持てる
+MS_PER_HOUR = 3_600_000
+MS_PER_DAY = 24 * MS_PER_HOUR
+MINIMUM_BILLABLE_MS = 60_000  # 最小課金時間は1分
+
+Coverage = Callable[[float, float], float]  # (開始, 終了) -> その間の稼働秒数
+
+
+def currency_exponent(currency: str) -> int:
+    """通貨の最小単位の桁数（jpy: 0, usd: 2, kwd: 3）"""
+    currency = currency.lower()
+    if currency in ZERO_DECIMAL_CURRENCIES:
+        return 0
+    if currency in THREE_DECIMAL_CURRENCIES:
+        return 3
+    return 2
+
+
+def parse_rate(value, currency: str) -> int:
+    """主単位の時間単価（"1.25" など）を 最小単位 × RATE_SCALE の整数にする"""
+    scaled = Decimal(str(value)) * (10 ** currency_exponent(currency)) * RATE_SCALE
+    if scaled != scaled.to_integral_value() or scaled < 0:
+        raise ValueError(f"rate {value!r} is negative or too precise for {currency}")
+    return int(scaled)
+
+
+def to_ms(seconds: float) -> int:
+    """秒（float）をミリ秒の整数にする（入力の丸めはここだけ）"""
+    return round(seconds * 1000)
+
+
+def round_half_even(numerator: int, denominator: int) -> int:
+    """整数の割り算を偶数丸めする（round() と同じ規則を誤差なしで）"""
+    quotient, remainder = divmod(numerator, denominator)
+    twice = 2 * remainder
+    if twice > denominator or (twice == denominator and quotient % 2 == 1):
+        quotient += 1
+    return quotient
+
+
+def format_minor(amount: int, currency: str) -> str:
+    """最小単位の金額を表示用の文字列にする（1234, 'usd' -> '12.34'）"""
+    exponent = currency_exponent(currency)
+    if exponent == 0:
+        return str(amount)
+    sign = '-' if amount < 0 else ''
+    whole, fraction = divmod(abs(amount), 10 ** exponent)
+    return f"{sign}{whole}.{fraction:0{exponent}d}"
+
+
+class RateSchedule:
+    """コンパイル済み料金表の基底クラス（サブクラスは _numerator だけを実装する）"""
+
+    kind = 'base'
+
+    def __init__(self, currency: str = 'jpy', minimum_ms: int = MINIMUM_BILLABLE_MS):
+        self.currency = currency
+        self.minimum_ms = minimum_ms
+        self._denominator = MS_PER_HOUR * RATE_SCALE
+
+    def _numerator(self, billable_ms: int, start_ms: int, end_ms: int,
+                   coverage: Optional[Coverage]) -> int:
+        """課金額 × MS_PER_HOUR × RATE_SCALE（丸め前の正確な値）"""
+        raise NotImplementedError
+
+    def price(self, billable_seconds: float, start: Optional[float] = None, end: Optional[float] = None,
+              coverage: Optional[Coverage] = None) -> int:
+        """課金額（最小単位の整数）
+
+        start / end は時間帯別料金で使う稼働区間（省略時は end = start + 稼働秒数）。
+        区間内に停止があった場合は coverage(開始, 終了) で部分区間ごとの稼働秒数を渡す。
+        """
+        billable_ms = to_ms(billable_seconds)
+        start_ms = to_ms(start) if start is not None else 0
+        end_ms = to_ms(end) if end is not None else start_ms + billable_ms
+        if abs((end_ms - start_ms) - billable_ms) <= 1:
+            billable_ms = end_ms - start_ms  # 連続稼働（秒→ミリ秒の丸めの違いは区間側に揃える）
+        billable_ms = max(billable_ms, self.minimum_ms)
+        return round_half_even(self._numerator(billable_ms, start_ms, end_ms, coverage), self._denominator)
+
+    def price_many(self, intervals: Iterable[Tuple[float, float]]) -> List[int]:
+        """(開始, 終了) の連続稼働区間をまとめて価格計算する"""
+        numerator = self._numerator
+        denominator = self._denominator
+        minimum_ms = self.minimum_ms
+        amounts = []
+        for start, end in intervals:
+            start_ms, end_ms = round(start * 1000), round(end * 1000)
+            billable_ms = max(end_ms - start_ms, minimum_ms)
+            amounts.append(round_half_even(numerator(billable_ms, start_ms, end_ms, None), denominator))
+        return amounts
+
+    def display_rate(self) -> str:
+        """表示用の代表単価（主単位/時間）"""
+        raise NotImplementedError
+
+    def describe(self) -> Dict:
+        return {'type': self.kind, 'currency': self.currency, 'rate': self.display_rate()}
+
+    def _format_rate(self, rate: int) -> str:
+        exponent = currency_exponent(self.currency)
+        return format((Decimal(rate) / RATE_SCALE / (10 ** exponent)).normalize(), 'f')
+
+
+class FlatRate(RateSchedule):
+    """定額の時間単価"""
+
+    kind = 'flat'
+
+    def __init__(self, rate, currency: str = 'jpy', minimum_ms: int = MINIMUM_BILLABLE_MS):
+        super().__init__(currency, minimum_ms)
+        self.rate = parse_rate(rate, currency)
+
+    def _numerator(self, billable_ms, start_ms, end_ms, coverage):
+        return billable_ms * self.rate
+
+    def display_rate(self) -> str:
+        return self._format_rate(self.rate)
+
+
+class TieredRate(RateSchedule):
+    """稼働時間に応じた段階料金
+
+    graduated: 各段階に入った分だけその段階の単価（区切りごとの累積額を前計算）
+    volume: 合計の稼働時間が入る段階の単価を全体に適用
+    """
+
+    def __init__(self, tiers: Sequence[Tuple[Optional[float], object]], mode: str = 'graduated',
+                 currency: str = 'jpy', minimum_ms: int = MINIMUM_BILLABLE_MS):
+        super().__init__(currency, minimum_ms)
+        if mode not in ('graduated', 'volume'):
+            raise ValueError(f"unknown tier mode {mode!r}")
+        if not tiers:
+            raise ValueError("at least one tier is required")
+        self.kind = mode
+
+        # 段階の上限（ミリ秒、昇順）。最後の段階は上限なし
+        self.upper_ms: List[int] = []
+        self.rates: List[int] = []
+        for index, (up_to_hours, rate) in enumerate(tiers):
+            last = index == len(tiers) - 1
+            if up_to_hours is None:
+                if not last:
+                    raise ValueError("only the last tier may be unbounded")
+                upper = None
+            else:
+                upper = to_ms(float(Decimal(str(up_to_hours)) * 3600))
+                if self.upper_ms and upper <= self.upper_ms[-1]:
+                    raise ValueError("tier bounds must be increasing")
+            if upper is not None:
+                self.upper_ms.append(upper)
+            self.rates.append(parse_rate(rate, currency))
+        if len(self.upper_ms) == len(self.rates):
+            # 最後の段階にも上限がある場合、それを超えた分は最後の単価で続ける
+            self.rates.append(self.rates[-1])
+
+        # graduated 用: 各段階の開始位置とそこまでの累積額
+        self.starts_ms = [0] + self.upper_ms
+        self.cumulative = [0]
+        for index, upper in enumerate(self.upper_ms):
+            self.cumulative.append(self.cumulative[-1] + (upper - self.starts_ms[index]) * self.rates[index])
+
+    def _numerator(self, billable_ms, start_ms, end_ms, coverage):
+        if self.kind == 'volume':
+            return billable_ms * self.rates[bisect_left(self.upper_ms, billable_ms)]
+        index = bisect_right(self.starts_ms, billable_ms) - 1
+        return self.cumulative[index] + (billable_ms - self.starts_ms[index]) * self.rates[index]
+
+    def display_rate(self) -> str:
+        return self._format_rate(self.rates[0])
+
+    def describe(self) -> Dict:
+        description = super().describe()
+        description['tiers'] = [
+            {'up_to_hours': upper / MS_PER_HOUR if upper is not None else None, 'rate': self._format_rate(rate)}
+            for upper, rate in zip(self.upper_ms + [None], self.rates)
+        ]
+        return description
+
+
+class TimeOfDayRate(RateSchedule):
+    """時間帯別の時間単価（1日分の累積額を前計算し、任意の区間を差分で求める）"""
+
+    kind = 'time_of_day'
+
+    def __init__(self, bands: Sequence[Tuple[str, object]], utc_offset_minutes: int = 0,
+                 currency: str = 'jpy', minimum_ms: int = MINIMUM_BILLABLE_MS):
+        super().__init__(currency, minimum_ms)
+        if not bands:
+            raise ValueError("at least one band is required")
+        parsed = sorted((self._parse_clock(clock), parse_rate(rate, currency)) for clock, rate in bands)
+        if parsed[0][0] != 0:
+            # 0時より前は前日最後の時間帯の続き
+            parsed.insert(0, (0, parsed[-1][1]))
+        self.starts_ms = [start for start, _ in parsed]
+        self.rates = [rate for _, rate in parsed]
+        self.offset_ms = utc_offset_minutes * 60_000
+
+        self.cumulative = [0]
+        for index in range(1, len(self.starts_ms)):
+            width = self.starts_ms[index] - self.starts_ms[index - 1]
+            self.cumulative.append(self.cumulative[-1] + width * self.rates[index - 1])
+        self.day_total = self.cumulative[-1] + (MS_PER_DAY - self.starts_ms[-1]) * self.rates[-1]
+
+    @staticmethod
+    def _parse_clock(clock: str) -> int:
+        hours, minutes = clock.split(':')
+        value = (int(hours) * 60 + int(minutes)) * 60_000
+        if not 0 <= value < MS_PER_DAY:
+            raise ValueError(f"invalid time of day {clock!r}")
+        return value
+
+    def _cost_until(self, when_ms: int) -> int:
+        """UNIX時刻0から when_ms までずっと稼働した場合の累積額"""
+        days, offset = divmod(when_ms + self.offset_ms, MS_PER_DAY)
+        index = bisect_right(self.starts_ms, offset) - 1
+        return days * self.day_total + self.cumulative[index] + (offset - self.starts_ms[index]) * self.rates[index]
+
+    def segments(self, start: float, end: float) -> Iterator[Tuple[float, float, int]]:
+        """start〜end を時間帯の境界で区切った (開始, 終了, 単価) を順に返す"""
+        start_ms, end_ms = to_ms(start), to_ms(end)
+        while start_ms < end_ms:
+            days, offset = divmod(start_ms + self.offset_ms, MS_PER_DAY)
+            index = bisect_right(self.starts_ms, offset) - 1
+            next_offset = self.starts_ms[index + 1] if index + 1 < len(self.starts_ms) else MS_PER_DAY
+            boundary = min(end_ms, start_ms + next_offset - offset)
+            yield start_ms / 1000, boundary / 1000, self.rates[index]
+            start_ms = boundary
+
+    def _numerator(self, billable_ms, start_ms, end_ms, coverage):
+        if end_ms - start_ms < billable_ms:
+            end_ms = start_ms + billable_ms  # 最小課金時間に満たない区間は延長して数える
+        elif end_ms - start_ms > billable_ms:
+            if coverage is None:
+                raise ValueError("interval has gaps; pass coverage to price it by time of day")
+            # 停止を含む区間: 時間帯ごとに実際の稼働秒数を数える
+            covered_ms = numerator = 0
+            last_rate = None
+            for a, b, rate in self.segments(start_ms / 1000, end_ms / 1000):
+                ms = to_ms(coverage(a, b))
+                if ms:
+                    covered_ms += ms
+                    numerator += ms * rate
+                    last_rate = rate
+                elif last_rate is None:
+                    last_rate = rate
+            if covered_ms < self.minimum_ms:
+                # 他の料金表と同じく最小課金時間に満たない分は、最後に稼働していた時間帯の単価で延長して数える
+                numerator += (self.minimum_ms - covered_ms) * last_rate
+            return numerator
+        return self._cost_until(end_ms) - self._cost_until(start_ms)
+
+    def display_rate(self) -> str:
+        return self._format_rate(self.rates[bisect_right(self.starts_ms, 0) - 1])
+
+    def describe(self) -> Dict:
+        description = super().describe()
+        description['utc_offset'] = self.offset_ms // 60_000
+        description['bands'] = [
+            {'from': f"{start // MS_PER_HOUR:02d}:{start % MS_PER_HOUR // 60_000:02d}", 'rate': self._format_rate(rate)}
+            for start, rate in zip(self.starts_ms, self.rates)
+        ]
+        return description
+
+
+class ResourceRate:
+    """使用量の単価（1 CPU時間 = 1コアを1時間使い切る量あたり、メモリ 1 GB時間あたり。主単位）
+
+    稼働時間の料金に上乗せする使用量分。CPU秒・GB時間はミリ単位の整数にしてから掛け、丸めは1回だけ。
+    """
+
+    def __init__(self, cpu_hour_rate, gb_hour_rate, currency: str = 'jpy'):
+        self.currency = currency
+        self.cpu_hour_rate = parse_rate(cpu_hour_rate, currency)
+        self.gb_hour_rate = parse_rate(gb_hour_rate, currency)
+
+    def price(self, cpu_seconds: float, gb_hours: float) -> int:
+        """使用量分の課金額（最小単位の整数）"""
+        # CPU: CPUミリ秒 × 単価 / (1時間のミリ秒)、メモリ: GBミリ時間 × 単価 / 1000
+        numerator = to_ms(cpu_seconds) * self.cpu_hour_rate + round(gb_hours * 1000) * self.gb_hour_rate * 3600
+        return round_half_even(numerator, MS_PER_HOUR * RATE_SCALE)
+
+    def describe(self) -> Dict:
+        exponent = currency_exponent(self.currency)
+        return {
+            'cpu_hour_rate': format((Decimal(self.cpu_hour_rate) / RATE_SCALE / (10 ** exponent)).normalize(), 'f'),
+            'gb_hour_rate': format((Decimal(self.gb_hour_rate) / RATE_SCALE / (10 ** exponent)).normalize(), 'f'),
+        }
+
+
+def compile_schedule(spec: Dict, currency: str = 'jpy') -> RateSchedule:
+    """料金表の指定（辞書）を RateSchedule にコンパイルする
+
+    金額は currency（Stripeに送る通貨）の最小単位で計算するので、料金表の currency が
+    それと違う場合は ValueError（usd の料金表で計算したセントを円として請求しないため）。
+    """
+    kind = spec.get('type', 'flat')
+    if spec.get('currency', currency).lower() != currency.lower():
+        raise ValueError(f"rate schedule currency {spec['currency']!r} does not match CURRENCY {currency!r}")
+    minimum_ms = int(spec.get('minimum_seconds', MINIMUM_BILLABLE_MS // 1000) * 1000)
+    if kind == 'flat':
+        return FlatRate(spec['rate'], currency, minimum_ms)
+    if kind in ('graduated', 'volume'):
+        tiers = [(tier.get('up_to'), tier['rate']) for tier in spec['tiers']]
+        return TieredRate(tiers, kind, currency, minimum_ms)
+    if kind == 'time_of_day':
+        bands = [(band['from'], band['rate']) for band in spec['bands']]
+        return TimeOfDayRate(bands, int(spec.get('utc_offset', 0)), currency, minimum_ms)
+    raise ValueError(f"unknown rate schedule type {kind!r}")
+
+
+def load_schedule(value: str, currency: str = 'jpy') -> RateSchedule:
+    """RATE_SCHEDULE（JSON文字列かJSONファイルのパス）から料金表を作る"""
+    if not value.lstrip().startswith('{') and os.path.exists(value):
+        with open(value, encoding='utf-8') as f:
+            value = f.read()
+    return compile_schedule(json.loads(value), currency)
@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+# reconciliation.py
+Charge Reconciliation
+calculate_billing_amount で計算した請求（サーバー × 課金期間ごとの金額・稼働時間）と、Stripe上で実際に
+作成された PaymentIntent / インボイスを、metadata の (server_name, billing_period) をキーに突き合わせ、
+金額・稼働時間の不一致、請求漏れ、計算にない請求、二重請求を見つける。
+
+数千万件でもメモリ使用量が一定になるように、両側の記録をまず課金期間のハッシュ、さらに期間の中で
+サーバー名のハッシュでパーティションに振り分けてディスクに書き出し（1パス目）、パーティションごとに
+ハッシュ索引を作って突き合わせる（2パス目）。期間が少なくても1パーティションの索引はサーバー数の
+1/server_partitions に収まる。パーティションごとの索引と結果は状態ディレクトリに残し、期間ごとに
+どのパーティションに入ったかも記録するので、次回は新しく届いた期間のパーティションだけを
+読み直せばよい（同じ記録を再投入しても結果は変わらない）。
+"""
+import csv
+import glob
+import json
+import os
+import pickle
+import shutil
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# (server_name, billing_period, 金額（最小単位）, 稼働時間, Stripeオブジェクトの ID（計算側は None）)
+ChargeRecord = Tuple[str, str, Optional[int], Optional[float], Optional[str]]
+
+ISSUE_TYPES = ('missing', 'unexpected', 'duplicate', 'amount_mismatch', 'hours_mismatch')
+
+EXPECTED, ACTUAL = 0, 1
+
+
+def partition_of(server_name: str, billing_period: str, partitions: int, server_partitions: int = 1) -> int:
+    """(サーバー, 課金期間) のパーティション
+
+    課金期間のハッシュで partitions 個に分け、その中をサーバー名のハッシュで server_partitions 個に分ける。
+    1つの期間の記録は server_partitions 個のパーティションにしか入らない。
+    """
+    period_part = zlib.crc32(billing_period.encode('utf-8')) % partitions
+    return period_part * server_partitions + zlib.crc32(server_name.encode('utf-8')) % server_partitions
+
+
+def _number(value, convert):
+    if value is None or value == '':
+        return None
+    try:
+        return convert(value)
+    except ValueError:
+        return None
+
+
+def read_records(path: str) -> Iterator[ChargeRecord]:
+    """NDJSON / CSV（billing_export の出力や計算結果のファイル）から記録を読む
+
+    金額は amount 列（インボイスは amount_due 列）。server_name か billing_period のない行は読み飛ばす。
+    """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.endswith('.csv'):
+            rows: Iterable[Dict] = csv.DictReader(f)
+        else:
+            rows = (json.loads(line) for line in f if line.strip())
+        for row in rows:
+            server_name, billing_period = row.get('server_name'), row.get('billing_period')
+            if not server_name or not billing_period:
+                continue
+            amount = row.get('amount')
+            if amount is None or amount == '':
+                amount = row.get('amount_due')
+            yield (server_name, billing_period, _number(amount, int), _number(row.get('uptime_hours'), float),
+                   row.get('id') or None)
+
+
+def expected_charges(billing_manager, interval: float, period_start: float, period_end: float
+                     ) -> Iterator[ChargeRecord]:
+    """稼働時間台帳から、定期課金と同じ区切りの期間ごとに計算上の請求を作る（稼働ゼロの期間は除く）"""
+    ledger = billing_manager.ledger
+    window_start = period_start - period_start % interval
+    while window_start + interval <= period_end:
+        window_end = window_start + interval
+        if ledger.billable_seconds(window_start, window_end) > 0:
+            billing_info = billing_manager.calculate_billing_amount(period_start=window_start, period_end=window_end)
+            yield (billing_manager.server_name, billing_manager.billing_period_label(window_start, window_end),
+                   billing_info['billing_amount'], billing_info['billing_hours'], None)
+        window_start = window_end
+
+
+class Reconciler:
+    """パーティション分割したハッシュ索引で計算上の請求とStripeの記録を突き合わせる（状態はディレクトリに保存）
+
+    索引の値は [計算上の金額, 計算上の稼働時間, {Stripe ID: (金額, 稼働時間)}]。
+    """
+
+    def __init__(self, state_dir: str, partitions: int = 256, hours_tolerance: float = 0.01,
+                 spill_batch: int = 512, server_partitions: int = 16):
+        self.state_dir = state_dir
+        self.hours_tolerance = hours_tolerance
+        self.spill_batch = spill_batch  # パーティションごとに溜めてから書き出す件数
+        os.makedirs(state_dir, exist_ok=True)
+        self.meta = self._load_meta() or {
+            'partitions': partitions,
+            'server_partitions': server_partitions,
+            'counts': {},  # パーティション番号 -> {'keys': n, 問題の種類: n}
+            'periods': {},  # 課金期間 -> 記録が入っているパーティション番号
+            'files': {},  # 処理済みの入力ファイル -> [サイズ, 更新時刻]
+            'runs': 0,
+        }
+        # 既存の状態があればその分割数に従う（期間だけで分けていた状態はサーバーでは分けない）
+        self.partitions = self.meta['partitions']
+        self.server_partitions = self.meta.setdefault('server_partitions', 1)
+        self.meta.setdefault('periods', {})
+
+    # ---- 状態ファイル ----
+
+    def _meta_path(self) -> str:
+        return os.path.join(self.state_dir, 'meta.json')
+
+    def _partition_path(self, partition: int) -> str:
+        return os.path.join(self.state_dir, f"part-{partition:04d}.pkl")
+
+    def _spill_dir(self) -> str:
+        return os.path.join(self.state_dir, 'spill')
+
+    def _load_meta(self) -> Optional[Dict]:
+        if not os.path.exists(self._meta_path()):
+            return None
+        with open(self._meta_path(), encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_meta(self):
+        tmp_path = self._meta_path() + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def _load_partition(self, partition: int) -> Dict:
+        path = self._partition_path(partition)
+        if not os.path.exists(path):
+            return {'index': {}, 'issues': []}
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _save_partition(self, partition: int, state: Dict):
+        path = self._partition_path(partition)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    # ---- 1パス目: パーティションへの振り分け ----
+
+    def _spill(self, expected: Iterable[ChargeRecord], actual: Iterable[ChargeRecord]
+               ) -> Tuple[Dict[int, int], Dict[str, int]]:
+        """両側の記録をパーティションごとのファイルに書き出す
+
+        (パーティション番号 -> 件数, 課金期間 -> 先頭のパーティション番号) を返す（期間の記録は先頭から
+        server_partitions 個のパーティションのどれかに入る）。パーティションは
+        partitions x server_partitions 個になりうるので、ファイルは書き出すたびに開いて閉じ、
+        溜めている件数の合計が spill_batch x 256 を超えたら全部書き出す。
+        """
+        spill_dir = self._spill_dir()
+        shutil.rmtree(spill_dir, ignore_errors=True)  # 前回落ちた実行の残り
+        os.makedirs(spill_dir)
+        partitions, server_partitions, batch_size = self.partitions, self.server_partitions, self.spill_batch
+        buffers: Dict[int, List] = {}
+        counts: Dict[int, int] = {}
+        period_parts: Dict[str, int] = {}  # 課金期間 -> 期間側のパーティション番号 x server_partitions
+        max_buffered = batch_size * 256
+        buffered = 0
+
+        def flush(partition: int):
+            with open(os.path.join(spill_dir, f"{partition:05d}.spill"), 'ab') as f:
+                pickle.dump(buffers[partition], f, protocol=pickle.HIGHEST_PROTOCOL)
+            counts[partition] = counts.get(partition, 0) + len(buffers[partition])
+            buffers[partition] = []
+
+        for side, records in ((EXPECTED, expected), (ACTUAL, actual)):
+            for record in records:
+                base = period_parts.get(record[1])
+                if base is None:
+                    base = period_parts[record[1]] = (
+                        zlib.crc32(record[1].encode('utf-8')) % partitions * server_partitions)
+                partition = base + zlib.crc32(record[0].encode('utf-8')) % server_partitions
+                buffer = buffers.get(partition)
+                if buffer is None:
+                    buffer = buffers[partition] = []
+                buffer.append((side, record))
+                buffered += 1
+                if len(buffer) >= batch_size:
+                    buffered -= len(buffer)
+                    flush(partition)
+                elif buffered >= max_buffered:
+                    for other, pending in buffers.items():
+                        if pending:
+                            flush(other)
+                    buffered = 0
+        for partition, buffer in buffers.items():
+            if buffer:
+                flush(partition)
+        return counts, period_parts
+
+    def _read_spill(self, partition: int) -> Iterator[Tuple[int, ChargeRecord]]:
+        with open(os.path.join(self._spill_dir(), f"{partition:05d}.spill"), 'rb') as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+    # ---- 2パス目: パーティションごとの突き合わせ ----
+
+    def _apply(self, index: Dict, records: Iterable[Tuple[int, ChargeRecord]]):
+        """記録を索引に反映（計算側はキー、Stripe側はIDで上書きするので再投入しても結果は同じ）"""
+        for side, (server_name, billing_period, amount, hours, object_id) in records:
+            key = (server_name, billing_period)
+            entry = index.get(key)
+            if entry is None:
+                entry = index[key] = [None, None, None]
+            if side == EXPECTED:
+                entry[0], entry[1] = amount, hours
+            else:
+                if entry[2] is None:
+                    entry[2] = {}
+                entry[2][object_id] = (amount, hours)
+
+    def _classify(self, index: Dict) -> List[Tuple]:
+        """索引全体から問題のあるキーを (種類, server_name, billing_period, 詳細) で返す"""
+        issues = []
+        tolerance = self.hours_tolerance
+        for (server_name, billing_period), (amount, hours, charges) in index.items():
+            if not charges:
+                issues.append(('missing', server_name, billing_period, {'expected_amount': amount}))
+                continue
+            if amount is None and hours is None:
+                issues.append(('unexpected', server_name, billing_period, {'charges': sorted(charges)}))
+                continue
+            if len(charges) > 1:
+                issues.append(('duplicate', server_name, billing_period,
+                               {'charges': sorted(charges), 'expected_amount': amount}))
+            for object_id, (charged, charged_hours) in charges.items():
+                if charged != amount:
+                    issues.append(('amount_mismatch', server_name, billing_period,
+                                   {'charge': object_id, 'expected_amount': amount, 'charged_amount': charged}))
+                elif (hours is not None and charged_hours is not None
+                      and abs(charged_hours - hours) > tolerance):
+                    issues.append(('hours_mismatch', server_name, billing_period,
+                                   {'charge': object_id, 'expected_hours': hours, 'charged_hours': charged_hours}))
+        return issues
+
+    def reconcile(self, expected: Iterable[ChargeRecord], actual: Iterable[ChargeRecord]) -> Dict:
+        """新しい（または変更された）記録を取り込んで突き合わせ、全体の集計を返す
+
+        初回は全件、以降は前回より後に届いた記録だけを渡せばよい。読み直すのは記録が属するパーティションだけ
+        （新しい期間の分だけなら、その期間の server_partitions 個以下）。
+        """
+        started = time.perf_counter()
+        spilled, period_parts = self._spill(expected, actual)
+        for billing_period, base in period_parts.items():
+            known = set(self.meta['periods'].get(billing_period, ()))
+            known.update(partition for partition in range(base, base + self.server_partitions)
+                         if partition in spilled)
+            self.meta['periods'][billing_period] = sorted(known)
+        for partition in sorted(spilled):
+            state = self._load_partition(partition)
+            self._apply(state['index'], self._read_spill(partition))
+            state['issues'] = self._classify(state['index'])
+            self._save_partition(partition, state)
+            counts = {'keys': len(state['index'])}
+            for issue in state['issues']:
+                counts[issue[0]] = counts.get(issue[0], 0) + 1
+            self.meta['counts'][str(partition)] = counts
+        shutil.rmtree(self._spill_dir(), ignore_errors=True)
+        self.meta['runs'] += 1
+        self._save_meta()
+        return {
+            **self.report(),
+            'records': sum(spilled.values()),
+            'partitions_touched': len(spilled),
+            'periods_touched': len(period_parts),
+            'elapsed': time.perf_counter() - started,
+        }
+
+    def reconcile_files(self, expected_paths: Sequence[str], actual_paths: Sequence[str]) -> Dict:
+        """ファイルから突き合わせる（前回から変わっていないファイルは読まない）"""
+        def changed(paths: Sequence[str]) -> List[str]:
+            result = []
+            for path in paths:
+                stat = os.stat(path)
+                if self.meta['files'].get(path) != [stat.st_size, stat.st_mtime]:
+                    result.append(path)
+            return result
+
+        expected_paths, actual_paths = changed(expected_paths), changed(actual_paths)
+        report = self.reconcile((record for path in expected_paths for record in read_records(path)),
+                                (record for path in actual_paths for record in read_records(path)))
+        for path in expected_paths + actual_paths:
+            stat = os.stat(path)
+            self.meta['files'][path] = [stat.st_size, stat.st_mtime]
+        self._save_meta()
+        report['files_read'] = len(expected_paths) + len(actual_paths)
+        return report
+
+    # ---- 結果 ----
+
+    def report(self) -> Dict:
+        """問題の種類ごとの件数（状態ファイルは読まない）"""
+        totals = {issue_type: 0 for issue_type in ISSUE_TYPES}
+        keys = 0
+        for counts in self.meta['counts'].values():
+            keys += counts['keys']
+            for issue_type in ISSUE_TYPES:
+                totals[issue_type] += counts.get(issue_type, 0)
+        return {'success': True, 'keys': keys, 'issues': totals, 'runs': self.meta['runs']}
+
+    def issues(self, issue_types: Optional[Sequence[str]] = None,
+               billing_period: Optional[str] = None) -> Iterator[Dict]:
+        """問題のあるキーを1件ずつ返す（パーティションを1つずつ読むのでメモリは一定）
+
+        billing_period を指定するとその期間のパーティションだけを読む。
+        """
+        candidates = (self.meta['counts'] if billing_period is None
+                      else [str(p) for p in self.meta['periods'].get(billing_period, ())])
+        for partition in sorted(int(p) for p in candidates
+                                if any(self.meta['counts'].get(p, {}).get(t) for t in (issue_types or ISSUE_TYPES))):
+            for issue_type, server_name, period, detail in self._load_partition(partition)['issues']:
+                if billing_period is not None and period != billing_period:
+                    continue
+                if issue_types is None or issue_type in issue_types:
+                    yield {'type': issue_type, 'server_name': server_name, 'billing_period': period,
+                           **detail}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Reconcile computed charges against Stripe records")
+    parser.add_argument('--expected', nargs='+', default=[],
+                        help="computed charges (NDJSON/CSV with server_name, billing_period, amount, uptime_hours)")
+    parser.add_argument('--actual', nargs='+', default=[],
+                        help="Stripe records, e.g. files written by billing_export.py (globs allowed)")
+    parser.add_argument('--state', default='reconciliation_state', help="state directory")
+    parser.add_argument('--partitions', type=int, default=256,
+                        help="billing period hash partitions (only used when the state is created)")
+    parser.add_argument('--server-partitions', type=int, default=16,
+                        help="server name hash partitions within each period (only used when the state is created)")
+    parser.add_argument('--period', help="only print issues of this billing period")
+    parser.add_argument('--issues', type=int, default=20, help="print up to this many issues")
+    args = parser.parse_args()
+
+    def expand(patterns: Sequence[str]) -> List[str]:
+        return sorted(path for pattern in patterns for path in (glob.glob(pattern) or [pattern]))
+
+    reconciler = Reconciler(args.state, args.partitions, server_partitions=args.server_partitions)
+    report = reconciler.reconcile_files(expand(args.expected), expand(args.actual))
+    print(f"🔎 {report['records']:,}件を突き合わせ（{report['files_read']}ファイル、"
+          f"{report['partitions_touched']}パーティション、{report['elapsed']:.1f}s）")
+    print(json.dumps(report['issues'], ensure_ascii=False))
+    for index, issue in enumerate(reconciler.issues(billing_period=args.period)):
+        if index >= args.issues:
+            print("...")
+            break
+        print(f"⚠️ {json.dumps(issue, ensure_ascii=False)}")
+    if not any(report['issues'].values()):
+        print("✅ 計算上の請求とStripeの記録はすべて一致")
@@ -0,0 +1,256 @@
+"""
+# resource_sampler.py
+Resource Sampler
+/proc/uptime・/proc/stat・/proc/meminfo を一定間隔で読み、CPU使用秒数とメモリ使用量を
+事前に確保した固定長のリングバッファ（array）に記録する。使用量に応じた課金
+（CPU秒・GB時間）の元データになる。
+
+サンプリングのコストを小さく保つため、ファイルは開いたままにして os.preadv で使い回しの
+バッファに読み込み、記録先も起動時に確保した配列に上書きしていく（サンプルごとに
+リストや辞書を作らない）。CPU秒とメモリのバイト秒は累積値で持つので、任意の期間の使用量は
+両端の二分探索と引き算だけで求まる。
+
+Linux専用（/proc がない環境では available() が False）。
+"""
+import os
+import threading
+import time
+from array import array
+from bisect import bisect_right
+from typing import Dict, Optional, Tuple
+
+PROC_STAT = '/proc/stat'
+PROC_MEMINFO = '/proc/meminfo'
+PROC_UPTIME = '/proc/uptime'
+GIB = 2 ** 30
+
+
+def available() -> bool:
+    """この環境で /proc から読めるか"""
+    return all(os.path.exists(path) for path in (PROC_STAT, PROC_MEMINFO, PROC_UPTIME))
+
+
+class _ProcFile:
+    """開いたままの /proc ファイルを使い回しのバッファに読む"""
+
+    __slots__ = ('fd', 'buffer', 'view')
+
+    def __init__(self, path: str, size: int):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def read(self) -> int:
+        """先頭から読み直す（読めたバイト数。/proc は毎回先頭から読むと最新の値になる）"""
+        return os.preadv(self.fd, [self.buffer], 0)
+
+    def close(self):
+        self.view.release()
+        os.close(self.fd)
+
+
+class ResourceSampler:
+    """CPU使用秒数・メモリ使用量のリングバッファ（書き込みはサンプラーのスレッドだけ）
+
+    各列は capacity 件の array。i 番目の記録には時刻・OSの稼働秒数・累積CPU使用秒数
+    （全CPUの合計、idle / iowait 以外）・メモリ使用量（MemTotal − MemAvailable）・
+    メモリの累積バイト秒（台形則）が入る。
+    """
+
+    def __init__(self, interval: float = 5.0, capacity: int = 17280, clock=time.time):
+        self.interval = interval
+        self.capacity = capacity  # 既定値は5秒間隔で24時間分
+        self.clock = clock
+        self.ticks_per_second = os.sysconf('SC_CLK_TCK')
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.uptimes = array('d', bytes(8 * capacity))
+        self.cpu_seconds = array('d', bytes(8 * capacity))
+        self.memory_bytes = array('d', bytes(8 * capacity))
+        self.memory_byte_seconds = array('d', bytes(8 * capacity))
+        self._count = 0  # これまでの記録数（capacity を超えたら古いものから上書き）
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._files: Optional[Tuple[_ProcFile, _ProcFile, _ProcFile]] = None
+        self.sampling_cpu_seconds = 0.0  # サンプラー自身が使ったCPU時間（スレッドのCPU時間）
+
+    # ---- サンプリング ----
+
+    def _open(self):
+        if self._files is None:
+            self._files = (_ProcFile(PROC_STAT, 4096), _ProcFile(PROC_MEMINFO, 512), _ProcFile(PROC_UPTIME, 64))
+
+    def _read(self) -> Tuple[float, float, float]:
+        """(OSの稼働秒数, 累積CPU使用秒数, メモリ使用バイト数)"""
+        stat, meminfo, uptime = self._files
+        stat.read()
+        # 先頭行 "cpu  user nice system idle iowait irq softirq steal ..."（単位はクロック刻み）
+        fields = stat.buffer[:stat.buffer.index(b'\n')].split()
+        busy = 0
+        for index in range(1, min(len(fields), 9)):
+            if index != 4 and index != 5:  # idle / iowait
+                busy += int(fields[index])
+
+        meminfo.read()
+        buffer = meminfo.buffer
+        total = int(buffer[buffer.index(b':') + 1:buffer.index(b'kB')])
+        start = buffer.index(b'MemAvailable:') + 13
+        available_kb = int(buffer[start:buffer.index(b'kB', start)])
+
+        length = uptime.read()
+        os_uptime = float(uptime.buffer[:uptime.buffer.index(b' ', 0, length)])
+        return os_uptime, busy / self.ticks_per_second, (total - available_kb) * 1024.0
+
+    def sample(self) -> int:
+        """1件記録する（記録した通し番号）"""
+        self._open()
+        os_uptime, cpu_seconds, memory_bytes = self._read()
+        now = self.clock()
+        with self._lock:
+            count = self._count
+            slot = count % self.capacity
+            if count:
+                previous = (count - 1) % self.capacity
+                elapsed = now - self.timestamps[previous]
+                byte_seconds = (self.memory_byte_seconds[previous]
+                                + (self.memory_bytes[previous] + memory_bytes) * 0.5 * elapsed)
+            else:
+                byte_seconds = 0.0
+            self.timestamps[slot] = now
+            self.uptimes[slot] = os_uptime
+            self.cpu_seconds[slot] = cpu_seconds
+            self.memory_bytes[slot] = memory_bytes
+            self.memory_byte_seconds[slot] = byte_seconds
+            self._count = count + 1
+        return count
+
+    def _run(self):
+        thread_time = time.thread_time
+        while not self._stop.is_set():
+            started = thread_time()
+            self.sample()
+            self.sampling_cpu_seconds += thread_time() - started
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """バックグラウンドのスレッドでサンプリングを始める"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='resource-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def close(self):
+        self.stop()
+        if self._files is not None:
+            for proc_file in self._files:
+                proc_file.close()
+            self._files = None
+
+    # ---- 集計 ----
+
+    def __len__(self) -> int:
+        return min(self._count, self.capacity)
+
+    def _at(self, count: int, oldest: int, when: float, column: array) -> float:
+        """時刻 when での累積値（前後の記録から線形補間。範囲外は端の値）"""
+        capacity = self.capacity
+        timestamps = self.timestamps
+        # 通し番号 oldest..count-1 の時刻は単調増加なので、そのまま二分探索する
+        position = bisect_right(_RingView(timestamps, oldest, count, capacity), when)
+        if position == 0:
+            return column[oldest % capacity]
+        if position == count - oldest:
+            return column[(count - 1) % capacity]
+        left, right = (oldest + position - 1) % capacity, (oldest + position) % capacity
+        span = timestamps[right] - timestamps[left]
+        fraction = (when - timestamps[left]) / span if span > 0 else 1.0
+        return column[left] + (column[right] - column[left]) * fraction
+
+    def usage(self, start: float, end: Optional[float] = None) -> Dict:
+        """期間内のCPU使用秒数とメモリのGB時間（記録のある部分だけ。covered_seconds はその長さ）"""
+        if end is None:
+            end = self.clock()
+        with self._lock:
+            count = self._count
+            if count == 0 or end <= start:
+                return {'cpu_seconds': 0.0, 'gb_hours': 0.0, 'covered_seconds': 0.0, 'samples': 0}
+            oldest = max(0, count - self.capacity)
+            first = self.timestamps[oldest % self.capacity]
+            last = self.timestamps[(count - 1) % self.capacity]
+            start, end = max(start, first), min(end, last)
+            if end <= start:
+                return {'cpu_seconds': 0.0, 'gb_hours': 0.0, 'covered_seconds': 0.0, 'samples': 0}
+            cpu_seconds = self._at(count, oldest, end, self.cpu_seconds) - self._at(count, oldest, start, self.cpu_seconds)
+            byte_seconds = (self._at(count, oldest, end, self.memory_byte_seconds)
+                            - self._at(count, oldest, start, self.memory_byte_seconds))
+            view = _RingView(self.timestamps, oldest, count, self.capacity)
+            samples = bisect_right(view, end) - bisect_right(view, start)
+        return {
+            'cpu_seconds': cpu_seconds,
+            'gb_hours': byte_seconds / GIB / 3600,
+            'covered_seconds': end - start,
+            'samples': samples,
+        }
+
+    def latest(self) -> Optional[Dict]:
+        """直近の記録"""
+        with self._lock:
+            if self._count == 0:
+                return None
+            slot = (self._count - 1) % self.capacity
+            return {
+                'timestamp': self.timestamps[slot],
+                'os_uptime_seconds': self.uptimes[slot],
+                'cpu_seconds': self.cpu_seconds[slot],
+                'memory_bytes': self.memory_bytes[slot],
+            }
+
+    def stats(self) -> Dict:
+        """記録数とサンプラー自身のコスト"""
+        running = self.sampling_cpu_seconds
+        return {
+            'interval': self.interval,
+            'capacity': self.capacity,
+            'samples': self._count,
+            'buffered': len(self),
+            'sampling_cpu_seconds': running,
+            'cpu_per_sample_us': running / self._count * 1e6 if self._count else None,
+        }
+
+
+class _RingView:
+    """リングバッファの通し番号 oldest..count-1 を 0 始まりの列に見せる（bisect 用）"""
+
+    __slots__ = ('column', 'oldest', 'length', 'capacity')
+
+    def __init__(self, column: array, oldest: int, count: int, capacity: int):
+        self.column = column
+        self.oldest = oldest
+        self.length = count - oldest
+        self.capacity = capacity
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> float:
+        return self.column[(self.oldest + index) % self.capacity]
+
+
+def sampler_from_settings(settings) -> Optional[ResourceSampler]:
+    """RESOURCE_BILLING が有効で /proc が読めるときだけサンプラーを作って始める"""
+    if not settings.resource_billing:
+        return None
+    if not available():
+        print("⚠️ /proc が読めないため使用量課金は無効です")
+        return None
+    sampler = ResourceSampler(settings.resource_sample_interval, settings.resource_sample_capacity)
+    sampler.start()
+    return sampler
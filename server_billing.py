@@ -2,44 +2,152 @@
 # server_billing.py
 Server Billing Management System
 This script manages server billing based on uptime and Stripe integration.
+
+stripe / psutil は重いので import 時には読み込まず、必要になった時点で読み込む。
 """
+import asyncio
+import contextvars
 import os
+import ssl
 import time
+import uuid
 import datetime
-import psutil
-import stripe
-from dotenv import load_dotenv
-from typing import Dict, Optional
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Optional, Tuple
 import json
+from job_queue import JobQueue, open_queue
+from metrics import BILLED_AMOUNT, UPTIME_READ_SECONDS, stripe_operation
+from pricing import FlatRate, RateSchedule, ResourceRate, format_minor, load_schedule
+from resource_sampler import ResourceSampler, sampler_from_settings
+from settings import Settings, get_settings
+from shared_state import LeaderLease, SharedBillingState
+from stripe_cache import CACHED_OBJECTS, cache_from_settings
+from stripe_resilience import StripeUnavailableError, caller_from_settings, classify
+from ttl_cache import TTLCache
+from uptime_ledger import UptimeLedger
+
+if TYPE_CHECKING:
+    import stripe
 
-# 環境変数をロード
-load_dotenv('.env')  # .envファイルから環境変数を読み込む
+# 同期版の1回の試行のタイムアウト（秒）。ResilientCaller が全体の期限の残りから決める
+_attempt_timeout: contextvars.ContextVar = contextvars.ContextVar('stripe_attempt_timeout', default=None)
 
 class ServerBillingManager:
-    def __init__(self):
-        """サーバー課金管理クラスの初期化"""
-        # Stripe設定
-        stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-        self.publishable_key = os.getenv('STRIPE_PUBLISHABLE_KEY')
+    def __init__(self, snapshot_resolution: Optional[float] = None,
+                 settings: Optional[Settings] = None):
+        """サーバー課金管理クラスの初期化（設定省略時は環境変数・.env から読む）"""
+        import psutil
+
+        self.settings = settings or get_settings()
+        # Stripe設定（stripe モジュール自体は最初のAPI呼び出しまで読み込まない）
+        self.publishable_key = self.settings.stripe_publishable_key
+        # 接続先API（ローカルのフェイクStripeサーバーを使う場合に指定）
+        self.api_base = self.settings.stripe_api_base
+        self._stripe = None
+        self._raw_client: Optional["stripe.StripeClient"] = None
+        # Stripe呼び出しの期限・再試行・サーキットブレーカー（同期・非同期で共有）
+        self.resilience = caller_from_settings(self.settings)
+        self._job_queue: Optional[JobQueue] = None
         
         # サーバー設定
-        self.server_name = os.getenv('SERVER_NAME', 'Unknown Server')
-        self.hourly_rate = int(os.getenv('HOURLY_RATE', 100))  # 1時間あたりの料金（円）
-        self.currency = os.getenv('CURRENCY', 'jpy')
+        self.server_name = self.settings.server_name
+        self.hourly_rate = self.settings.hourly_rate  # 1時間あたりの料金（円）
+        self.currency = self.settings.currency
+        # 料金表（RATE_SCHEDULE 未指定なら時間単価の定額）。起動時に一度だけ整数テーブルにコンパイルする
+        self.rate_schedule: RateSchedule = (
+            load_schedule(self.settings.rate_schedule, self.currency) if self.settings.rate_schedule
+            else FlatRate(self.hourly_rate, self.currency)
+        )
+        # 使用量課金（RESOURCE_BILLING 有効時のみ）。/proc のサンプラーをバックグラウンドで動かす
+        self.resource_sampler: Optional[ResourceSampler] = sampler_from_settings(self.settings)
+        self.resource_rate: Optional[ResourceRate] = (
+            ResourceRate(self.settings.cpu_hour_rate, self.settings.gb_hour_rate, self.currency)
+            if self.resource_sampler is not None else None
+        )
         
-        # サーバー開始時刻を記録
+        # サーバー開始時刻を記録（起動時刻は変わらないので一度だけ読む）
         self.server_start_time = time.time()
-        self.boot_time = datetime.datetime.fromtimestamp(psutil.boot_time())
+        self.boot_timestamp = psutil.boot_time()
+        self.boot_time = datetime.datetime.fromtimestamp(self.boot_timestamp)
+
+        # ステータス用スナップショットの粒度（秒）。同じ時間枠内は計算結果を使い回す
+        if snapshot_resolution is None:
+            snapshot_resolution = self.settings.snapshot_resolution
+        self.snapshot_resolution = snapshot_resolution
+        self._snapshot: Optional[Dict] = None
+
+        # 稼働時間台帳（UPTIME_LEDGER_PATH 指定時のみ）。再起動をまたいだ任意期間の課金に使う
+        ledger_path = self.settings.uptime_ledger_path
+        self.ledger: Optional[UptimeLedger] = UptimeLedger(ledger_path) if ledger_path else None
+
+        # 複数ワーカー時の共有状態（SHARED_STATE_PATH 指定時のみ）。起動時刻・スナップショット・
+        # 課金済み期間を全ワーカーで共有し、台帳への記録や定期課金はリーダーだけが行う
+        self.shared_state: Optional[SharedBillingState] = None
+        self.leader: Optional[LeaderLease] = None
+        if self.settings.shared_state_path:
+            self.shared_state = SharedBillingState(self.settings.shared_state_path, self.boot_timestamp)
+            self.leader = LeaderLease(self.settings.shared_state_path + '.leader')
+            self.server_start_time = self.shared_state.started_at
+
+        # 決済の重複排除: 冪等キー -> 作成済みの結果（ダブルクリックや再送をStripeに流さない）
+        self.payment_dedupe_window = self.settings.payment_dedupe_window
+        self.payment_cache = TTLCache(
+            maxsize=self.settings.payment_cache_size,
+            ttl=self.payment_dedupe_window,
+        )
+        # 顧客・価格・PaymentIntent・インボイスの読み取りキャッシュ（作成時に入れ、Webhookで捨てる）
+        self.object_cache = cache_from_settings(self.settings)
         
         print(f"🚀 {self.server_name} 課金システム開始")
         print(f"📅 サーバー起動時刻: {self.boot_time}")
         print(f"💰 時間単価: {self.hourly_rate}円/時間")
     
+    @property
+    def stripe(self):
+        """stripe モジュール（初回アクセス時に import してAPIキーと接続先を設定）"""
+        if self._stripe is None:
+            import stripe
+
+            stripe.api_key = self.settings.stripe_secret_key
+            if self.api_base:
+                stripe.api_base = self.api_base
+            # 再試行は ResilientCaller が行うので stripe 自身の再試行は止め、
+            # keep-alive 接続を使い回すセッションと試行ごとのタイムアウトを設定する
+            stripe.max_network_retries = 0
+            stripe.default_http_client = deadline_requests_client_class()(
+                timeout=self.settings.stripe_timeout, session=pooled_requests_session())
+            self._stripe = stripe
+        return self._stripe
+
+    @property
+    def raw_client(self) -> "stripe.StripeClient":
+        """生のAPI応答（dict）を返す raw_request 用のStripeClient（HTTP接続は stripe モジュールと共有）
+
+        一覧の大量取得では応答をStripeObjectに変換するコストが通信より大きいので、こちらを使う。
+        """
+        if self._raw_client is None:
+            stripe = self.stripe
+            base_addresses = {'api': self.api_base} if self.api_base else {}
+            self._raw_client = stripe.StripeClient(
+                self.settings.stripe_secret_key or '',
+                http_client=stripe.default_http_client,
+                base_addresses=base_addresses,
+                max_network_retries=0,  # 再試行は ResilientCaller が行う
+            )
+        return self._raw_client
+
     def get_server_uptime(self) -> Dict:
         """サーバーの稼働時間を取得"""
+        read_start = time.perf_counter()
         current_time = time.time() # 現在のUNIXタイムスタンプを取得
-        uptime_seconds = current_time - psutil.boot_time() # サーバーの起動からの経過時間を秒単位で計算
-        
+        uptime_seconds = current_time - self.boot_timestamp # サーバーの起動からの経過時間を秒単位で計算
+        uptime = self.format_uptime(uptime_seconds)
+        UPTIME_READ_SECONDS.observe(time.perf_counter() - read_start)
+        return uptime
+
+    @staticmethod
+    def format_uptime(uptime_seconds: float) -> Dict:
+        """稼働秒数を時間・分・秒の辞書に変換"""
         # 時間、分、秒に変換
         hours = int(uptime_seconds // 3600)
         minutes = int((uptime_seconds % 3600) // 60)
@@ -53,121 +161,310 @@ class ServerBillingManager:
             'formatted': f"{hours}時間{minutes}分{seconds}秒"
         }
     
-    def calculate_billing_amount(self) -> Dict:
-        """稼働時間に基づく課金額を計算"""
-        uptime = self.get_server_uptime() # 稼働時間を取得
-        
-        # 時間単位での課金（最小単位は分）
-        total_minutes = uptime['uptime_seconds'] / 60
-        billing_hours = total_minutes / 60
-        
-        # 最小課金時間は1分とする
-        if total_minutes < 1:
-            billing_amount = self.hourly_rate / 60  # 1分あたりの料金
+    def try_lead(self) -> bool:
+        """このプロセスが定期処理を担当するか（共有状態なしなら常にTrue）"""
+        if self.leader is None:
+            return True
+        if self.leader.is_leader:
+            return True
+        if not self.leader.try_acquire():
+            return False
+        self.shared_state.set_leader(os.getpid())
+        print(f"👑 ワーカー {os.getpid()} がリーダーになりました")
+        return True
+
+    def record_heartbeat(self) -> Optional[float]:
+        """稼働中であることを台帳に記録（台帳未設定なら何もしない）"""
+        if self.ledger is None:
+            return None
+        return self.ledger.append_heartbeat(time.time(), self.boot_timestamp)
+
+    def resolve_period(self, period_start: Optional[float] = None,
+                       period_end: Optional[float] = None) -> Tuple[float, float]:
+        """課金期間を確定（開始省略時は台帳の先頭、終了省略時は現在時刻）"""
+        if period_start is None:
+            period_start = self.ledger.first_timestamp() if self.ledger is not None else None
+            if period_start is None:
+                period_start = self.boot_timestamp
+        if period_end is None:
+            period_end = time.time()
+        return period_start, period_end
+
+    def get_period_uptime(self, period_start: Optional[float] = None,
+                          period_end: Optional[float] = None) -> Dict:
+        """台帳から任意期間の稼働時間を取得"""
+        if self.ledger is None:
+            raise ValueError("UPTIME_LEDGER_PATH is not configured; period billing needs the uptime ledger")
+        period_start, period_end = self.resolve_period(period_start, period_end)
+        return self.format_uptime(self.ledger.billable_seconds(period_start, period_end))
+
+    def billing_period_label(self, period_start: Optional[float] = None,
+                             period_end: Optional[float] = None,
+                             billed_until: Optional[float] = None) -> str:
+        """インボイスのメタデータ用の課金期間文字列（期間省略時は起動から billed_until まで）"""
+        if period_start is None and period_end is None:
+            until = datetime.datetime.now() if billed_until is None else datetime.datetime.fromtimestamp(billed_until)
+            return f"{self.boot_time} - {until}"
+        period_start, period_end = self.resolve_period(period_start, period_end)
+        return f"{datetime.datetime.fromtimestamp(period_start)} - {datetime.datetime.fromtimestamp(period_end)}"
+
+    def calculate_billing_amount(self, uptime: Optional[Dict] = None,
+                                 period_start: Optional[float] = None,
+                                 period_end: Optional[float] = None,
+                                 billed_until: Optional[float] = None) -> Dict:
+        """稼働時間に基づく課金額を計算（期間指定時は稼働時間台帳から求める）
+
+        金額は料金表で通貨の最小単位の整数として計算する（最小課金時間は1分）。
+        期間指定で台帳に稼働が1秒もない場合は 0 になる。billed_until を渡すと
+        現在時刻ではなくその時刻までの稼働で計算する（同じ冪等キーの再送で金額を変えないため）。
+        """
+        coverage = None
+        if uptime is None:
+            if period_start is not None or period_end is not None:
+                start, end = self.resolve_period(period_start, period_end)
+                uptime = self.get_period_uptime(start, end)
+                coverage = self.ledger.billable_seconds  # 時間帯別料金で停止中の時間を除くため
+            elif billed_until is not None:
+                uptime = self.format_uptime(max(0.0, billed_until - self.boot_timestamp))
+                start, end = self.boot_timestamp, max(billed_until, self.boot_timestamp)
+            else:
+                uptime = self.get_server_uptime() # 稼働時間を取得
+                start, end = self.boot_timestamp, None
         else:
-            billing_amount = billing_hours * self.hourly_rate
-        
-        # 円単位に丸める
-        billing_amount = round(billing_amount)
+            # 稼働時間だけ渡された場合は現在までの連続稼働とみなす
+            start, end = time.time() - uptime['uptime_seconds'], None
+
+        billing_hours = uptime['uptime_seconds'] / 3600
+        if coverage is not None and uptime['uptime_seconds'] <= 0:
+            billing_amount = 0  # 期間内に稼働がなければ最小課金時間も適用しない
+        else:
+            billing_amount = self.rate_schedule.price(uptime['uptime_seconds'], start, end, coverage)
         
-        return {
+        billing_info = {
             'uptime': uptime,
             'billing_hours': round(billing_hours, 2),
             'billing_amount': billing_amount,
             'currency': self.currency
         }
+        if self.resource_sampler is not None:
+            # 使用量分を上乗せ（サンプラーの記録がある部分だけ。記録より前の期間は稼働時間のみ）
+            usage = self.resource_sampler.usage(start, end)
+            resource_amount = self.resource_rate.price(usage['cpu_seconds'], usage['gb_hours'])
+            billing_info['uptime_amount'] = billing_amount
+            billing_info['resource_amount'] = resource_amount
+            billing_info['billing_amount'] = billing_amount + resource_amount
+            billing_info['usage'] = {
+                'cpu_seconds': round(usage['cpu_seconds'], 3),
+                'gb_hours': round(usage['gb_hours'], 6),
+                'covered_seconds': round(usage['covered_seconds'], 3),
+            }
+        return billing_info
     
-    def create_payment_intent(self, customer_email: Optional[str] = None) -> Dict:
-        """Stripe Payment Intentを作成"""
+    def resolve_idempotency_key(self, kind: str, idempotency_key: Optional[str] = None,
+                                session_id: Optional[str] = None,
+                                now: Optional[float] = None) -> Optional[str]:
+        """冪等キーを確定（指定がなければセッションID + 課金ウィンドウから導出）"""
+        if idempotency_key is not None:
+            return f"{kind}:{idempotency_key}"
+        if session_id is not None:
+            window = int((time.time() if now is None else now) // self.payment_dedupe_window)
+            return f"{kind}:{session_id}:{window}"
+        return None
+
+    def resolve_billed_until(self, idempotency_key: Optional[str],
+                             billed_until: Optional[float] = None,
+                             now: Optional[float] = None) -> float:
+        """決済で請求する稼働の終わりの時刻を確定
+
+        冪等キーがある場合、Stripeは同じキーで本文の違うリクエストを 400 で拒否するので、
+        金額とメタデータは重複排除ウィンドウの開始時刻までの稼働で決める（同じウィンドウ内の
+        再送は別のワーカーや再起動後でも同じ内容になる）。キーがなければ現在時刻まで。
+        """
+        if billed_until is not None:
+            return billed_until
+        now = time.time() if now is None else now
+        if idempotency_key is None:
+            return now
+        return now - now % self.payment_dedupe_window
+
+    def _payment_metadata(self, billing_info: Dict, billed_until: float) -> Dict:
+        """PaymentIntent のメタデータ（billed_until で決まるので再送でも同じ）"""
+        return {
+            'server_name': self.server_name,
+            'uptime_hours': billing_info['billing_hours'],
+            'uptime_formatted': billing_info['uptime']['formatted'],
+            'start_time': str(self.boot_time),
+            'billing_date': str(datetime.datetime.fromtimestamp(billed_until)),
+            'billing_period': self.billing_period_label(billed_until=billed_until),
+        }
+
+    def _call_stripe(self, operation: str, method, **params):
+        """Stripe API呼び出し（期限・再試行・ブレーカー付き。試行ごとにメトリクスを記録）
+
+        冪等キーがなければ呼び出しごとに1つ作り、再試行でも同じキーを送るので作成は1回になる。
+        """
+        if params.get('idempotency_key') is None:
+            params['idempotency_key'] = f"{operation}:{uuid.uuid4().hex}"
+        metrics = stripe_operation(operation)
+
+        def attempt(timeout: float):
+            start = metrics.begin()
+            error = None
+            token = _attempt_timeout.set(timeout)
+            try:
+                return method(**params)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _attempt_timeout.reset(token)
+                metrics.end(start, error)
+
+        return self.resilience.call(operation, attempt)
+
+    @staticmethod
+    def _failure(error: Exception, **extra) -> Dict:
+        """失敗時の結果（Stripeを呼ばずに断った場合は retry_after 秒後の再試行を促す）
+
+        retryable は後で同じ操作をやり直せば成功しうるか（4xx の入力エラーなどは False）。
+        """
+        result = {'success': False, 'error': str(error), **extra}
+        if isinstance(error, StripeUnavailableError):
+            result['retry_after'] = error.retry_after
+            result['retryable'] = True
+        else:
+            result['retryable'] = classify(error)[0]
+        return result
+
+    def _record_billed(self, kind: str, amount: int):
+        """Stripeで請求が作成できた金額を集計"""
+        BILLED_AMOUNT.labels(kind, self.currency).inc(amount)
+
+    def create_payment_intent(self, customer_email: Optional[str] = None,
+                              idempotency_key: Optional[str] = None,
+                              session_id: Optional[str] = None,
+                              billed_until: Optional[float] = None) -> Dict:
+        """Stripe Payment Intentを作成
+
+        idempotency_key（または session_id から導出したキー）が同じ呼び出しは、
+        重複排除ウィンドウ内ならStripeを呼ばずに前回作成した結果を返す。
+        キャッシュにない再送（別のワーカー・再起動後）でもStripeへ送る内容は同じになる。
+        """
+        now = time.time()
+        idempotency_key = self.resolve_idempotency_key('payment_intent', idempotency_key, session_id, now)
+        cached = self.payment_cache.get(idempotency_key) if idempotency_key else None
+        if cached is not None:
+            return cached
+
+        billed_until = self.resolve_billed_until(idempotency_key, billed_until, now)
+        billing_info = self.calculate_billing_amount(billed_until=billed_until)
         try:
-            billing_info = self.calculate_billing_amount()
-            
             # Payment Intent作成
-            intent = stripe.PaymentIntent.create(
+            intent = self._call_stripe(
+                'payment_intent.create', self.stripe.PaymentIntent.create,
                 amount=billing_info['billing_amount'],
                 currency=self.currency,
-                metadata={
-                    'server_name': self.server_name,
-                    'uptime_hours': billing_info['billing_hours'],
-                    'uptime_formatted': billing_info['uptime']['formatted'],
-                    'start_time': str(self.boot_time),
-                    'billing_date': str(datetime.datetime.now())
-                }
+                idempotency_key=idempotency_key,
+                metadata=self._payment_metadata(billing_info, billed_until)
             )
             
-            return {
+            result = {
                 'success': True,
                 'payment_intent': intent,
                 'billing_info': billing_info,
                 'client_secret': intent.client_secret
             }
+            self._record_billed('payment_intent', billing_info['billing_amount'])
+            self.object_cache.put('payment_intent', intent.to_dict())
+            if idempotency_key:
+                self.payment_cache.set(idempotency_key, result)
+            return result
             
         except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
-                'billing_info': self.calculate_billing_amount()
-            }
+            return self._failure(e, billing_info=billing_info)
     
-    def create_test_payment(self) -> Dict:
-        """テスト用の決済を実行（サーバーサイドで完結）"""
+    def create_test_payment(self, idempotency_key: Optional[str] = None,
+                            session_id: Optional[str] = None,
+                            billed_until: Optional[float] = None) -> Dict:
+        """テスト用の決済を実行（サーバーサイドで完結・重複排除は create_payment_intent と同じ）"""
+        now = time.time()
+        idempotency_key = self.resolve_idempotency_key('test_payment', idempotency_key, session_id, now)
+        cached = self.payment_cache.get(idempotency_key) if idempotency_key else None
+        if cached is not None:
+            return cached
+
+        billed_until = self.resolve_billed_until(idempotency_key, billed_until, now)
+        billing_info = self.calculate_billing_amount(billed_until=billed_until)
         try:
-            billing_info = self.calculate_billing_amount()
-            
             # テスト用のPayment Intentを作成
-            intent = stripe.PaymentIntent.create(
+            intent = self._call_stripe(
+                'payment_intent.create', self.stripe.PaymentIntent.create,
                 amount=billing_info['billing_amount'],
                 currency=self.currency,
                 confirm=True,
+                idempotency_key=idempotency_key,
                 payment_method='pm_card_visa',  # Stripeのテスト用PaymentMethod
-                metadata={
-                    'server_name': self.server_name,
-                    'uptime_hours': billing_info['billing_hours'],
-                    'uptime_formatted': billing_info['uptime']['formatted'],
-                    'start_time': str(self.boot_time),
-                    'billing_date': str(datetime.datetime.now()),
-                    'test_payment': 'true'
-                }
+                metadata={**self._payment_metadata(billing_info, billed_until), 'test_payment': 'true'}
             )
             
-            return {
+            result = {
                 'success': True,
                 'payment_intent': intent,
                 'billing_info': billing_info,
                 'payment_id': intent.id,
                 'status': intent.status
             }
+            self._record_billed('test_payment', billing_info['billing_amount'])
+            self.object_cache.put('payment_intent', intent.to_dict())
+            if idempotency_key:
+                self.payment_cache.set(idempotency_key, result)
+            return result
             
         except Exception as e:
-            return {
-                'success': False,
-                'error': str(e),
-                'billing_info': self.calculate_billing_amount()
-            }
+            return self._failure(e, billing_info=billing_info)
     
-    def create_invoice(self, customer_id: str) -> Dict:
-        """定期請求用のインボイスを作成"""
+    def create_invoice(self, customer_id: str, period_start: Optional[float] = None,
+                       period_end: Optional[float] = None,
+                       idempotency_key: Optional[str] = None,
+                       billed_until: Optional[float] = None) -> Dict:
+        """定期請求用のインボイスを作成（期間指定時は稼働時間台帳からその期間を請求）
+
+        idempotency_key を渡すと InvoiceItem / Invoice それぞれに派生キーを付けて送るので、
+        同じキーでの再実行は重複作成にならない。再実行で金額が変わらないよう、キーを使う
+        呼び出し側は期間（期間を省略するなら billed_until）を確定した値で渡すこと。
+        """
         try:
-            billing_info = self.calculate_billing_amount()
-            
+            billing_info = self.calculate_billing_amount(period_start=period_start, period_end=period_end,
+                                                         billed_until=billed_until)
+            if billing_info['billing_amount'] <= 0:
+                # 稼働のない期間に 0 円のインボイスは作らない（やり直しても変わらないので再試行しない）
+                return self._failure(ValueError("no billable uptime in the billing period"),
+                                     billing_info=billing_info)
+
             # インボイスアイテムを作成
-            invoice_item = stripe.InvoiceItem.create(
+            invoice_item = self._call_stripe(
+                'invoice_item.create', self.stripe.InvoiceItem.create,
                 customer=customer_id,
                 amount=billing_info['billing_amount'],
                 currency=self.currency,
-                description=f"{self.server_name} サーバー利用料金 ({billing_info['uptime']['formatted']})"
+                description=f"{self.server_name} サーバー利用料金 ({billing_info['uptime']['formatted']})",
+                idempotency_key=f"{idempotency_key}:item" if idempotency_key else None
             )
             
             # インボイスを作成
-            invoice = stripe.Invoice.create(
+            invoice = self._call_stripe(
+                'invoice.create', self.stripe.Invoice.create,
                 customer=customer_id,
+                idempotency_key=f"{idempotency_key}:invoice" if idempotency_key else None,
                 metadata={
                     'server_name': self.server_name,
                     'uptime_hours': billing_info['billing_hours'],
-                    'billing_period': f"{self.boot_time} - {datetime.datetime.now()}"
+                    'billing_period': self.billing_period_label(period_start, period_end, billed_until)
                 }
             )
             
+            self._record_billed('invoice', billing_info['billing_amount'])
+            self.object_cache.put('invoice', invoice.to_dict())
             return {
                 'success': True,
                 'invoice': invoice,
@@ -176,24 +473,148 @@ class ServerBillingManager:
             }
             
         except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+            return self._failure(e)
     
+    def _read_stripe(self, operation: str, method, *args, **params):
+        """読み取りのStripe API呼び出し（冪等キーは付けない。期限・再試行・ブレーカーは書き込みと共通）"""
+        metrics = stripe_operation(operation)
+
+        def attempt(timeout: float):
+            start = metrics.begin()
+            error = None
+            token = _attempt_timeout.set(timeout)
+            try:
+                return method(*args, **params)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _attempt_timeout.reset(token)
+                metrics.end(start, error)
+
+        return self.resilience.call(operation, attempt)
+
+    def _retrieve(self, kind: str, object_id: str) -> Dict:
+        """Stripeから1件取得"""
+        method = getattr(self.stripe, CACHED_OBJECTS[kind][0]).retrieve
+        return self._read_stripe(f"{kind}.retrieve", method, object_id).to_dict()
+
+    @staticmethod
+    def _object_result(kind: str, object_id: str, obj: Optional[Dict]) -> Dict:
+        if obj is None:
+            return {'success': False, 'error': f"No such {kind}: '{object_id}'", 'not_found': True}
+        return {'success': True, kind: obj}
+
+    @staticmethod
+    def _payment_status(result: Dict) -> Dict:
+        if not result['success']:
+            return result
+        intent = result['payment_intent']
+        return {
+            'success': True,
+            'payment_intent_id': intent['id'],
+            'status': intent['status'],
+            'amount': intent['amount'],
+            'currency': intent['currency'],
+        }
+
+    def get_stripe_object(self, kind: str, object_id: str) -> Dict:
+        """顧客・価格・PaymentIntent・インボイスを取得（読み取りキャッシュになければStripeから取る）"""
+        try:
+            obj = self.object_cache.get(kind, object_id, lambda oid: self._retrieve(kind, oid))
+        except Exception as e:
+            return self._failure(e)
+        return self._object_result(kind, object_id, obj)
+
+    def get_payment_status(self, payment_intent_id: str) -> Dict:
+        """決済の状態（画面表示用。キャッシュの有効期限内かWebhookで変更を知るまではStripeを呼ばない）"""
+        return self._payment_status(self.get_stripe_object('payment_intent', payment_intent_id))
+
+    @property
+    def job_queue(self) -> JobQueue:
+        """インボイス・テスト決済のジョブキュー（初回アクセス時に開く）"""
+        if self._job_queue is None:
+            self._job_queue = open_queue(self.settings.job_queue_path, self.settings.job_queue_durable)
+        return self._job_queue
+
+    def enqueue_invoice(self, customer_id: str, period_start: Optional[float] = None,
+                        period_end: Optional[float] = None,
+                        idempotency_key: Optional[str] = None) -> Dict:
+        """インボイス作成をキューに積んでジョブIDを返す（Stripeは呼ばない）
+
+        再試行やリース切れの再実行で金額が変わらないよう、請求する期間はここで確定して積む
+        （期間を省略した場合は起動から今までの稼働を billed_until として固定する）。
+        """
+        params = {'customer_id': customer_id}
+        if period_start is None and period_end is None:
+            params['billed_until'] = time.time()
+        else:
+            params['period_start'], params['period_end'] = self.resolve_period(period_start, period_end)
+        job = self.job_queue.enqueue('invoice', params,
+                                     f"invoice:{idempotency_key}" if idempotency_key else None)
+        return {'success': True, **job}
+
+    def enqueue_test_payment(self, idempotency_key: Optional[str] = None) -> Dict:
+        """テスト決済をキューに積んでジョブIDを返す（Stripeは呼ばない。金額は積んだ時点までの稼働で固定）"""
+        job = self.job_queue.enqueue('test_payment', {'billed_until': time.time()},
+                                     f"test_payment:{idempotency_key}" if idempotency_key else None)
+        return {'success': True, **job}
+
     def get_billing_summary(self) -> Dict:
-        """課金サマリーを取得"""
+        """課金サマリーを取得（スナップショットの時間枠内はキャッシュを返す）"""
+        return self.get_billing_snapshot()['summary']
+
+    def get_billing_snapshot(self) -> Dict:
+        """時間枠ごとに量子化した課金スナップショットを取得
+
+        snapshot_resolution 秒の枠内では稼働時間・課金額・サマリーとそのJSONを一度だけ計算し、
+        ステータス系エンドポイントからの問い合わせにはそれを使い回す。
+        """
+        now = time.time()
+        bucket = int(now // self.snapshot_resolution) if self.snapshot_resolution > 0 else now
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot['bucket'] == bucket:
+            return snapshot
+
+        if self.shared_state is not None:
+            # 時間枠ごとに1ワーカーだけが計算し、他のワーカーは同じバイト列をそのまま返す
+            snapshot = self.shared_state.get_or_publish_snapshot(
+                bucket, lambda: self._build_snapshot(now, bucket))
+        else:
+            snapshot = self._build_snapshot(now, bucket)
+        self._snapshot = snapshot
+        return snapshot
+
+    def _build_snapshot(self, now: float, bucket: float) -> Dict:
         billing_info = self.calculate_billing_amount()
-        
-        return {
+        summary = {
             'server_name': self.server_name,
             'boot_time': str(self.boot_time),
-            'current_time': str(datetime.datetime.now()),
+            'current_time': str(datetime.datetime.fromtimestamp(now)),
             'uptime': billing_info['uptime']['formatted'],
             'hourly_rate': self.hourly_rate,
+            'rate_schedule': self.rate_schedule.describe(),
             'total_amount': billing_info['billing_amount'],
             'currency': self.currency
         }
+        if 'usage' in billing_info:
+            summary['resource_rate'] = self.resource_rate.describe()
+            summary['resource_amount'] = billing_info['resource_amount']
+            summary['usage'] = billing_info['usage']
+        snapshot = {
+            'bucket': bucket,
+            'expires_at': (bucket + 1) * self.snapshot_resolution if self.snapshot_resolution > 0 else now,
+            'etag': f'"{int(self.boot_timestamp)}-{bucket}"',
+            'billing_info': billing_info,
+            'summary': summary,
+            'summary_json': json.dumps(summary, ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+            'uptime_json': json.dumps(billing_info['uptime'], ensure_ascii=False, separators=(',', ':')).encode('utf-8'),
+        }
+        return snapshot
+
+    def invalidate_snapshot(self):
+        """キャッシュ済みスナップショットを破棄（設定変更・決済完了後などに呼ぶ）"""
+        self._snapshot = None
     
     def print_billing_status(self):
         """現在の課金状況を表示"""
@@ -204,12 +625,340 @@ class ServerBillingManager:
         print("="*50)
         print(f"🕐 起動時刻: {summary['boot_time']}")
         print(f"⏱️  稼働時間: {summary['uptime']}")
-        print(f"💰 時間単価: {summary['hourly_rate']}円/時間")
-        print(f"💸 現在の課金額: {summary['total_amount']}円")
+        currency = summary['currency'].upper()
+        print(f"💰 時間単価: {summary['hourly_rate']} {currency}/時間")
+        print(f"💸 現在の課金額: {format_minor(summary['total_amount'], summary['currency'])} {currency}")
         print("="*50)
 
+
+def pooled_requests_session(pool_size: int = 20):
+    """同期版のStripe呼び出し用に keep-alive 接続をプールする requests セッション"""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+@lru_cache(maxsize=None)
+def deadline_requests_client_class():
+    """DeadlineRequestsClient クラスを返す（基底クラスが stripe にあるので初回呼び出し時に定義）"""
+    import stripe
+
+    class DeadlineRequestsClient(stripe.RequestsClient):
+        """試行ごとのタイムアウト（_attempt_timeout）で送る RequestsClient
+
+        固定の timeout のままだと、最後の再試行が操作全体の期限を timeout 秒まで超えうる。
+        """
+
+        @property
+        def _timeout(self):
+            timeout = _attempt_timeout.get()
+            return timeout if timeout is not None else self._default_timeout
+
+        @_timeout.setter
+        def _timeout(self, value):
+            self._default_timeout = value
+
+    return DeadlineRequestsClient
+
+
+@lru_cache(maxsize=None)
+def pooled_httpx_client_class():
+    """PooledHTTPXClient クラスを返す（基底クラスが stripe にあるので初回呼び出し時に定義）"""
+    import stripe
+
+    class PooledHTTPXClient(stripe.HTTPXClient):
+        """同時接続数の上限付きでkeep-alive接続を使い回すStripe用httpxクライアント"""
+
+        def __init__(self, max_connections: int = 20, **kwargs):
+            super().__init__(**kwargs)
+            verify = (
+                ssl.create_default_context(cafile=stripe.ca_bundle_path)
+                if self._verify_ssl_certs else False
+            )
+            self._client_async = self.httpx.AsyncClient(
+                verify=verify,
+                limits=self.httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+            )
+
+    return PooledHTTPXClient
+
+
+class AsyncServerBillingManager(ServerBillingManager):
+    """イベントループをブロックしない非同期版の課金管理クラス
+
+    Stripe呼び出しはコネクションプール付きのhttpxクライアント経由で行い、
+    課金計算などの同期処理は ServerBillingManager のものをそのまま使う。
+    """
+
+    def __init__(self, max_connections: int = 20, timeout: Optional[float] = None,
+                 snapshot_resolution: Optional[float] = None,
+                 settings: Optional[Settings] = None):
+        super().__init__(snapshot_resolution=snapshot_resolution, settings=settings)
+        self.max_connections = max_connections
+        self.timeout = timeout if timeout is not None else self.settings.stripe_timeout  # 1回の試行のタイムアウト
+        self._http_client = None  # PooledHTTPXClient
+        self._client: Optional["stripe.StripeClient"] = None
+        self._inflight: Dict[str, asyncio.Future] = {}  # 冪等キー -> 実行中のStripe呼び出し
+
+    @property
+    def client(self) -> "stripe.StripeClient":
+        """プール済みHTTPクライアントを持つStripeClientを取得（初回呼び出し時に生成）"""
+        if self._client is None:
+            self._http_client = pooled_httpx_client_class()(
+                max_connections=self.max_connections,
+                timeout=self.timeout,
+            )
+            base_addresses = {'api': self.api_base} if self.api_base else {}
+            self._client = self.stripe.StripeClient(
+                self.settings.stripe_secret_key or '',
+                http_client=self._http_client,
+                base_addresses=base_addresses,
+                max_network_retries=0,  # 再試行は ResilientCaller が行う
+            )
+        return self._client
+
+    def warm_up(self):
+        """stripe の import・クライアント生成・APIリソースの読み込みを先に済ませる（スレッドから呼んでよい）"""
+        v1 = self.client.v1
+        v1.payment_intents, v1.invoice_items, v1.invoices, v1.customers, v1.prices
+
+    async def aclose(self):
+        """HTTPコネクションプールを閉じる"""
+        if self._http_client is not None:
+            await self._http_client.close_async()
+            self._http_client = None
+            self._client = None
+
+    async def _deduplicated(self, idempotency_key: Optional[str], create, *args) -> Dict:
+        """キャッシュ済みならその結果を、同じキーの呼び出しが実行中ならその完了を待って結果を共有する"""
+        if idempotency_key is None:
+            return await create(*args)
+
+        cached = self.payment_cache.get(idempotency_key)
+        if cached is not None:
+            return cached
+
+        task = self._inflight.get(idempotency_key)
+        if task is None:
+            task = asyncio.ensure_future(create(*args))
+            self._inflight[idempotency_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(idempotency_key, None))
+        # 待っている側がキャンセルされても共有中の呼び出しは止めない
+        return await asyncio.shield(task)
+
+    async def _call_stripe_async(self, operation: str, method, params: Dict,
+                                 idempotency_key: Optional[str] = None):
+        """非同期のStripe API呼び出し（期限・再試行・ヘッジ・ブレーカーは同期版と共有の ResilientCaller）"""
+        options = {'idempotency_key': idempotency_key or f"{operation}:{uuid.uuid4().hex}"}
+        metrics = stripe_operation(operation)
+
+        async def attempt(timeout: float):
+            start = metrics.begin()
+            error = None
+            try:
+                return await method(params=params, options=options)
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.end(start, error)
+
+        return await self.resilience.call_async(operation, attempt)
+
+    async def create_payment_intent(self, customer_email: Optional[str] = None,
+                                    idempotency_key: Optional[str] = None,
+                                    session_id: Optional[str] = None,
+                                    billed_until: Optional[float] = None) -> Dict:
+        """Stripe Payment Intentを作成（非同期・同時に来た重複リクエストは1回の呼び出しを共有）"""
+        now = time.time()
+        idempotency_key = self.resolve_idempotency_key('payment_intent', idempotency_key, session_id, now)
+        billed_until = self.resolve_billed_until(idempotency_key, billed_until, now)
+        return await self._deduplicated(idempotency_key, self._create_payment_intent,
+                                        customer_email, idempotency_key, billed_until)
+
+    async def _create_payment_intent(self, customer_email: Optional[str],
+                                     idempotency_key: Optional[str], billed_until: float) -> Dict:
+        billing_info = self.calculate_billing_amount(billed_until=billed_until)
+        try:
+            intent = await self._call_stripe_async(
+                'payment_intent.create', self.client.v1.payment_intents.create_async, {
+                'amount': billing_info['billing_amount'],
+                'currency': self.currency,
+                'metadata': self._payment_metadata(billing_info, billed_until)
+            }, idempotency_key)
+
+            result = {
+                'success': True,
+                'payment_intent': intent.to_dict(),
+                'billing_info': billing_info,
+                'client_secret': intent.client_secret
+            }
+            self._record_billed('payment_intent', billing_info['billing_amount'])
+            self.object_cache.put('payment_intent', result['payment_intent'])
+            if idempotency_key:
+                self.payment_cache.set(idempotency_key, result)
+            return result
+
+        except Exception as e:
+            return self._failure(e, billing_info=billing_info)
+
+    async def create_test_payment(self, idempotency_key: Optional[str] = None,
+                                  session_id: Optional[str] = None,
+                                  billed_until: Optional[float] = None) -> Dict:
+        """テスト用の決済を実行（非同期・サーバーサイドで完結）"""
+        now = time.time()
+        idempotency_key = self.resolve_idempotency_key('test_payment', idempotency_key, session_id, now)
+        billed_until = self.resolve_billed_until(idempotency_key, billed_until, now)
+        return await self._deduplicated(idempotency_key, self._create_test_payment, idempotency_key, billed_until)
+
+    async def _create_test_payment(self, idempotency_key: Optional[str], billed_until: float) -> Dict:
+        billing_info = self.calculate_billing_amount(billed_until=billed_until)
+        try:
+            intent = await self._call_stripe_async(
+                'payment_intent.create', self.client.v1.payment_intents.create_async, {
+                'amount': billing_info['billing_amount'],
+                'currency': self.currency,
+                'confirm': True,
+                'payment_method': 'pm_card_visa',  # Stripeのテスト用PaymentMethod
+                'metadata': {**self._payment_metadata(billing_info, billed_until), 'test_payment': 'true'}
+            }, idempotency_key)
+
+            result = {
+                'success': True,
+                'payment_intent': intent.to_dict(),
+                'billing_info': billing_info,
+                'payment_id': intent.id,
+                'status': intent.status
+            }
+            self._record_billed('test_payment', billing_info['billing_amount'])
+            self.object_cache.put('payment_intent', result['payment_intent'])
+            if idempotency_key:
+                self.payment_cache.set(idempotency_key, result)
+            return result
+
+        except Exception as e:
+            return self._failure(e, billing_info=billing_info)
+
+    async def create_invoice(self, customer_id: str, period_start: Optional[float] = None,
+                             period_end: Optional[float] = None,
+                             idempotency_key: Optional[str] = None,
+                             billed_until: Optional[float] = None) -> Dict:
+        """定期請求用のインボイスを作成（非同期・期間指定と billed_until は同期版と同じ）"""
+        try:
+            billing_info = self.calculate_billing_amount(period_start=period_start, period_end=period_end,
+                                                         billed_until=billed_until)
+            if billing_info['billing_amount'] <= 0:
+                # 稼働のない期間に 0 円のインボイスは作らない（やり直しても変わらないので再試行しない）
+                return self._failure(ValueError("no billable uptime in the billing period"),
+                                     billing_info=billing_info)
+
+            # インボイスアイテムを作成
+            invoice_item = await self._call_stripe_async(
+                'invoice_item.create', self.client.v1.invoice_items.create_async, {
+                'customer': customer_id,
+                'amount': billing_info['billing_amount'],
+                'currency': self.currency,
+                'description': f"{self.server_name} サーバー利用料金 ({billing_info['uptime']['formatted']})"
+            }, f"{idempotency_key}:item" if idempotency_key else None)
+
+            # インボイスを作成
+            invoice = await self._call_stripe_async(
+                'invoice.create', self.client.v1.invoices.create_async, {
+                'customer': customer_id,
+                'metadata': {
+                    'server_name': self.server_name,
+                    'uptime_hours': billing_info['billing_hours'],
+                    'billing_period': self.billing_period_label(period_start, period_end, billed_until)
+                }
+            }, f"{idempotency_key}:invoice" if idempotency_key else None)
+
+            self._record_billed('invoice', billing_info['billing_amount'])
+            result = {
+                'success': True,
+                'invoice': invoice.to_dict(),
+                'invoice_item': invoice_item.to_dict(),
+                'billing_info': billing_info
+            }
+            self.object_cache.put('invoice', result['invoice'])
+            return result
+
+        except Exception as e:
+            return self._failure(e)
+
+    async def _retrieve_async(self, kind: str, object_id: str) -> Dict:
+        """Stripeから1件取得（非同期・読み取りなので冪等キーは付けない）"""
+        operation = f"{kind}.retrieve"
+        method = getattr(self.client.v1, CACHED_OBJECTS[kind][1]).retrieve_async
+        metrics = stripe_operation(operation)
+
+        async def attempt(timeout: float):
+            start = metrics.begin()
+            error = None
+            try:
+                return (await method(object_id)).to_dict()
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                metrics.end(start, error)
+
+        return await self.resilience.call_async(operation, attempt)
+
+    async def get_stripe_object(self, kind: str, object_id: str) -> Dict:
+        """顧客・価格・PaymentIntent・インボイスを取得（非同期・同じIDの同時取得は1回の呼び出しを共有）"""
+        try:
+            obj = await self.object_cache.get_async(kind, object_id,
+                                                    lambda oid: self._retrieve_async(kind, oid))
+        except Exception as e:
+            return self._failure(e)
+        return self._object_result(kind, object_id, obj)
+
+    async def get_payment_status(self, payment_intent_id: str) -> Dict:
+        """決済の状態（非同期）"""
+        return self._payment_status(await self.get_stripe_object('payment_intent', payment_intent_id))
+
+    async def create_meter_event(self, customer_id: str, event_name: str, value: int,
+                                 identifier: str, timestamp: Optional[int] = None) -> Dict:
+        """従量課金のメーターイベントを送信（identifier を冪等キーにも使うので再送しても二重計上されない）"""
+        try:
+            event = await self._call_stripe_async(
+                'meter_event.create', self.client.v1.billing.meter_events.create_async, {
+                'event_name': event_name,
+                'identifier': identifier,
+                'timestamp': int(timestamp if timestamp is not None else time.time()),
+                'payload': {
+                    'stripe_customer_id': customer_id,
+                    'value': str(value),
+                }
+            }, identifier)
+
+            return {
+                'success': True,
+                'meter_event': event.to_dict()
+            }
+
+        except Exception as e:
+            return self._failure(e)
+
 # 使用例
 if __name__ == "__main__":
+    import sys
+
+    if sys.argv[1:2] == ['agent']:
+        # エージェントモード: 課金システムは起動せず、ハートビートだけをコレクターへ送る
+        # （node_agent は標準ライブラリだけで動き、psutil・dotenv・stripe は読み込まない）
+        from node_agent import main as run_agent
+
+        run_agent(sys.argv[2:])
+        sys.exit(0)
+
     # 課金管理システムを初期化
     billing_manager = ServerBillingManager()
     
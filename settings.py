@@ -0,0 +1,167 @@
+"""
+# settings.py
+Application Settings
+環境変数（と .env）から読む設定をまとめた型付きの設定オブジェクト。
+import 時には何も読まず、最初に get_settings() を呼んだときに一度だけ .env を読み込む。
+"""
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+
+def _optional(name: str) -> Optional[str]:
+    return os.getenv(name) or None
+
+
+@dataclass(frozen=True)
+class Settings:
+    # Stripe
+    stripe_secret_key: Optional[str] = None
+    stripe_publishable_key: Optional[str] = None
+    stripe_webhook_secret: Optional[str] = None
+    stripe_api_base: Optional[str] = None  # ローカルのフェイクStripeサーバーを使う場合に指定
+
+    # Stripe呼び出しの期限・再試行・サーキットブレーカー（stripe_resilience.py）
+    stripe_timeout: float = 5.0  # 1回の試行のタイムアウト（秒）
+    stripe_deadline: float = 10.0  # 再試行込みの期限（秒。バックグラウンドの請求はこの3倍）
+    stripe_max_attempts: int = 3
+    stripe_hedge_after: float = 2.0  # 決済がこの秒数応答しなければ同じ冪等キーで2本目を出す（0で無効）
+    stripe_breaker_threshold: int = 5  # この回数連続で上流が失敗したらブレーカーを開く
+    stripe_breaker_reset: float = 10.0  # ブレーカーを開いてから試行を再開するまで（秒）
+    stripe_max_in_flight: int = 100  # 同時に実行するStripe呼び出しの上限（超えた分はすぐ断る）
+    # 送信のレート制限（stripe_scheduler.py）。1秒あたりの呼び出し数、0 なら制限しない
+    # （Stripeの既定の上限はテストモード25・本番100。超えない値にすると429になる前に待たせる）
+    stripe_rate_limit: float = 0.0
+    stripe_rate_burst: float = 0.0  # 一度に送ってよい数（0ならレートと同じ）
+    stripe_class_rates: Optional[str] = None  # 種類ごとのレート（JSON。例 {"invoices": 10}）
+
+    # Stripeオブジェクトの読み取りキャッシュ（stripe_cache.py）。有効期限は秒、0でその種別はキャッシュしない
+    stripe_cache_size: int = 10000  # 種別ごとの件数上限
+    stripe_cache_customer_ttl: float = 300.0
+    stripe_cache_price_ttl: float = 3600.0
+    stripe_cache_payment_intent_ttl: float = 10.0  # 状態が変わるので短め（Webhookでも捨てる）
+    stripe_cache_invoice_ttl: float = 60.0
+    stripe_cache_negative_ttl: float = 30.0  # 存在しないIDを覚えておく期間
+
+    # サーバー・課金
+    server_name: str = 'Unknown Server'
+    hourly_rate: int = 100  # 1時間あたりの料金（通貨の主単位。円なら円）
+    currency: str = 'jpy'
+    rate_schedule: Optional[str] = None  # 料金表（JSONかJSONファイルのパス。pricing.py 参照）
+
+    # 使用量課金（resource_sampler.py）。有効時は稼働時間の料金にCPU時間・メモリGB時間の分を上乗せする
+    resource_billing: bool = False
+    cpu_hour_rate: str = '0'  # 1 CPU時間あたり（主単位。文字列なら誤差なく読める）
+    gb_hour_rate: str = '0'  # メモリ 1 GB時間あたり
+    resource_sample_interval: float = 5.0  # /proc を読む間隔（秒）
+    resource_sample_capacity: int = 17280  # リングバッファの件数（既定は5秒間隔で24時間分）
+
+    # キャッシュ・配信
+    snapshot_resolution: float = 1.0
+    stream_interval: float = 1.0
+    payment_dedupe_window: float = 60.0
+    payment_cache_size: int = 10000
+
+    # 稼働時間台帳・Webhook
+    uptime_ledger_path: Optional[str] = None
+    ledger_heartbeat_interval: float = 10.0
+    webhook_results_path: str = 'webhook_events.jsonl'
+
+    # 複数ワーカー（共有状態ファイル指定時はスナップショット・課金済み期間を共有し、定期処理はリーダーのみ）
+    shared_state_path: Optional[str] = None
+    periodic_charge_customer: Optional[str] = None
+    periodic_charge_interval: float = 3600.0
+
+    # 従量課金（使用量をWALに記録し、まとめてメーターイベントとして送る）
+    usage_wal_dir: str = 'usage_wal'
+    usage_flush_interval: float = 60.0
+    usage_flush_size: int = 10000
+    usage_fsync_interval: float = 0.05  # WALをfsyncする最短間隔（秒）。0なら記録ごと（イベントループを止める）
+    usage_event_name: str = 'server_uptime_seconds'
+    usage_customer: Optional[str] = None  # 指定時はリーダーが稼働秒数を毎分記録する
+
+    # ジョブキュー（インボイス・テスト決済を積んですぐ202を返し、バックグラウンドで実行）
+    job_queue_path: str = 'billing_jobs.db'
+    job_queue_durable: bool = False  # True: 積むたびにfsync（電源断にも耐えるが遅い）
+    job_workers: int = 8  # 同時に実行するジョブ数
+    job_batch_size: int = 32
+    job_max_attempts: int = 5
+
+    # ノードエージェント（node_agent.py）のハートビートの受け付け
+    agent_token: Optional[str] = None  # 指定時はエージェントに Authorization: Bearer を求める
+    node_stale_after: float = 180.0  # これ以上ハートビートがないノードはオフライン扱い（秒）
+    max_nodes: int = 10000  # 台帳に載せるノード数の上限（超えた新しいノードのハートビートは捨てる）
+
+    # Webサーバー
+    port: int = 8000
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """現在の環境変数から設定を作る（未設定の項目は既定値）"""
+        return cls(
+            stripe_secret_key=_optional('STRIPE_SECRET_KEY'),
+            stripe_publishable_key=_optional('STRIPE_PUBLISHABLE_KEY'),
+            stripe_webhook_secret=_optional('STRIPE_WEBHOOK_SECRET'),
+            stripe_api_base=_optional('STRIPE_API_BASE'),
+            stripe_timeout=float(os.getenv('STRIPE_TIMEOUT', cls.stripe_timeout)),
+            stripe_deadline=float(os.getenv('STRIPE_DEADLINE', cls.stripe_deadline)),
+            stripe_max_attempts=int(os.getenv('STRIPE_MAX_ATTEMPTS', cls.stripe_max_attempts)),
+            stripe_hedge_after=float(os.getenv('STRIPE_HEDGE_AFTER', cls.stripe_hedge_after)),
+            stripe_breaker_threshold=int(os.getenv('STRIPE_BREAKER_THRESHOLD', cls.stripe_breaker_threshold)),
+            stripe_breaker_reset=float(os.getenv('STRIPE_BREAKER_RESET', cls.stripe_breaker_reset)),
+            stripe_max_in_flight=int(os.getenv('STRIPE_MAX_IN_FLIGHT', cls.stripe_max_in_flight)),
+            stripe_rate_limit=float(os.getenv('STRIPE_RATE_LIMIT', cls.stripe_rate_limit)),
+            stripe_rate_burst=float(os.getenv('STRIPE_RATE_BURST', cls.stripe_rate_burst)),
+            stripe_class_rates=_optional('STRIPE_CLASS_RATES'),
+            stripe_cache_size=int(os.getenv('STRIPE_CACHE_SIZE', cls.stripe_cache_size)),
+            stripe_cache_customer_ttl=float(os.getenv('STRIPE_CACHE_CUSTOMER_TTL', cls.stripe_cache_customer_ttl)),
+            stripe_cache_price_ttl=float(os.getenv('STRIPE_CACHE_PRICE_TTL', cls.stripe_cache_price_ttl)),
+            stripe_cache_payment_intent_ttl=float(
+                os.getenv('STRIPE_CACHE_PAYMENT_INTENT_TTL', cls.stripe_cache_payment_intent_ttl)),
+            stripe_cache_invoice_ttl=float(os.getenv('STRIPE_CACHE_INVOICE_TTL', cls.stripe_cache_invoice_ttl)),
+            stripe_cache_negative_ttl=float(os.getenv('STRIPE_CACHE_NEGATIVE_TTL', cls.stripe_cache_negative_ttl)),
+            server_name=os.getenv('SERVER_NAME', cls.server_name),
+            hourly_rate=int(os.getenv('HOURLY_RATE', cls.hourly_rate)),
+            currency=os.getenv('CURRENCY', cls.currency),
+            rate_schedule=_optional('RATE_SCHEDULE'),
+            resource_billing=os.getenv('RESOURCE_BILLING', '').lower() in ('1', 'true', 'yes'),
+            cpu_hour_rate=os.getenv('CPU_HOUR_RATE', cls.cpu_hour_rate),
+            gb_hour_rate=os.getenv('GB_HOUR_RATE', cls.gb_hour_rate),
+            resource_sample_interval=float(os.getenv('RESOURCE_SAMPLE_INTERVAL', cls.resource_sample_interval)),
+            resource_sample_capacity=int(os.getenv('RESOURCE_SAMPLE_CAPACITY', cls.resource_sample_capacity)),
+            snapshot_resolution=float(os.getenv('SNAPSHOT_RESOLUTION', cls.snapshot_resolution)),
+            stream_interval=float(os.getenv('STREAM_INTERVAL', cls.stream_interval)),
+            payment_dedupe_window=float(os.getenv('PAYMENT_DEDUPE_WINDOW', cls.payment_dedupe_window)),
+            payment_cache_size=int(os.getenv('PAYMENT_CACHE_SIZE', cls.payment_cache_size)),
+            uptime_ledger_path=_optional('UPTIME_LEDGER_PATH'),
+            ledger_heartbeat_interval=float(os.getenv('LEDGER_HEARTBEAT_INTERVAL', cls.ledger_heartbeat_interval)),
+            webhook_results_path=os.getenv('WEBHOOK_RESULTS_PATH', cls.webhook_results_path),
+            shared_state_path=_optional('SHARED_STATE_PATH'),
+            periodic_charge_customer=_optional('PERIODIC_CHARGE_CUSTOMER'),
+            periodic_charge_interval=float(os.getenv('PERIODIC_CHARGE_INTERVAL', cls.periodic_charge_interval)),
+            usage_wal_dir=os.getenv('USAGE_WAL_DIR', cls.usage_wal_dir),
+            usage_flush_interval=float(os.getenv('USAGE_FLUSH_INTERVAL', cls.usage_flush_interval)),
+            usage_flush_size=int(os.getenv('USAGE_FLUSH_SIZE', cls.usage_flush_size)),
+            usage_fsync_interval=float(os.getenv('USAGE_FSYNC_INTERVAL', cls.usage_fsync_interval)),
+            usage_event_name=os.getenv('USAGE_EVENT_NAME', cls.usage_event_name),
+            usage_customer=_optional('USAGE_CUSTOMER'),
+            job_queue_path=os.getenv('JOB_QUEUE_PATH', cls.job_queue_path),
+            job_queue_durable=os.getenv('JOB_QUEUE_DURABLE', '').lower() in ('1', 'true', 'yes'),
+            job_workers=int(os.getenv('JOB_WORKERS', cls.job_workers)),
+            job_batch_size=int(os.getenv('JOB_BATCH_SIZE', cls.job_batch_size)),
+            job_max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', cls.job_max_attempts)),
+            agent_token=_optional('AGENT_TOKEN'),
+            node_stale_after=float(os.getenv('NODE_STALE_AFTER', cls.node_stale_after)),
+            max_nodes=int(os.getenv('MAX_NODES', cls.max_nodes)),
+            port=int(os.getenv('PORT', cls.port)),
+        )
+
+
+@lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    """設定を取得（初回のみ .env を読み込んで生成。再読込は get_settings.cache_clear()）"""
+    from dotenv import load_dotenv
+
+    load_dotenv('.env')  # 既に設定済みの環境変数は上書きしない
+    return Settings.from_env()
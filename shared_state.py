@@ -0,0 +1,229 @@
+"""
+# shared_state.py
+Shared Billing State
+複数のワーカープロセスで共有する課金状態を、固定レイアウトのmmapファイル1つに置く。
+起動時刻・最新の課金スナップショット（シリアライズ済み）・課金済み期間の終端（ウォーターマーク）を保持し、
+読み出しはロックを取らないシーケンスロック（seqlock）、書き込みだけをファイルロックで直列化する。
+定期課金などを1プロセスだけで動かすためのリーダー選出（LeaderLease）もここに置く。
+
+ファイル形式（リトルエンディアン）
+    ヘッダー 128バイト: magic(8) version(I) leader_pid(I) seq(Q) boot_time(d) started_at(d)
+                       charged_until(d) bucket(d) expires_at(d) etag_len(I) summary_len(I)
+                       uptime_len(I) info_len(I) crc32(I)
+    ペイロード: etag | summary_json | uptime_json | billing_info_json
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+import zlib
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional
+
+MAGIC = b'BILLSTAT'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQdddddIIIII')
+HEADER_SIZE = 128
+SEQ = struct.Struct('<Q')
+SEQ_OFFSET = 16
+PAYLOAD_CAPACITY = 16384
+FILE_SIZE = HEADER_SIZE + PAYLOAD_CAPACITY
+
+
+class SharedBillingState:
+    """ワーカー間で共有する課金状態（mmapファイル）"""
+
+    def __init__(self, path: str, boot_timestamp: float):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < FILE_SIZE:
+            os.ftruncate(self._fd, FILE_SIZE)
+        self._mmap = mmap.mmap(self._fd, FILE_SIZE)
+
+        with self.locked():
+            header = self._read_header()
+            if header is None or header['boot_time'] != boot_timestamp:
+                # 新規作成・マシン再起動後はスナップショットを捨てる（課金済みウォーターマークは引き継ぐ）
+                charged_until = header['charged_until'] if header is not None else 0.0
+                self._write(boot_time=boot_timestamp, started_at=time.time(),
+                            charged_until=charged_until, leader_pid=0)
+
+    # ---- 低レベル読み書き ----
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        """書き込み用の排他ロック（プロセス間）"""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _read_header(self, with_payload: bool = False) -> Optional[Dict]:
+        """seqlockで一貫したヘッダー（とペイロード）を読む。未初期化・破損ならNone"""
+        mm = self._mmap
+        for _ in range(1000):
+            seq = SEQ.unpack_from(mm, SEQ_OFFSET)[0]
+            if seq & 1:
+                time.sleep(0)  # 書き込み中
+                continue
+            (magic, version, leader_pid, _seq, boot_time, started_at, charged_until, bucket, expires_at,
+             etag_len, summary_len, uptime_len, info_len, crc) = HEADER.unpack_from(mm, 0)
+            payload_len = etag_len + summary_len + uptime_len + info_len
+            payload = mm[HEADER_SIZE:HEADER_SIZE + payload_len] if with_payload else b''
+            if SEQ.unpack_from(mm, SEQ_OFFSET)[0] != seq:
+                continue
+            if magic != MAGIC or version != VERSION:
+                return None
+            if with_payload and zlib.crc32(payload) != crc:
+                continue
+            return {
+                'leader_pid': leader_pid,
+                'boot_time': boot_time,
+                'started_at': started_at,
+                'charged_until': charged_until,
+                'bucket': bucket,
+                'expires_at': expires_at,
+                'lengths': (etag_len, summary_len, uptime_len, info_len),
+                'crc': crc,
+                'payload': payload,
+            }
+        raise RuntimeError(f"{self.path}: could not get a consistent read")
+
+    def _write(self, payload: Optional[bytes] = None, lengths=None, **fields):
+        """ロック取得済みの状態でヘッダー（とペイロード）を更新する"""
+        current = self._read_header() or {
+            'leader_pid': 0, 'boot_time': 0.0, 'started_at': 0.0, 'charged_until': 0.0,
+            'bucket': -1.0, 'expires_at': 0.0, 'lengths': (0, 0, 0, 0), 'crc': 0, 'payload': b'',
+        }
+        current.update(fields)
+        if payload is not None:
+            current['payload'] = payload
+            current['lengths'] = lengths
+            current['crc'] = zlib.crc32(payload)
+
+        mm = self._mmap
+        seq = SEQ.unpack_from(mm, SEQ_OFFSET)[0]
+        SEQ.pack_into(mm, SEQ_OFFSET, seq | 1)  # 奇数 = 書き込み中
+        if payload is not None:
+            mm[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+        HEADER.pack_into(mm, 0, MAGIC, VERSION, current['leader_pid'], seq | 1,
+                         current['boot_time'], current['started_at'], current['charged_until'],
+                         current['bucket'], current['expires_at'], *current['lengths'], current['crc'])
+        SEQ.pack_into(mm, SEQ_OFFSET, (seq | 1) + 1)
+
+    # ---- 公開API ----
+
+    @property
+    def started_at(self) -> float:
+        """最初のワーカーが状態を初期化した時刻"""
+        return self._read_header()['started_at']
+
+    @property
+    def charged_until(self) -> float:
+        """ここまで課金済み（UNIX時刻、未課金なら0）"""
+        return self._read_header()['charged_until']
+
+    def begin_run(self):
+        """アプリ起動時に1回だけ呼ぶ（起動時刻を更新し前回のスナップショットを捨てる。課金済み期間は引き継ぐ）"""
+        with self.locked():
+            self._write(started_at=time.time(), bucket=-1.0, leader_pid=0)
+
+    def set_charged_until(self, timestamp: float):
+        with self.locked():
+            self._write(charged_until=timestamp)
+
+    def set_leader(self, pid: int):
+        with self.locked():
+            self._write(leader_pid=pid)
+
+    def read_snapshot(self, bucket: float) -> Optional[Dict]:
+        """指定の時間枠のスナップショットが共有されていれば復元して返す"""
+        header = self._read_header()
+        if header is None or header['bucket'] != bucket:
+            return None
+        header = self._read_header(with_payload=True)
+        if header['bucket'] != bucket:
+            return None
+        etag_len, summary_len, uptime_len, _ = header['lengths']
+        payload = header['payload']
+        summary_json = payload[etag_len:etag_len + summary_len]
+        uptime_json = payload[etag_len + summary_len:etag_len + summary_len + uptime_len]
+        return {
+            'bucket': bucket,
+            'expires_at': header['expires_at'],
+            'etag': payload[:etag_len].decode('ascii'),
+            'billing_info': json.loads(payload[etag_len + summary_len + uptime_len:]),
+            'summary': json.loads(summary_json),
+            'summary_json': summary_json,
+            'uptime_json': uptime_json,
+        }
+
+    def get_or_publish_snapshot(self, bucket: float, build: Callable[[], Dict]) -> Dict:
+        """共有スナップショットを返す。なければ1プロセスだけが build() して公開する"""
+        snapshot = self.read_snapshot(bucket)
+        if snapshot is not None:
+            return snapshot
+        with self.locked():
+            # ロック待ちの間に他のワーカーが公開していればそれを使う
+            snapshot = self.read_snapshot(bucket)
+            if snapshot is not None:
+                return snapshot
+            snapshot = build()
+            etag = snapshot['etag'].encode('ascii')
+            info_json = json.dumps(snapshot['billing_info'], ensure_ascii=False,
+                                   separators=(',', ':')).encode('utf-8')
+            parts = (etag, snapshot['summary_json'], snapshot['uptime_json'], info_json)
+            payload = b''.join(parts)
+            if len(payload) > PAYLOAD_CAPACITY:
+                return snapshot  # 共有できない大きさなら自プロセスだけで使う
+            self._write(payload, tuple(len(part) for part in parts),
+                        bucket=snapshot['bucket'], expires_at=snapshot['expires_at'])
+            return snapshot
+
+    def stats(self) -> Dict:
+        header = self._read_header()
+        return {
+            'path': self.path,
+            'leader_pid': header['leader_pid'],
+            'started_at': header['started_at'],
+            'charged_until': header['charged_until'],
+            'snapshot_bucket': header['bucket'],
+        }
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+class LeaderLease:
+    """ロックファイルの排他ロックによるリーダー選出
+
+    ロックはプロセスが終了するとOSが解放するので、リーダーが落ちれば次に try_acquire() したワーカーが引き継ぐ。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.is_leader = False
+
+    def try_acquire(self) -> bool:
+        """リーダーならTrue（まだなら非ブロッキングで取得を試みる）"""
+        if not self.is_leader:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            self.is_leader = True
+        return True
+
+    def release(self):
+        if self.is_leader:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self.is_leader = False
+
+    def close(self):
+        self.release()
+        os.close(self._fd)
@@ -0,0 +1,225 @@
+"""
+# stripe_cache.py
+Stripe Object Cache
+顧客・価格・PaymentIntent・インボイスの読み取りをStripeの手前でキャッシュする（read-through）。
+種別ごとに有効期限と件数上限（LRU）を持ち、存在しないIDも短い間だけ覚えておく（ネガティブキャッシュ）。
+同じオブジェクトの取得が同時に来たときはStripeへの呼び出しを1回にまとめて結果を共有する。
+
+作成直後のオブジェクトは put() で入れておき、Webhookで変更・削除を知ったら invalidate_event() で捨てる。
+キャッシュした dict は呼び出し元で共有されるので書き換えないこと。
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from metrics import STRIPE_CACHE_LOOKUPS
+from ttl_cache import TTLCache
+
+# 種別 -> (stripe モジュールのクラス名, StripeClient.v1 のサービス名)
+CACHED_OBJECTS: Dict[str, Tuple[str, str]] = {
+    'customer': ('Customer', 'customers'),
+    'price': ('Price', 'prices'),
+    'payment_intent': ('PaymentIntent', 'payment_intents'),
+    'invoice': ('Invoice', 'invoices'),
+}
+
+_MISSING = object()
+_NOT_FOUND = object()  # ネガティブキャッシュの値
+
+
+def is_not_found(error: BaseException) -> bool:
+    """Stripeの「そのIDのオブジェクトはない」エラーか"""
+    import stripe  # エラーが起きたときだけ参照する
+
+    return isinstance(error, stripe.InvalidRequestError) and (
+        error.http_status == 404 or error.code == 'resource_missing')
+
+
+class ObjectCacheStats:
+    """種別ごとの参照結果の件数"""
+
+    __slots__ = ('hits', 'misses', 'negative_hits', 'coalesced', 'errors', 'invalidations', 'metrics')
+
+    def __init__(self, kind: str):
+        self.hits = 0
+        self.misses = 0  # Stripeに取りに行った回数
+        self.negative_hits = 0  # 「存在しない」を覚えていて返した回数
+        self.coalesced = 0  # 実行中の取得に相乗りした回数
+        self.errors = 0  # 取得の失敗（キャッシュしない）
+        self.invalidations = 0
+        self.metrics = {result: STRIPE_CACHE_LOOKUPS.labels(kind, result)
+                        for result in ('hit', 'miss', 'negative_hit', 'coalesced')}
+
+
+class StripeObjectCache:
+    """Stripeオブジェクトの読み取りキャッシュ（種別ごとのTTL + LRU、ネガティブキャッシュ、取得の合流）"""
+
+    def __init__(self, ttls: Dict[str, float], maxsize: int = 10000, negative_ttl: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.ttls = dict(ttls)  # 種別 -> 有効期限（秒）。0 ならその種別はキャッシュしない
+        self.negative_ttl = negative_ttl
+        self._caches = {kind: TTLCache(maxsize=maxsize, ttl=ttl, clock=clock) for kind, ttl in self.ttls.items()}
+        self._stats = {kind: ObjectCacheStats(kind) for kind in self.ttls}
+        self._inflight: Dict[Hashable, asyncio.Future] = {}  # (種別, ID) -> 実行中の取得
+        self._sync_inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, kind: str, object_id: str):
+        """キャッシュを引く（なければ _MISSING、存在しないと分かっていれば None）"""
+        value = self._caches[kind].get(object_id, _MISSING)
+        if value is _MISSING:
+            return _MISSING
+        stats = self._stats[kind]
+        if value is _NOT_FOUND:
+            stats.negative_hits += 1
+            stats.metrics['negative_hit'].inc()
+            return None
+        stats.hits += 1
+        stats.metrics['hit'].inc()
+        return value
+
+    def _store_fetched(self, kind: str, object_id: str, fetched) -> Optional[Dict]:
+        if fetched is None:
+            self._caches[kind].set(object_id, _NOT_FOUND, ttl=self.negative_ttl)
+        elif self.ttls[kind] > 0:
+            self._caches[kind].set(object_id, fetched)
+        return fetched
+
+    def _count_miss(self, kind: str):
+        stats = self._stats[kind]
+        stats.misses += 1
+        stats.metrics['miss'].inc()
+
+    def _count_coalesced(self, kind: str):
+        stats = self._stats[kind]
+        stats.coalesced += 1
+        stats.metrics['coalesced'].inc()
+
+    def get(self, kind: str, object_id: str, fetch: Callable[[str], Dict]) -> Optional[Dict]:
+        """オブジェクトを取得（キャッシュになければ fetch(ID) で取りに行く。存在しなければ None）
+
+        同じオブジェクトを別スレッドが取得中なら、その結果を待って使う。
+        """
+        value = self._lookup(kind, object_id)
+        if value is not _MISSING:
+            return value
+
+        key = (kind, object_id)
+        with self._lock:
+            future = self._sync_inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._sync_inflight[key] = Future()
+        if not leader:
+            self._count_coalesced(kind)
+            return future.result()
+
+        self._count_miss(kind)
+        try:
+            try:
+                fetched = fetch(object_id)
+            except Exception as e:
+                if not is_not_found(e):
+                    self._stats[kind].errors += 1
+                    raise
+                fetched = None
+            future.set_result(self._store_fetched(kind, object_id, fetched))
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._sync_inflight.pop(key, None)
+        return fetched
+
+    async def get_async(self, kind: str, object_id: str,
+                        fetch: Callable[[str], Awaitable[Dict]]) -> Optional[Dict]:
+        """get() の非同期版（同じオブジェクトの取得が実行中ならその完了を待って結果を共有する）"""
+        value = self._lookup(kind, object_id)
+        if value is not _MISSING:
+            return value
+
+        key = (kind, object_id)
+        task = self._inflight.get(key)
+        if task is None:
+            self._count_miss(kind)
+            task = asyncio.ensure_future(self._fetch_async(kind, object_id, fetch))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self._count_coalesced(kind)
+        # 待っている側がキャンセルされても共有中の取得は止めない
+        return await asyncio.shield(task)
+
+    async def _fetch_async(self, kind: str, object_id: str, fetch) -> Optional[Dict]:
+        try:
+            fetched = await fetch(object_id)
+        except Exception as e:
+            if not is_not_found(e):
+                self._stats[kind].errors += 1
+                raise
+            fetched = None
+        return self._store_fetched(kind, object_id, fetched)
+
+    # ---- 書き込み・無効化 ----
+
+    def put(self, kind: str, obj: Dict):
+        """作成・更新したばかりのオブジェクトを入れる（直後の参照でStripeを呼ばない）"""
+        if kind in self._caches and self.ttls[kind] > 0:
+            self._caches[kind].set(obj['id'], obj)
+
+    def invalidate(self, kind: str, object_id: str) -> bool:
+        """1件捨てる（捨てるものがあれば True）"""
+        cache = self._caches.get(kind)
+        if cache is None or cache.pop(object_id, _MISSING) is _MISSING:
+            return False
+        self._stats[kind].invalidations += 1
+        return True
+
+    def invalidate_event(self, event: Dict) -> bool:
+        """Webhookイベントの対象オブジェクトを捨てる（customer.updated / payment_intent.succeeded など）"""
+        obj = (event.get('data') or {}).get('object') or {}
+        kind, object_id = obj.get('object'), obj.get('id')
+        if kind not in self._caches or not object_id:
+            return False
+        return self.invalidate(kind, object_id)
+
+    def clear(self, kind: Optional[str] = None):
+        """種別ごと（省略時は全種別）に捨てる"""
+        for name, cache in self._caches.items():
+            if kind is None or name == kind:
+                cache.clear()
+
+    def stats(self) -> Dict:
+        """種別ごとのヒット率・件数"""
+        result = {}
+        for kind, stats in self._stats.items():
+            lookups = stats.hits + stats.negative_hits + stats.misses + stats.coalesced
+            result[kind] = {
+                'ttl': self.ttls[kind],
+                'size': len(self._caches[kind]),
+                'hits': stats.hits,
+                'negative_hits': stats.negative_hits,
+                'misses': stats.misses,
+                'coalesced': stats.coalesced,
+                'errors': stats.errors,
+                'evictions': self._caches[kind].evictions,
+                'invalidations': stats.invalidations,
+                'hit_ratio': round((lookups - stats.misses) / lookups, 4) if lookups else None,
+            }
+        return result
+
+
+def cache_from_settings(settings) -> StripeObjectCache:
+    return StripeObjectCache(
+        ttls={
+            'customer': settings.stripe_cache_customer_ttl,
+            'price': settings.stripe_cache_price_ttl,
+            'payment_intent': settings.stripe_cache_payment_intent_ttl,
+            'invoice': settings.stripe_cache_invoice_ttl,
+        },
+        maxsize=settings.stripe_cache_size,
+        negative_ttl=settings.stripe_cache_negative_ttl,
+    )
@@ -0,0 +1,366 @@
+"""
+# stripe_resilience.py
+Resilient Stripe Calls
+Stripe呼び出しに操作ごとの期限（再試行込みの全体期限と1回の試行のタイムアウト）、
+ジッター付き指数バックオフの再試行、ヘッジ（応答が遅い試行に同じ冪等キーで2本目を出す）、
+サーキットブレーカーと同時実行数の上限をかける。
+
+再試行・ヘッジは冪等キー付きの呼び出しだけに行うので、何度送っても作成は1回になる。
+上流の不調（5xx・接続エラー・タイムアウト）が続くとブレーカーが開き、一定時間は
+Stripeを呼ばずに StripeUnavailableError ですぐ失敗させる（リクエストのレイテンシを上流に引きずられない）。
+スケジューラー（stripe_scheduler.py）を渡すと、各試行はレート制限の送信枠を取ってから送る。
+"""
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from metrics import STRIPE_CIRCUIT_OPEN, STRIPE_RETRIES, STRIPE_SHED
+from stripe_scheduler import RateLimitedError, StripeScheduler, scheduler_from_settings
+
+T = TypeVar('T')
+
+# 再試行してよいHTTPステータス（409は同じ冪等キーのリクエストがまだ処理中）
+RETRYABLE_STATUSES = frozenset({409, 429, 500, 502, 503, 504})
+# ブレーカーの失敗として数えるもの（429・409は上流が生きている応答なので数えない）
+UNHEALTHY_STATUSES = frozenset({500, 502, 503, 504})
+
+
+class StripeUnavailableError(Exception):
+    """Stripeを呼ばずに失敗させた（回路遮断中・同時実行数超過・期限内に送信枠が取れない）"""
+
+    def __init__(self, reason: str, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after  # クライアントに返す再試行までの目安（秒）
+
+
+@dataclass(frozen=True)
+class CallPolicy:
+    """1種類の操作の期限と再試行の設定"""
+
+    deadline: float = 10.0  # 再試行・待ち時間を含めた全体の期限（秒）
+    attempt_timeout: float = 5.0  # 1回の試行のタイムアウト（秒）
+    max_attempts: int = 3
+    base_delay: float = 0.1  # バックオフの初期値（秒）
+    max_delay: float = 2.0  # バックオフの上限（秒）
+    hedge_after: Optional[float] = None  # この秒数応答がなければ2本目を出す（非同期のみ・None で無効）
+
+
+class CircuitBreaker:
+    """連続失敗で開き、reset_timeout 後に少数の試行（half-open）で回復を確かめるブレーカー"""
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    _GAUGE = {CLOSED: 0.0, HALF_OPEN: 0.5, OPEN: 1.0}
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0, half_open_probes: int = 1,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0  # 連続失敗数
+        self.opened_at = 0.0
+        self.probes = 0  # half-open 中に実行中の試行数
+        self.times_opened = 0
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str):
+        self.state = state
+        STRIPE_CIRCUIT_OPEN.labels().set(self._GAUGE[state])
+
+    def retry_after(self) -> float:
+        """開いている場合、次に試行できるまでの秒数"""
+        return max(0.0, self.opened_at + self.reset_timeout - self.clock())
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half-open では同時に half_open_probes 件まで）"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if self.clock() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+                self.probes = 0
+            if self.probes >= self.half_open_probes:
+                return False
+            self.probes += 1
+            return True
+
+    def release(self, healthy: Optional[bool]):
+        """呼び出しの結果を記録（None は上流の健全性と無関係な終わり方）"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.probes = max(0, self.probes - 1)
+            if healthy is None:
+                return
+            if healthy:
+                self.failures = 0
+                if self.state != self.CLOSED:
+                    self._set_state(self.CLOSED)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self._set_state(self.OPEN)
+                self.opened_at = self.clock()
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and self.clock() - self.opened_at < self.reset_timeout
+
+    def stats(self) -> Dict:
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'times_opened': self.times_opened,
+            'retry_after': round(self.retry_after(), 3) if self.state == self.OPEN else 0.0,
+        }
+
+
+def classify(error: BaseException) -> Tuple[bool, Optional[bool], Optional[float], str]:
+    """エラーを (再試行してよいか, 上流の健全性, Retry-After秒, 理由) に分類する"""
+    if isinstance(error, StripeUnavailableError):
+        return False, None, None, error.reason
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+        return True, False, None, 'timeout'
+
+    import stripe
+
+    if isinstance(error, stripe.APIConnectionError):
+        return True, False, None, 'connection'
+    if not isinstance(error, stripe.StripeError):
+        return False, None, None, 'error'
+
+    status = error.http_status
+    headers = {name.lower(): value for name, value in (error.headers or {}).items()}
+    should_retry = headers.get('stripe-should-retry')
+    retry_after = None
+    if headers.get('retry-after'):
+        try:
+            retry_after = float(headers['retry-after'])
+        except ValueError:
+            retry_after = None
+    healthy = status not in UNHEALTHY_STATUSES
+    if should_retry is not None:
+        return should_retry == 'true', healthy, retry_after, f"http_{status}"
+    if status == 409 and error.code != 'idempotency_key_in_use':
+        return False, True, None, 'http_409'
+    return status in RETRYABLE_STATUSES, healthy, retry_after, f"http_{status}"
+
+
+class ResilientCaller:
+    """操作ごとのポリシーでStripe呼び出しを実行する（同期・非同期共通の状態を持つ）"""
+
+    def __init__(self, policies: Optional[Dict[str, CallPolicy]] = None, default: CallPolicy = CallPolicy(),
+                 breaker: Optional[CircuitBreaker] = None, max_in_flight: int = 100,
+                 rng: Optional[random.Random] = None, scheduler: Optional[StripeScheduler] = None):
+        self.policies = policies or {}
+        self.default = default
+        self.breaker = breaker or CircuitBreaker()
+        self.scheduler = scheduler  # レート制限に合わせた送信（None なら制限しない）
+        self.max_in_flight = max_in_flight  # これを超える同時呼び出しは待たせずに断る
+        self.random = rng or random.Random()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def policy(self, operation: str) -> CallPolicy:
+        return self.policies.get(operation, self.default)
+
+    def _admit(self, operation: str):
+        """呼び出しを受け付ける（ブレーカーが開いているか混みすぎなら即座に失敗）"""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                STRIPE_SHED.labels(operation, 'overloaded').inc()
+                raise StripeUnavailableError('overloaded', f"too many Stripe calls in flight ({self.in_flight})")
+            if not self.breaker.allow():
+                STRIPE_SHED.labels(operation, 'circuit_open').inc()
+                raise StripeUnavailableError(
+                    'circuit_open', "Stripe is unavailable (circuit open); failing fast",
+                    retry_after=max(self.breaker.retry_after(), 0.1))
+            self.in_flight += 1
+
+    def _finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _rate_limited(self, operation: str, error: RateLimitedError) -> StripeUnavailableError:
+        STRIPE_SHED.labels(operation, 'rate_limited').inc()
+        return StripeUnavailableError('rate_limited', str(error), retry_after=error.retry_after)
+
+    def _acquire(self, operation: str, deadline: float):
+        """試行の前に送信枠を取る（期限までに取れなければ StripeUnavailableError）"""
+        if self.scheduler is not None:
+            try:
+                self.scheduler.acquire(operation, deadline - time.monotonic())
+            except RateLimitedError as error:
+                raise self._rate_limited(operation, error) from None
+
+    async def _acquire_async(self, operation: str, deadline: float):
+        if self.scheduler is not None:
+            try:
+                await self.scheduler.acquire_async(operation, deadline - time.monotonic())
+            except RateLimitedError as error:
+                raise self._rate_limited(operation, error) from None
+
+    def _record(self, operation: str, error: Optional[BaseException] = None):
+        """試行の結果をスケジューラーに伝える（429で送信レートを下げ、成功で戻す）"""
+        if self.scheduler is not None and not isinstance(error, StripeUnavailableError):
+            self.scheduler.record(operation, error)
+
+    def _next_delay(self, operation: str, policy: CallPolicy, attempt_no: int, error: BaseException,
+                    idempotent: bool, deadline: float) -> Optional[float]:
+        """再試行までの待ち時間（再試行しないなら None）。結果はブレーカーにも記録する"""
+        retryable, healthy, retry_after, reason = classify(error)
+        self.breaker.release(healthy)
+        if not (retryable and idempotent) or attempt_no >= policy.max_attempts:
+            return None
+        # full jitter: 0〜min(上限, 初期値 × 2^(n-1)) の一様乱数。Retry-After があればそれ以上待つ
+        delay = self.random.uniform(0, min(policy.max_delay, policy.base_delay * 2 ** (attempt_no - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        if time.monotonic() + delay >= deadline or self.breaker.is_open():
+            return None
+        STRIPE_RETRIES.labels(operation, reason).inc()
+        return delay
+
+    def _readmit(self, operation: str):
+        """再試行の前にもう一度ブレーカーを通す（待っている間に開いたら打ち切る）"""
+        if not self.breaker.allow():
+            STRIPE_SHED.labels(operation, 'circuit_open').inc()
+            raise StripeUnavailableError('circuit_open', "Stripe is unavailable (circuit open); failing fast",
+                                         retry_after=max(self.breaker.retry_after(), 0.1))
+
+    def call(self, operation: str, attempt: Callable[[float], T], idempotent: bool = True) -> T:
+        """同期呼び出し。attempt(タイムアウト秒) を期限内で再試行する"""
+        policy = self.policy(operation)
+        self._admit(operation)
+        deadline = time.monotonic() + policy.deadline
+        try:
+            attempt_no = 1
+            while True:
+                try:
+                    self._acquire(operation, deadline)
+                    timeout = min(policy.attempt_timeout, deadline - time.monotonic())
+                    result = attempt(timeout)
+                except Exception as error:
+                    self._record(operation, error)
+                    delay = self._next_delay(operation, policy, attempt_no, error, idempotent, deadline)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    self._readmit(operation)
+                    attempt_no += 1
+                    continue
+                self._record(operation)
+                self.breaker.release(True)
+                return result
+        finally:
+            self._finish()
+
+    async def call_async(self, operation: str, attempt: Callable[[float], Awaitable[T]],
+                         idempotent: bool = True) -> T:
+        """非同期呼び出し。試行ごとにタイムアウトをかけ、冪等なら遅い試行をヘッジする"""
+        policy = self.policy(operation)
+        self._admit(operation)
+        deadline = time.monotonic() + policy.deadline
+        try:
+            attempt_no = 1
+            while True:
+                hedge_after = policy.hedge_after if idempotent else None
+                try:
+                    await self._acquire_async(operation, deadline)
+                    timeout = min(policy.attempt_timeout, deadline - time.monotonic())
+                    result = await self._attempt_async(operation, attempt, timeout, hedge_after)
+                except Exception as error:
+                    self._record(operation, error)
+                    delay = self._next_delay(operation, policy, attempt_no, error, idempotent, deadline)
+                    if delay is None:
+                        raise
+                    await asyncio.sleep(delay)
+                    self._readmit(operation)
+                    attempt_no += 1
+                    continue
+                self._record(operation)
+                self.breaker.release(True)
+                return result
+        finally:
+            self._finish()
+
+    async def _attempt_async(self, operation: str, attempt: Callable[[float], Awaitable[T]],
+                             timeout: float, hedge_after: Optional[float]) -> T:
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        if hedge_after is None or hedge_after >= timeout:
+            return await asyncio.wait_for(attempt(timeout), timeout)
+
+        loop = asyncio.get_running_loop()
+        attempt_deadline = loop.time() + timeout
+        first = asyncio.ensure_future(attempt(timeout))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return first.result()
+            if self.scheduler is not None and not self.scheduler.try_acquire(operation):
+                # 送信枠に空きがない: レート制限を超えてまでヘッジはしない
+                return await asyncio.wait_for(first, attempt_deadline - loop.time())
+            # 1本目が遅い: 同じ冪等キーで2本目を出し、先に成功した方を使う
+            STRIPE_RETRIES.labels(operation, 'hedge').inc()
+            pending.add(asyncio.ensure_future(attempt(attempt_deadline - loop.time())))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=attempt_deadline - loop.time(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    # 片方の失敗（409 処理中など）は、もう片方が残っていればそちらを待つ
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> Dict:
+        stats = {'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight, 'breaker': self.breaker.stats()}
+        if self.scheduler is not None:
+            stats['scheduler'] = self.scheduler.stats()
+        return stats
+
+
+def policies_from_settings(settings) -> Tuple[CallPolicy, Dict[str, CallPolicy]]:
+    """設定から既定のポリシーと操作ごとのポリシーを作る
+
+    画面から呼ばれる決済は期限を短くしてヘッジし、バックグラウンドの請求・メーターイベントは
+    期限を長く・再試行を多めにする（ヘッジはしない）。
+    """
+    default = CallPolicy(
+        deadline=settings.stripe_deadline,
+        attempt_timeout=settings.stripe_timeout,
+        max_attempts=settings.stripe_max_attempts,
+        hedge_after=settings.stripe_hedge_after or None,
+    )
+    background = replace(default, deadline=default.deadline * 3, max_attempts=default.max_attempts * 2,
+                         hedge_after=None)
+    policies = {
+        'payment_intent.create': default,
+        'invoice_item.create': background,
+        'invoice.create': background,
+        'meter_event.create': background,
+    }
+    return default, policies
+
+
+def caller_from_settings(settings) -> ResilientCaller:
+    default, policies = policies_from_settings(settings)
+    breaker = CircuitBreaker(failure_threshold=settings.stripe_breaker_threshold,
+                             reset_timeout=settings.stripe_breaker_reset)
+    return ResilientCaller(policies, default, breaker, max_in_flight=settings.stripe_max_in_flight,
+                           scheduler=scheduler_from_settings(settings))
@@ -0,0 +1,390 @@
+"""
+# stripe_scheduler.py
+Stripe Call Scheduler
+Stripeへの送信をアカウント全体のレート制限に合わせて送り出すスケジューラー。
+全呼び出し共通のトークンバケットと操作の種類ごとのトークンバケットの両方からトークンを取れた
+呼び出しだけが送られ、取れない間は優先度別のキュー（interactive が先、batch は後）で待つ。
+
+画面からの決済は interactive、インボイス・メーターイベント・一覧の取得などは batch に入るので、
+一括請求が混んでいても決済はキューの先頭から送られる（429になってから再試行するのではなく、
+そもそも制限を超えて送らない）。
+
+レートは429の応答に合わせて変える（AIMD）。429を受けたらバケットのレートを半分にして
+トークンを空にし、Retry-After があればその間は送らない。成功が続けば設定値まで少しずつ戻す。
+Stripe-Rate-Limited-Reason がエンドポイント単位の制限を示すときは、その種類のバケットだけを絞る。
+
+同期（スレッド）・非同期（イベントループ）のどちらの呼び出しからも使える。待っている呼び出しへの
+割り当ては1本のディスパッチャースレッドが行う（待ちがなくトークンがあればその場で送る）。
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Deque, Dict, Iterator, Optional
+
+from metrics import STRIPE_QUEUE_DEPTH, STRIPE_QUEUE_WAIT_SECONDS, STRIPE_RATE_LIMIT, STRIPE_THROTTLED
+
+INTERACTIVE, BATCH = 'interactive', 'batch'
+LANES = (INTERACTIVE, BATCH)  # 優先度の高い順
+
+# 操作の種類ごとのバケットのレート（全体のレートに対する割合。STRIPE_CLASS_RATES で上書きできる）
+CLASS_SHARES: Dict[str, float] = {
+    'payments': 1.0,
+    'reads': 1.0,
+    'invoices': 0.8,
+    'meter_events': 0.8,
+    'default': 1.0,
+}
+
+# エンドポイント・オブジェクト単位の制限（種類ごとのバケットだけを絞る）
+ENDPOINT_LIMIT_REASONS = frozenset({'endpoint-rate', 'endpoint-concurrency', 'resource-specific'})
+
+_lane: contextvars.ContextVar = contextvars.ContextVar('stripe_lane', default=None)
+
+
+def operation_class(operation: str) -> str:
+    """操作名（'invoice.create' など）の種類"""
+    if operation == 'payment_intent.create':
+        return 'payments'
+    if operation.endswith(('.retrieve', '.list')):
+        return 'reads'
+    if operation in ('invoice_item.create', 'invoice.create'):
+        return 'invoices'
+    if operation == 'meter_event.create':
+        return 'meter_events'
+    return 'default'
+
+
+def default_lane(operation: str) -> str:
+    """操作の既定の優先度（決済の作成と1件の取得は画面から、それ以外はバックグラウンド）"""
+    if operation == 'payment_intent.create' or operation.endswith('.retrieve'):
+        return INTERACTIVE
+    return BATCH
+
+
+@contextmanager
+def priority_lane(lane: str) -> Iterator[None]:
+    """この中（同じスレッド・タスク）のStripe呼び出しを指定の優先度で送る
+
+    ジョブキューのテスト決済のように、画面用の操作をバックグラウンドで実行するときに使う。
+    """
+    token = _lane.set(lane)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class TokenBucket:
+    """レート（個/秒）と容量を持つトークンバケット（paused_until までは補充しない）"""
+
+    __slots__ = ('max_rate', 'rate', 'burst', 'tokens', 'updated', 'paused_until', 'last_decrease')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = now
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+
+    def refill(self, now: float):
+        start = max(self.updated, self.paused_until)
+        if now > start:
+            self.tokens = min(self.burst, self.tokens + (now - start) * self.rate)
+        self.updated = max(self.updated, now)
+
+    def wait_time(self, now: float) -> float:
+        """次のトークンまでの秒数（refill 済みの前提）"""
+        if self.tokens >= 1.0:
+            return 0.0
+        start = max(now, self.paused_until)
+        return start - now + (1.0 - self.tokens) / self.rate
+
+    def throttle(self, now: float, factor: float, min_rate: float, retry_after: Optional[float],
+                 cooldown: float) -> bool:
+        """429を受けたとき: レートを下げてトークンを捨てる（cooldown 内の連続した429では1回だけ下げる）"""
+        self.tokens = 0.0
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self.last_decrease < cooldown:
+            return False
+        self.rate = max(min_rate, self.rate * factor)
+        self.last_decrease = now
+        return True
+
+    def recover(self, step: float):
+        """成功したとき: 1秒あたり step 個ずつ設定値まで戻る（成功1回あたり step / rate）"""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + step / self.rate)
+
+
+class _Waiter:
+    __slots__ = ('lane', 'bucket', 'enqueued', 'granted', 'wake')
+
+    def __init__(self, lane: str, bucket: TokenBucket, enqueued: float, wake: Callable[[], None]):
+        self.lane = lane
+        self.bucket = bucket
+        self.enqueued = enqueued
+        self.granted = False
+        self.wake = wake
+
+
+class LaneStats:
+    __slots__ = ('granted', 'queued', 'dequeued', 'timeouts', 'wait_total', 'wait_max', 'depth_gauge',
+                 'wait_histogram')
+
+    def __init__(self, lane: str):
+        self.granted = 0
+        self.queued = 0  # キューで待った呼び出し数
+        self.dequeued = 0  # キューで待ってから送信枠を取れた呼び出し数（wait_total の件数）
+        self.timeouts = 0  # 期限までにトークンが取れなかった呼び出し数
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.depth_gauge = STRIPE_QUEUE_DEPTH.labels(lane)
+        self.wait_histogram = STRIPE_QUEUE_WAIT_SECONDS.labels(lane)
+
+
+class RateLimitedError(Exception):
+    """期限までに送信の順番が来なかった"""
+
+    def __init__(self, lane: str, retry_after: float):
+        super().__init__(f"Stripe rate limit: no send slot for {lane} call before its deadline")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class StripeScheduler:
+    """全体・種類ごとのトークンバケットと優先度別キューでStripe呼び出しの送信を調整する"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None, class_rates: Optional[Dict[str, float]] = None,
+                 min_rate: float = 1.0, decrease_factor: float = 0.5, recovery: float = 0.05,
+                 cooldown: float = 1.0, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        now = clock()
+        burst = burst if burst is not None else rate
+        self.global_bucket = TokenBucket(rate, burst, now)
+        class_rates = {**{name: rate * share for name, share in CLASS_SHARES.items()}, **(class_rates or {})}
+        self.class_buckets = {name: TokenBucket(class_rate, burst * class_rate / rate, now)
+                              for name, class_rate in class_rates.items()}
+        self.min_rate = min_rate
+        self.decrease_factor = decrease_factor
+        self.recovery = recovery  # 設定値に対して1秒あたりに戻す割合
+        self.cooldown = cooldown
+        self.lanes: Dict[str, Deque[_Waiter]] = {lane: deque() for lane in LANES}
+        self.lane_stats = {lane: LaneStats(lane) for lane in LANES}
+        self.throttled: Dict[str, int] = {}  # 絞ったバケット -> 回数
+        self._cond = threading.Condition(threading.Lock())
+        self._dispatcher: Optional[threading.Thread] = None
+        STRIPE_RATE_LIMIT.labels().set(rate)
+
+    # ---- 送信枠の取得 ----
+
+    def _bucket(self, operation: str) -> TokenBucket:
+        return self.class_buckets.get(operation_class(operation)) or self.class_buckets['default']
+
+    def _lane(self, operation: str) -> str:
+        return _lane.get() or default_lane(operation)
+
+    def _try_take(self, lane: str, bucket: TokenBucket, now: float) -> bool:
+        """待ちがなく（自分以上の優先度のキューが空で）トークンがあればその場で取る"""
+        for other in LANES:
+            if self.lanes[other]:
+                return False
+            if other == lane:
+                break
+        global_bucket = self.global_bucket
+        global_bucket.refill(now)
+        bucket.refill(now)
+        if global_bucket.tokens < 1.0 or bucket.tokens < 1.0:
+            return False
+        global_bucket.tokens -= 1.0
+        bucket.tokens -= 1.0
+        self.lane_stats[lane].granted += 1
+        return True
+
+    def _enqueue(self, lane: str, bucket: TokenBucket, now: float, wake: Callable[[], None]) -> _Waiter:
+        waiter = _Waiter(lane, bucket, now, wake)
+        self.lanes[lane].append(waiter)
+        stats = self.lane_stats[lane]
+        stats.queued += 1
+        stats.depth_gauge.inc()
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._run, name='stripe-scheduler', daemon=True)
+            self._dispatcher.start()
+        self._cond.notify()
+        return waiter
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """期限切れ・キャンセルでキューから外す（もう割り当て済みなら False）"""
+        if waiter.granted:
+            return False
+        self.lanes[waiter.lane].remove(waiter)
+        stats = self.lane_stats[waiter.lane]
+        stats.timeouts += 1
+        stats.depth_gauge.dec()
+        self._cond.notify()  # 後ろで待っている呼び出しが先頭になる
+        return True
+
+    def _retry_after(self) -> float:
+        return max(self.global_bucket.wait_time(self.clock()), 1.0 / self.global_bucket.rate)
+
+    def try_acquire(self, operation: str) -> bool:
+        """待たずに取れるときだけ送信枠を取る（ヘッジなど、取れなければやめてよい送信用）"""
+        with self._cond:
+            return self._try_take(self._lane(operation), self._bucket(operation), self.clock())
+
+    def acquire(self, operation: str, timeout: float) -> float:
+        """送信枠を取る（同期・取れるまで最大 timeout 秒待つ）。待った秒数を返す"""
+        lane, bucket = self._lane(operation), self._bucket(operation)
+        event = threading.Event()
+        with self._cond:
+            now = self.clock()
+            if self._try_take(lane, bucket, now):
+                return 0.0
+            waiter = self._enqueue(lane, bucket, now, event.set)
+        if not event.wait(max(0.0, timeout)):
+            with self._cond:
+                if self._abandon(waiter):
+                    raise RateLimitedError(lane, self._retry_after())
+        return self.clock() - waiter.enqueued
+
+    async def acquire_async(self, operation: str, timeout: float) -> float:
+        """送信枠を取る（非同期版）"""
+        lane, bucket = self._lane(operation), self._bucket(operation)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(_resolve, future)
+
+        with self._cond:
+            now = self.clock()
+            if self._try_take(lane, bucket, now):
+                return 0.0
+            waiter = self._enqueue(lane, bucket, now, wake)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(0.0, timeout))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            with self._cond:
+                abandoned = self._abandon(waiter)
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            if abandoned:
+                raise RateLimitedError(lane, self._retry_after()) from None
+        return self.clock() - waiter.enqueued
+
+    # ---- ディスパッチャー ----
+
+    def _dispatch(self, now: float) -> Optional[float]:
+        """優先度の高いキューの先頭から送信枠を割り当てる（次に見直すまでの秒数を返す）"""
+        global_bucket = self.global_bucket
+        global_bucket.refill(now)
+        next_check: Optional[float] = None
+        for lane in LANES:
+            queue = self.lanes[lane]
+            stats = self.lane_stats[lane]
+            while queue:
+                if global_bucket.tokens < 1.0:
+                    # 全体の枠が空: 下の優先度にも回さない（補充されたら上から割り当てる）
+                    return global_bucket.wait_time(now)
+                waiter = queue[0]
+                bucket = waiter.bucket
+                bucket.refill(now)
+                if bucket.tokens < 1.0:
+                    # この種類の枠だけが空: 下の優先度の別の種類は送ってよい
+                    wait = bucket.wait_time(now)
+                    next_check = wait if next_check is None else min(next_check, wait)
+                    break
+                global_bucket.tokens -= 1.0
+                bucket.tokens -= 1.0
+                queue.popleft()
+                waiter.granted = True
+                waited = now - waiter.enqueued
+                stats.granted += 1
+                stats.dequeued += 1
+                stats.wait_total += waited
+                stats.wait_max = max(stats.wait_max, waited)
+                stats.depth_gauge.dec()
+                stats.wait_histogram.observe(waited)
+                waiter.wake()
+        return next_check
+
+    def _run(self):
+        with self._cond:
+            while True:
+                timeout = self._dispatch(self.clock())
+                self._cond.wait(timeout)
+
+    # ---- 応答によるレートの調整 ----
+
+    def record(self, operation: str, error: Optional[BaseException] = None):
+        """試行の結果を反映する（429ならレートを下げ、成功なら少しずつ戻す）"""
+        status = getattr(error, 'http_status', None) if error is not None else None
+        if error is not None and status != 429:
+            return
+        with self._cond:
+            bucket = self._bucket(operation)
+            if error is None:
+                self.global_bucket.recover(self.global_bucket.max_rate * self.recovery)
+                bucket.recover(bucket.max_rate * self.recovery)
+                STRIPE_RATE_LIMIT.labels().set(self.global_bucket.rate)
+                return
+            headers = {name.lower(): value for name, value in (getattr(error, 'headers', None) or {}).items()}
+            retry_after = None
+            try:
+                retry_after = float(headers['retry-after']) if headers.get('retry-after') else None
+            except ValueError:
+                pass
+            reason = headers.get('stripe-rate-limited-reason', '')
+            name = operation_class(operation) if reason in ENDPOINT_LIMIT_REASONS else 'global'
+            target = bucket if name != 'global' else self.global_bucket
+            if target.throttle(self.clock(), self.decrease_factor, self.min_rate, retry_after, self.cooldown):
+                self.throttled[name] = self.throttled.get(name, 0) + 1
+                STRIPE_THROTTLED.labels(name).inc()
+            STRIPE_RATE_LIMIT.labels().set(self.global_bucket.rate)
+            self._cond.notify()
+
+    def stats(self) -> Dict:
+        """キューの深さ・待ち時間とバケットの現在のレート"""
+        with self._cond:
+            now = self.clock()
+            lanes = {}
+            for lane, stats in self.lane_stats.items():
+                waited = [now - waiter.enqueued for waiter in self.lanes[lane]]
+                lanes[lane] = {
+                    'depth': len(waited),
+                    'oldest_wait_ms': round(max(waited) * 1000, 1) if waited else 0.0,
+                    'granted': stats.granted,
+                    'queued': stats.queued,
+                    'timeouts': stats.timeouts,
+                    'mean_wait_ms': round(stats.wait_total / stats.dequeued * 1000, 2) if stats.dequeued else 0.0,
+                    'max_wait_ms': round(stats.wait_max * 1000, 1),
+                }
+            buckets = {'global': self.global_bucket, **self.class_buckets}
+            return {
+                'lanes': lanes,
+                'buckets': {name: {'rate': round(bucket.rate, 2), 'max_rate': bucket.max_rate,
+                                   'tokens': round(bucket.tokens, 2),
+                                   'paused_for': round(max(0.0, bucket.paused_until - now), 3)}
+                            for name, bucket in buckets.items()},
+                'throttled': dict(self.throttled),
+            }
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def scheduler_from_settings(settings) -> Optional[StripeScheduler]:
+    """STRIPE_RATE_LIMIT（1秒あたりの呼び出し数。0 なら使わない）からスケジューラーを作る"""
+    if not settings.stripe_rate_limit:
+        return None
+    import json
+
+    class_rates = json.loads(settings.stripe_class_rates) if settings.stripe_class_rates else None
+    return StripeScheduler(settings.stripe_rate_limit, settings.stripe_rate_burst or None, class_rates)
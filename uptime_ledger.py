@@ -0,0 +1,241 @@
+"""
+# uptime_ledger.py
+Persistent Uptime Ledger
+稼働ハートビートを固定長バイナリレコードで追記していく台帳。読み出しはmmapで行い、
+各レコードに累積稼働秒数を持たせることで「T1〜T2の課金対象秒数」を二分探索(O(log n))で求める。
+
+ファイル形式（リトルエンディアン）
+    ヘッダー 32バイト: magic(8) version(I) record_size(I) reserved(16)
+    レコード 32バイト: timestamp(d) boot_time(d) cumulative_seconds(d) crc32(I) flags(I)
+末尾の書きかけ・破損レコードはオープン時に切り詰めるので、クラッシュ後もそのまま追記を再開できる。
+"""
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import Optional, Tuple
+
+MAGIC = b'UPLEDGR\x00'
+VERSION = 1
+HEADER = struct.Struct('<8sII16x')
+RECORD = struct.Struct('<dddII')
+PAYLOAD_SIZE = struct.calcsize('<ddd')
+
+FLAG_HEARTBEAT = 0
+
+
+class UptimeLedger:
+    """追記専用の稼働時間台帳"""
+
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_interval = fsync_interval  # fsyncする最短間隔（秒）。0なら毎回
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._mmap: Optional[mmap.mmap] = None
+        self._mapped_size = 0
+        self._last_fsync = 0.0
+        self._last: Optional[Tuple[float, float, float]] = None
+        self._size = 0  # 自プロセスが把握しているファイルサイズ
+
+        self._recover()
+
+    # ---- ファイル管理 ----
+
+    def _recover(self):
+        """ヘッダーを検証し、末尾の不完全・破損レコードを切り詰める"""
+        size = os.fstat(self._fd).st_size
+        if size < HEADER.size:
+            os.ftruncate(self._fd, 0)
+            os.write(self._fd, HEADER.pack(MAGIC, VERSION, RECORD.size))
+            os.fsync(self._fd)
+            self._size = HEADER.size
+            return
+
+        magic, version, record_size = HEADER.unpack(os.pread(self._fd, HEADER.size, 0))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            raise ValueError(f"{self.path} is not an uptime ledger (version {VERSION})")
+
+        count = (size - HEADER.size) // RECORD.size
+        # 書きかけの端数バイトと、CRCが合わない末尾レコードを落とす
+        while count > 0:
+            record = self._unpack(os.pread(self._fd, RECORD.size, self._offset(count - 1)))
+            if record is not None:
+                self._last = record
+                break
+            count -= 1
+        valid_size = self._offset(count)
+        if valid_size != size:
+            os.ftruncate(self._fd, valid_size)
+            os.fsync(self._fd)
+        self._size = valid_size
+
+    def _sync_tail(self):
+        """他のプロセスが追記していたら最終レコードを読み直す（書き込み担当が別ワーカーから移った場合）"""
+        size = os.fstat(self._fd).st_size
+        if size == self._size:
+            return
+        count = (size - HEADER.size) // RECORD.size
+        self._last = self._unpack(os.pread(self._fd, RECORD.size, self._offset(count - 1))) if count else None
+        self._size = size
+
+    @staticmethod
+    def _offset(index: int) -> int:
+        return HEADER.size + index * RECORD.size
+
+    @staticmethod
+    def _unpack(raw: bytes) -> Optional[Tuple[float, float, float]]:
+        """レコードを (timestamp, boot_time, cumulative_seconds) に復元。CRC不一致ならNone"""
+        if len(raw) != RECORD.size:
+            return None
+        timestamp, boot_time, cumulative, crc, _flags = RECORD.unpack(raw)
+        if zlib.crc32(raw[:PAYLOAD_SIZE]) != crc:
+            return None
+        return timestamp, boot_time, cumulative
+
+    def _view(self) -> mmap.mmap:
+        """現在のファイルサイズに合わせたmmapを返す（追記で伸びていたら張り直す）"""
+        size = os.fstat(self._fd).st_size
+        if self._mmap is None or size != self._mapped_size:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._mmap = mmap.mmap(self._fd, size, access=mmap.ACCESS_READ)
+            self._mapped_size = size
+        return self._mmap
+
+    def close(self):
+        """ファイルを閉じる"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fd >= 0:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = -1
+
+    def __len__(self) -> int:
+        return (self._view().size() - HEADER.size) // RECORD.size
+
+    def __enter__(self) -> "UptimeLedger":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- 書き込み ----
+
+    def append_heartbeat(self, timestamp: Optional[float] = None, boot_time: Optional[float] = None) -> float:
+        """「boot_time に起動したマシンが timestamp 時点で稼働中」というハートビートを追記
+
+        戻り値は台帳の先頭からの累積課金対象秒数。
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        if boot_time is None:
+            boot_time = timestamp
+
+        self._sync_tail()
+        cumulative = 0.0
+        if self._last is not None:
+            last_timestamp, _, last_cumulative = self._last
+            if timestamp < last_timestamp:
+                raise ValueError(f"heartbeat {timestamp} is older than the last record {last_timestamp}")
+            # 同じ起動なら前回からの経過分、再起動後なら起動時刻（か前回時刻の遅い方）からの分を加算
+            cumulative = last_cumulative + max(0.0, timestamp - max(boot_time, last_timestamp))
+
+        payload = struct.pack('<ddd', timestamp, boot_time, cumulative)
+        os.write(self._fd, payload + struct.pack('<II', zlib.crc32(payload), FLAG_HEARTBEAT))
+        self._last = (timestamp, boot_time, cumulative)
+        self._size += RECORD.size
+
+        now = time.monotonic()
+        if now - self._last_fsync >= self.fsync_interval:
+            os.fsync(self._fd)
+            self._last_fsync = now
+        return cumulative
+
+    # ---- 読み出し ----
+
+    def _record(self, view: mmap.mmap, index: int) -> Tuple[float, float, float]:
+        return struct.unpack_from('<ddd', view, self._offset(index))
+
+    def _cumulative_until(self, view: mmap.mmap, count: int, when: float) -> float:
+        """台帳の先頭から when 時点までの累積課金対象秒数"""
+        # timestamp <= when となる最後のレコードを二分探索
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<d', view, self._offset(mid))[0] <= when:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            # 最初のレコードより前: 最初の起動区間に含まれる分だけ数える
+            if count == 0:
+                return 0.0
+            first_timestamp, first_boot, _ = self._record(view, 0)
+            return -max(0.0, first_timestamp - max(first_boot, when))
+
+        timestamp, _, cumulative = self._record(view, lo - 1)
+        if lo == count:
+            # 最後のハートビート以降は稼働が確認できていないので数えない
+            return cumulative
+        next_timestamp, next_boot, _ = self._record(view, lo)
+        segment_start = max(next_boot, timestamp)
+        return cumulative + min(max(0.0, when - segment_start), next_timestamp - segment_start)
+
+    def billable_seconds(self, start: float, end: float) -> float:
+        """start〜end の間に稼働していた秒数（O(log n)）"""
+        if end <= start:
+            return 0.0
+        view = self._view()
+        count = (view.size() - HEADER.size) // RECORD.size
+        return self._cumulative_until(view, count, end) - self._cumulative_until(view, count, start)
+
+    def first_timestamp(self) -> Optional[float]:
+        """最初に記録された稼働開始時刻"""
+        view = self._view()
+        if view.size() <= HEADER.size:
+            return None
+        timestamp, boot_time, _ = self._record(view, 0)
+        return min(timestamp, boot_time)
+
+    def last_timestamp(self) -> Optional[float]:
+        """最後のハートビート時刻"""
+        return self._last[0] if self._last is not None else None
+
+
+if __name__ == "__main__":
+    import argparse
+    import datetime
+
+    parser = argparse.ArgumentParser(description="Uptime ledger tools")
+    parser.add_argument('path')
+    sub = parser.add_subparsers(dest='command', required=True)
+    query = sub.add_parser('query', help="billable seconds between two ISO timestamps")
+    query.add_argument('start')
+    query.add_argument('end')
+    bench = sub.add_parser('bench', help="append / query throughput")
+    bench.add_argument('--records', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    if args.command == 'query':
+        with UptimeLedger(args.path) as ledger:
+            start = datetime.datetime.fromisoformat(args.start).timestamp()
+            end = datetime.datetime.fromisoformat(args.end).timestamp()
+            print(f"⏱️  {ledger.billable_seconds(start, end):.0f} 秒 ({len(ledger)} レコード)")
+    else:
+        with UptimeLedger(args.path, fsync_interval=1.0) as ledger:
+            base = (ledger.last_timestamp() or time.time() - args.records) + 1
+            start = time.perf_counter()
+            for i in range(args.records):
+                ledger.append_heartbeat(base + i, base)
+            append_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(10000):
+                ledger.billable_seconds(base + i * 7, base + i * 97)
+            query_time = time.perf_counter() - start
+
+        print(f"📝 追記: {args.records / append_time:,.0f} レコード/秒")
+        print(f"🔍 範囲問い合わせ: {query_time / 10000 * 1e6:.1f} µs/回")
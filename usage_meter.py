@@ -0,0 +1,374 @@
+"""
+# usage_meter.py
+Coalescing Usage Meter
+従量課金の使用量（1分ごとの稼働秒数など）をメモリ上で顧客 × メーターごとに合算し、
+件数か時間のしきい値でまとめてStripeのメーターイベントとして送る。
+
+受け付けた使用量は先に先行書き込みログ（WAL, JSON Lines）へ追記するので、クラッシュしても失われない。
+送信はバッチ単位で「送信予定（intent）→ 送信 → 確定（commit）」の順にWALへ記録し、
+各イベントの identifier はWALごとのトークン + バッチ番号から決まるので、再起動後の再送は
+Stripe側で重複として弾かれ、請求される合計は常に記録した使用量と一致する。
+
+WALはプロセスごとに1ファイル（ディレクトリ内 usage-<pid>.wal）で、ファイルロックを持つ。
+ロックが外れたWAL（プロセスが落ちたもの）は他のメーターが引き取って送信し切ってから削除する。
+
+WALの行形式
+    {"t": "open", "wal": トークン}
+    {"t": "u", "s": 連番, "c": 顧客ID, "e": メーター名, "v": 値, "ts": UNIX時刻}   使用量
+    {"t": "b", "b": バッチ番号, "through": 連番, "items": [[顧客ID, メーター名, 値, identifier, 時刻], ...]}
+    {"t": "c", "b": バッチ番号}                                                     送信確定
+    {"t": "k", "s": 連番, "b": バッチ番号}                                          圧縮後のチェックポイント
+"""
+import asyncio
+import fcntl
+import glob
+import json
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from metrics import USAGE_RECORDED, USAGE_REPORTED
+
+UsageKey = Tuple[str, str]  # (customer_id, event_name)
+
+
+class UsageWAL:
+    """使用量の先行書き込みログ1ファイル分（排他ロック付き）"""
+
+    def __init__(self, path: str, fsync_interval: float = 0.0, blocking: bool = True,
+                 compact_bytes: int = 4 * 1024 * 1024):
+        self.path = path
+        self.fsync_interval = fsync_interval  # fsyncする最短間隔（秒）。0なら追記ごと
+        self.compact_bytes = compact_bytes  # 確定時にWALがこの大きさを超えていたら書き直す
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            os.close(self._fd)
+            raise
+        self._last_fsync = 0.0
+        self.unsynced = False  # fsync していない追記があるか
+
+        self.token = ''
+        self.seq = 0
+        self.batch_no = 0
+        self.pending: Dict[UsageKey, int] = {}  # まだバッチに入っていない合計
+        self.pending_records = 0
+        self.pending_timestamp = 0.0  # 未送信分の最新の使用時刻
+        self.batches: Dict[int, List[list]] = {}  # 未確定のバッチ番号 -> items
+        self._recover()
+
+    def _recover(self):
+        """WALを読み直して未送信の使用量と未確定のバッチを復元する（書きかけの最終行は無視）"""
+        records: List[Dict] = []
+        batches: Dict[int, Dict] = {}
+        through = 0  # ここまでの連番はバッチ（確定済み・未確定を問わず）かチェックポイントに入っている
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                kind = entry.get('t')
+                if kind == 'open':
+                    self.token = entry['wal']
+                elif kind == 'u':
+                    records.append(entry)
+                    self.seq = max(self.seq, entry['s'])
+                elif kind == 'b':
+                    batches[entry['b']] = entry
+                    self.batch_no = max(self.batch_no, entry['b'])
+                    through = max(through, entry['through'])
+                elif kind == 'c':
+                    batches.pop(entry['b'], None)
+                elif kind == 'k':
+                    self.seq = max(self.seq, entry['s'])
+                    self.batch_no = max(self.batch_no, entry['b'])
+                    through = max(through, entry['s'])
+
+        if not self.token:
+            self._start_new_file()
+            return
+        for record in records:
+            if record['s'] > through:
+                self._add_pending(record)
+        self.batches = {number: batch['items'] for number, batch in batches.items()}
+
+    def _start_new_file(self):
+        """新しいトークンでWALを書き始める（連番・バッチ番号はチェックポイントとして引き継ぐ）"""
+        self.token = uuid.uuid4().hex[:16]
+        os.ftruncate(self._fd, 0)
+        self._append({'t': 'open', 'wal': self.token}, sync=False)
+        self._append({'t': 'k', 's': self.seq, 'b': self.batch_no}, sync=True)
+
+    @staticmethod
+    def _line(entry: Dict) -> bytes:
+        return (json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n").encode('utf-8')
+
+    def _append(self, entry: Dict, sync: Optional[bool] = None):
+        os.write(self._fd, self._line(entry))
+        now = time.monotonic()
+        if sync or (sync is None and now - self._last_fsync >= self.fsync_interval):
+            os.fsync(self._fd)
+            self._last_fsync = now
+            self.unsynced = False
+        else:
+            self.unsynced = True
+
+    def sync(self):
+        """fsync していない追記があればディスクに書く"""
+        if self.unsynced and self._fd >= 0:
+            os.fsync(self._fd)
+            self._last_fsync = time.monotonic()
+            self.unsynced = False
+
+    def _add_pending(self, record: Dict):
+        key = (record['c'], record['e'])
+        self.pending[key] = self.pending.get(key, 0) + record['v']
+        self.pending_records += 1
+        self.pending_timestamp = max(self.pending_timestamp, record['ts'])
+
+    def append_usage(self, customer_id: str, event_name: str, value: int, timestamp: float):
+        """使用量を1件追記（WALに書いてから合算する）"""
+        self.seq += 1
+        record = {'t': 'u', 's': self.seq, 'c': customer_id, 'e': event_name, 'v': value, 'ts': timestamp}
+        self._append(record)
+        self._add_pending(record)
+
+    def begin_batch(self) -> Optional[int]:
+        """未送信の合計を1バッチにまとめ、送信予定としてWALに記録する"""
+        if not self.pending:
+            return None
+        self.batch_no += 1
+        timestamp = int(self.pending_timestamp)
+        items = [
+            [customer_id, event_name, value, f"{self.token}-{self.batch_no}-{index}", timestamp]
+            for index, ((customer_id, event_name), value) in enumerate(sorted(self.pending.items()))
+            if value
+        ]
+        self._append({'t': 'b', 'b': self.batch_no, 'through': self.seq, 'items': items}, sync=True)
+        self.batches[self.batch_no] = items
+        self.pending = {}
+        self.pending_records = 0
+        self.pending_timestamp = 0.0
+        return self.batch_no
+
+    def commit_batch(self, batch_no: int):
+        """バッチの送信完了を記録し、何も残っていなければWALを切り詰める
+
+        使用量が途切れず届いていると未送信分が空になることはほとんどないので、
+        WALが compact_bytes を超えていれば今の状態だけを書き直して大きさを戻す。
+        """
+        self._append({'t': 'c', 'b': batch_no}, sync=True)
+        self.batches.pop(batch_no, None)
+        if not self.batches and not self.pending:
+            self._start_new_file()
+        elif os.fstat(self._fd).st_size > self.compact_bytes:
+            self._compact()
+
+    def _compact(self):
+        """未確定のバッチ・チェックポイント・未送信の合計だけの新しいWALに置き換える
+
+        トークンは変えない（未確定のバッチの identifier に含まれているので、再送で重複として弾かれる）。
+        新しいファイルをロックしてから os.replace するので、置き換えの途中で他のメーターに引き取られない。
+        """
+        lines = [self._line({'t': 'open', 'wal': self.token})]
+        for number, items in sorted(self.batches.items()):
+            lines.append(self._line({'t': 'b', 'b': number, 'through': self.seq, 'items': items}))
+        lines.append(self._line({'t': 'k', 's': self.seq, 'b': self.batch_no}))
+        # 未送信分は顧客 × メーターごとの合計1行ずつにする（チェックポイントより後の連番）
+        timestamp = self.pending_timestamp
+        for (customer_id, event_name), value in sorted(self.pending.items()):
+            self.seq += 1
+            lines.append(self._line({'t': 'u', 's': self.seq, 'c': customer_id, 'e': event_name,
+                                     'v': value, 'ts': timestamp}))
+
+        compact_path = self.path + '.compact'
+        fd = os.open(compact_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, b''.join(lines))
+            os.fsync(fd)
+            os.replace(compact_path, self.path)
+        except BaseException:
+            os.close(fd)
+            raise
+        directory = os.open(os.path.dirname(self.path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        old_fd, self._fd = self._fd, fd
+        fcntl.flock(old_fd, fcntl.LOCK_UN)
+        os.close(old_fd)
+
+    def remove(self):
+        """空になった（引き取った）WALを削除する"""
+        os.unlink(self.path)
+        self.close()
+
+    def close(self):
+        if self._fd >= 0:
+            os.fsync(self._fd)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = -1
+
+
+class UsageMeter:
+    """使用量の合算とバッチ送信"""
+
+    def __init__(self, billing_manager, wal_dir: str = 'usage_wal', flush_interval: float = 60.0,
+                 flush_size: int = 10000, fsync_interval: float = 0.0, concurrency: int = 8):
+        self.billing_manager = billing_manager  # AsyncServerBillingManager
+        self.wal_dir = wal_dir
+        self.flush_interval = flush_interval  # この間隔で定期的に送る（秒）
+        self.flush_size = flush_size  # 未送信の記録がこの件数に達したら送る
+        self.concurrency = concurrency  # 1バッチ内で同時に送るイベント数
+        os.makedirs(wal_dir, exist_ok=True)
+        self.wal = UsageWAL(os.path.join(wal_dir, f"usage-{os.getpid()}.wal"), fsync_interval)
+
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sync_handle: Optional[asyncio.TimerHandle] = None
+
+        self.recorded = 0
+        self.recorded_value = 0
+        self.events_sent = 0
+        self.batches_sent = 0
+        self.failures = 0
+        self.adopted = 0
+        self.last_error: Optional[str] = None
+
+    # ---- 記録 ----
+
+    def record(self, customer_id: str, value: int, event_name: str = 'server_uptime_seconds',
+               timestamp: Optional[float] = None):
+        """使用量を記録する
+
+        WALへの追記が終わった時点でプロセスが落ちても失われない。fsync は fsync_interval 秒に1回までで、
+        それ以降に追記がなくても fsync_interval 秒後にはディスクに書く（電源断で失うのはその間の分だけ）。
+        """
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError(f"usage value must be a non-negative integer, got {value!r}")
+        self.wal.append_usage(customer_id, event_name, value, time.time() if timestamp is None else timestamp)
+        if self.wal.unsynced and self._sync_handle is None:
+            self._sync_handle = asyncio.get_running_loop().call_later(self.wal.fsync_interval, self._sync_wal)
+        self.recorded += 1
+        self.recorded_value += value
+        USAGE_RECORDED.labels(event_name).inc(value)
+        if self.wal.pending_records >= self.flush_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _sync_wal(self):
+        self._sync_handle = None
+        self.wal.sync()
+
+    # ---- 送信 ----
+
+    async def _send_batch(self, wal: UsageWAL, batch_no: int) -> bool:
+        items = wal.batches[batch_no]
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(item) -> Dict:
+            customer_id, event_name, value, identifier, timestamp = item
+            async with semaphore:
+                return await self.billing_manager.create_meter_event(
+                    customer_id, event_name, value, identifier, timestamp)
+
+        results = await asyncio.gather(*(send(item) for item in items))
+        failed = [result['error'] for result in results if not result['success']]
+        if failed:
+            # 成功した分も含めてバッチごと次回に再送する（identifier が同じなので二重計上されない）
+            self.failures += 1
+            self.last_error = failed[0]
+            print(f"❌ 使用量の送信エラー ({len(failed)}/{len(items)}件): {failed[0]}")
+            return False
+        wal.commit_batch(batch_no)
+        self.events_sent += len(items)
+        self.batches_sent += 1
+        for _, event_name, value, _, _ in items:
+            USAGE_REPORTED.labels(event_name).inc(value)
+        return True
+
+    async def _flush_wal(self, wal: UsageWAL) -> bool:
+        """未確定のバッチを再送してから、未送信分を新しいバッチにして送る"""
+        for batch_no in sorted(wal.batches):
+            if not await self._send_batch(wal, batch_no):
+                return False
+        batch_no = wal.begin_batch()
+        if batch_no is None:
+            return True
+        return await self._send_batch(wal, batch_no)
+
+    async def flush(self) -> bool:
+        """今ある使用量をすべて送る（失敗したバッチは次回再送）"""
+        async with self._flush_lock:
+            return await self._flush_wal(self.wal)
+
+    async def adopt_orphans(self):
+        """落ちたプロセスが残したWALを引き取って送信し、送り切ったら削除する"""
+        for path in glob.glob(os.path.join(self.wal_dir, 'usage-*.wal')):
+            if path == self.wal.path:
+                continue
+            try:
+                orphan = UsageWAL(path, blocking=False)
+            except (BlockingIOError, FileNotFoundError):
+                continue  # 稼働中のプロセスのWAL
+            try:
+                async with self._flush_lock:
+                    done = await self._flush_wal(orphan)
+                if done:
+                    orphan.remove()
+                    self.adopted += 1
+                else:
+                    orphan.close()
+            except Exception:
+                orphan.close()
+                raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.adopt_orphans()
+            await self.flush()
+
+    def start(self):
+        """定期送信を開始（起動時に残っているWALの再送も行う）"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._startup_and_run())
+
+    async def _startup_and_run(self):
+        await self.adopt_orphans()
+        await self.flush()
+        await self.run()
+
+    async def stop(self):
+        """定期送信を止め、残りを送る"""
+        if self._sync_handle is not None:
+            self._sync_handle.cancel()
+            self._sync_handle = None
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+        if self.wal.pending or self.wal.batches:
+            self.wal.close()  # 送れなかった分は次の起動時（か他のワーカー）が引き取る
+        else:
+            self.wal.remove()
+
+    def stats(self) -> Dict:
+        return {
+            'recorded': self.recorded,
+            'recorded_value': self.recorded_value,
+            'pending_records': self.wal.pending_records,
+            'unconfirmed_batches': len(self.wal.batches),
+            'events_sent': self.events_sent,
+            'batches_sent': self.batches_sent,
+            'failures': self.failures,
+            'adopted_wals': self.adopted,
+            'last_error': self.last_error,
+        }
@@ -1,18 +1,195 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-import uvicorn
+from contextlib import asynccontextmanager
+import asyncio
+import gzip
+import hashlib
+import hmac
+import math
 import os
-from server_billing import ServerBillingManager
+import time
 
-app = FastAPI(title="Server Billing System", version="1.0.0")
+try:
+    import brotli  # Optional: enables precompressed "br" variant of the dashboard
+except ImportError:
+    brotli = None
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+from server_billing import AsyncServerBillingManager
+from billing_stream import BillingStreamHub
+from bulk_invoicing import BulkInvoiceRun
+from webhooks import WebhookProcessor
+from periodic_billing import PeriodicCharger
+from usage_meter import UsageMeter
+from job_queue import JobWorker
+from node_agent import CONTENT_TYPE as HEARTBEAT_CONTENT_TYPE, decode_batch
+from node_registry import NodeRegistry
+import billing_export
+from api_responses import FastJSONResponse, payment_intent_response, payment_status_response
+from metrics import REGISTRY, MetricsMiddleware
+from pricing import currency_exponent
+from settings import get_settings
 
-# Initialize billing management system
-billing_manager = ServerBillingManager()
+# Heavy objects are built on first use (normally during lifespan startup) rather
+# than at import time, so importing this module stays cheap for workers and tests.
+_billing_manager: Optional[AsyncServerBillingManager] = None
+_billing_stream: Optional[BillingStreamHub] = None
+_webhook_processor: Optional[WebhookProcessor] = None
 
-@app.get("/", response_class=HTMLResponse)
-async def index():
-    """Main page"""
+def get_billing_manager() -> AsyncServerBillingManager:
+    """Billing manager (async variant so Stripe round trips never block the event loop)"""
+    global _billing_manager
+    if _billing_manager is None:
+        _billing_manager = AsyncServerBillingManager()
+    return _billing_manager
+
+def get_stream_hub() -> BillingStreamHub:
+    """Single ticker that pushes billing status to every connected dashboard"""
+    global _billing_stream
+    if _billing_stream is None:
+        _billing_stream = BillingStreamHub(get_billing_manager())
+    return _billing_stream
+
+def get_webhook_processor() -> WebhookProcessor:
+    """Stripe webhooks: verify + dedupe on the request path, process in background workers"""
+    global _webhook_processor
+    if _webhook_processor is None:
+        _webhook_processor = WebhookProcessor()
+        # Drop cached Stripe objects as soon as Stripe tells us they changed
+        _webhook_processor.add_listener(get_billing_manager().object_cache.invalidate_event)
+    return _webhook_processor
+
+# Bulk invoicing runs started through the API (run_id -> run)
+bulk_runs: Dict[str, BulkInvoiceRun] = {}
+bulk_tasks: Dict[str, asyncio.Task] = {}
+
+# Periodic charging (PERIODIC_CHARGE_CUSTOMER + uptime ledger); only the leader worker charges
+periodic_charger: Optional[PeriodicCharger] = None
+
+async def record_heartbeats(interval: float):
+    """Append uptime heartbeats to the ledger while the app is running (leader worker only)"""
+    billing_manager = get_billing_manager()
+    while True:
+        if billing_manager.try_lead():
+            billing_manager.record_heartbeat()
+        await asyncio.sleep(interval)
+
+_usage_meter: Optional[UsageMeter] = None
+
+def get_usage_meter() -> UsageMeter:
+    """Metered usage: appended to a write-ahead log, sent to Stripe in coalesced batches"""
+    global _usage_meter
+    if _usage_meter is None:
+        settings = get_billing_manager().settings
+        _usage_meter = UsageMeter(get_billing_manager(), settings.usage_wal_dir,
+                                  settings.usage_flush_interval, settings.usage_flush_size,
+                                  fsync_interval=settings.usage_fsync_interval)
+        _usage_meter.start()
+    return _usage_meter
+
+async def record_uptime_usage(customer_id: str, event_name: str, interval: float = 60.0):
+    """Record elapsed seconds as metered usage every interval (leader worker only)"""
+    billing_manager = get_billing_manager()
+    meter = get_usage_meter()
+    last = time.time()
+    while True:
+        await asyncio.sleep(interval)
+        now = time.time()
+        if billing_manager.try_lead():
+            seconds = int(now - last)
+            meter.record(customer_id, seconds, event_name, timestamp=now)
+            last += seconds  # carry the fractional second into the next interval
+        else:
+            last = now
+
+_node_registry: Optional[NodeRegistry] = None
+
+def get_node_registry() -> NodeRegistry:
+    """Per-node uptime reported by node_agent.py (independent of this server's billing manager)"""
+    global _node_registry
+    if _node_registry is None:
+        settings = get_settings()
+        _node_registry = NodeRegistry(stale_after=settings.node_stale_after, max_nodes=settings.max_nodes)
+    return _node_registry
+
+# Compressed heartbeat batches are a few hundred bytes; anything far larger is not an agent
+MAX_HEARTBEAT_BATCH_BYTES = 1024 * 1024
+
+_job_worker: Optional[JobWorker] = None
+
+def get_job_worker() -> JobWorker:
+    """Durable queue for invoices / test payments, drained by a background worker pool"""
+    global _job_worker
+    if _job_worker is None:
+        billing_manager = get_billing_manager()
+        settings = billing_manager.settings
+        _job_worker = JobWorker(billing_manager.job_queue, billing_manager, settings.job_workers,
+                                settings.job_batch_size, max_attempts=settings.job_max_attempts)
+        _job_worker.start()
+    return _job_worker
+
+async def maintain_leadership(interval: float = 2.0):
+    """Keep exactly one leader among the workers; a follower takes over if the leader exits"""
+    billing_manager = get_billing_manager()
+    while True:
+        billing_manager.try_lead()
+        await asyncio.sleep(interval)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    billing_manager = get_billing_manager()
+    billing_stream = get_stream_hub()
+    webhook_processor = get_webhook_processor()
+    get_index_page()
+    billing_stream.start()
+    webhook_processor.start()
+    # Accept requests right away; load the Stripe SDK and client off the event loop
+    # so the first payment does not stall every other request while it loads
+    stripe_warmup = asyncio.create_task(asyncio.to_thread(billing_manager.warm_up))
+    background_tasks = []
+    if billing_manager.shared_state is not None:
+        background_tasks.append(asyncio.create_task(maintain_leadership()))
+    if billing_manager.ledger is not None:
+        interval = billing_manager.settings.ledger_heartbeat_interval
+        background_tasks.append(asyncio.create_task(record_heartbeats(interval)))
+    customer_id = billing_manager.settings.periodic_charge_customer
+    if customer_id:
+        global periodic_charger
+        periodic_charger = PeriodicCharger(billing_manager, customer_id,
+                                           billing_manager.settings.periodic_charge_interval)
+        background_tasks.append(asyncio.create_task(periodic_charger.run()))
+    settings = billing_manager.settings
+    if settings.usage_customer:
+        background_tasks.append(asyncio.create_task(
+            record_uptime_usage(settings.usage_customer, settings.usage_event_name)))
+    elif os.path.isdir(settings.usage_wal_dir):
+        get_usage_meter()  # resend usage left in the write-ahead log by an earlier run
+    if os.path.exists(settings.job_queue_path):
+        get_job_worker()  # pick up jobs queued before a restart
+    if not get_settings().agent_token:
+        print(f"⚠️  AGENT_TOKEN is not set: POST /api/agent/heartbeats accepts any caller "
+              f"(registry capped at {get_settings().max_nodes} nodes)")
+    yield
+    stripe_warmup.cancel()
+    for task in background_tasks:
+        task.cancel()
+    await billing_stream.stop()
+    await webhook_processor.stop()
+    if _usage_meter is not None:
+        await _usage_meter.stop()
+    if _job_worker is not None:
+        await _job_worker.stop()
+    if billing_manager.resource_sampler is not None:
+        billing_manager.resource_sampler.close()
+    # Release pooled Stripe connections on shutdown
+    await billing_manager.aclose()
+
+app = FastAPI(title="Server Billing System", version="1.0.0", lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+def render_index_html(publishable_key: str, currency_exponent: int = 0) -> str:
+    """Render the dashboard HTML (only the publishable key and currency exponent are dynamic)"""
     html_content = f"""
     <!DOCTYPE html>
     <html lang="en">
@@ -123,15 +300,26 @@ async def index():
             </div>
             
             <div class="update-info">
-                <p>💡 Information is automatically updated every 30 seconds</p>
+                <p>💡 Information is updated live (every 30 seconds if the live stream is unavailable)</p>
             </div>
         </div>
 
         <script>
-            const stripe = Stripe('{billing_manager.publishable_key}');
+            const stripe = Stripe('{publishable_key}');
+            // Amounts from the API are in the currency's minor unit (cents for USD, yen for JPY)
+            const CURRENCY_EXPONENT = {currency_exponent};
+
+            function formatAmount(minor, currency) {{
+                const major = (minor / 10 ** CURRENCY_EXPONENT).toFixed(CURRENCY_EXPONENT);
+                return `${{major}} ${{currency.toUpperCase()}}`;
+            }}
             let cardElement;
             let clientSecret;
 
+            // Per-tab session ID: repeated clicks inside one billing window reuse the same Payment Intent
+            const sessionId = sessionStorage.getItem('billingSessionId') || crypto.randomUUID();
+            sessionStorage.setItem('billingSessionId', sessionId);
+
             async function setupStripeElements() {{
                 const elements = stripe.elements();
                 cardElement = elements.create('card', {{
@@ -155,6 +343,7 @@ async def index():
                         method: 'POST',
                         headers: {{
                             'Content-Type': 'application/json',
+                            'X-Session-Id': sessionId,
                         }}
                     }});
                     
@@ -165,7 +354,7 @@ async def index():
                         
                         // Show card input form
                         document.getElementById('payment-form').style.display = 'block';
-                        document.getElementById('payment-status').innerHTML = `💳 Please enter card information to complete payment (Billing amount: ${{data.billing_info.billing_amount}} yen)`;
+                        document.getElementById('payment-status').innerHTML = `💳 Please enter card information to complete payment (Billing amount: ${{formatAmount(data.billing_info.billing_amount, data.billing_info.currency)}})`;
                         document.getElementById('payment-status').style.background = '#d4edda';
                         document.getElementById('payment-status').style.color = '#155724';
                         
@@ -219,51 +408,438 @@ async def index():
                 document.getElementById('payment-status').style.color = '#721c24';
             }}
 
+            function renderBillingInfo(data) {{
+                document.getElementById('server-name').textContent = data.server_name;
+                document.getElementById('uptime').textContent = data.uptime;
+                document.getElementById('hourly-rate').textContent = `${{data.hourly_rate}} ${{data.currency.toUpperCase()}}/hour`;
+                document.getElementById('billing-amount').textContent = formatAmount(data.total_amount, data.currency);
+            }}
+
             async function updateBillingInfo() {{
                 try {{
                     const response = await fetch('/api/billing-status');
                     const data = await response.json();
                     
-                    document.getElementById('server-name').textContent = data.server_name;
-                    document.getElementById('uptime').textContent = data.uptime;
-                    document.getElementById('hourly-rate').textContent = `${{data.hourly_rate}} yen/hour`;
-                    document.getElementById('billing-amount').textContent = `${{data.total_amount}} yen`;
+                    renderBillingInfo(data);
                 }} catch (error) {{
                     console.error('Error updating billing info:', error);
                 }}
             }}
 
+            let pollTimer = null;
+
+            function startPolling() {{
+                if (!pollTimer) {{
+                    pollTimer = setInterval(updateBillingInfo, 30000);
+                }}
+            }}
+
+            function stopPolling() {{
+                if (pollTimer) {{
+                    clearInterval(pollTimer);
+                    pollTimer = null;
+                }}
+            }}
+
+            function startBillingStream() {{
+                if (!window.EventSource) {{
+                    startPolling();
+                    return;
+                }}
+                const source = new EventSource('/api/billing-stream');
+                source.onopen = () => stopPolling();
+                source.onmessage = (event) => renderBillingInfo(JSON.parse(event.data));
+                source.onerror = () => {{
+                    // Poll while the stream is unavailable; retry the stream if it was closed for good
+                    startPolling();
+                    if (source.readyState === EventSource.CLOSED) {{
+                        setTimeout(startBillingStream, 30000);
+                    }}
+                }};
+            }}
+
             // Get billing information on initialization
             updateBillingInfo();
             
-            // Auto-update every 30 seconds
-            setInterval(updateBillingInfo, 30000);
+            // Live updates from the server stream (falls back to 30-second polling)
+            startBillingStream();
         </script>
     </body>
     </html>
     """
     return html_content
 
+class PrecompressedPage:
+    """Immutable page body held as identity / gzip / brotli bytes with ETags"""
+
+    def __init__(self, html: str, media_type: str = "text/html; charset=utf-8"):
+        self.media_type = media_type
+        body = html.encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:16]
+
+        # encoding -> (body, etag)
+        self.variants = {"identity": (body, f'"{digest}"')}
+        self.variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gz"')
+        if brotli is not None:
+            self.variants["br"] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+        self.etags = {etag for _, etag in self.variants.values()}
+
+    def choose_encoding(self, accept_encoding: str) -> str:
+        """Pick the best available encoding from an Accept-Encoding header"""
+        accepted = {}
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.strip().partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[name.strip()] = quality
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return "identity"
+
+    def response(self, request: Request) -> Response:
+        """Serve the precomputed variant, or 304 when If-None-Match matches"""
+        encoding = self.choose_encoding(request.headers.get("accept-encoding", ""))
+        body, etag = self.variants[encoding]
+        headers = {
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+            "Cache-Control": "no-cache",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in candidates or candidates & self.etags:
+                return Response(status_code=304, headers=headers)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type=self.media_type, headers=headers)
+
+# Render the dashboard once; serving "/" is then just handing out bytes
+_index_page: Optional[PrecompressedPage] = None
+
+def get_index_page() -> PrecompressedPage:
+    global _index_page
+    if _index_page is None:
+        billing_manager = get_billing_manager()
+        _index_page = PrecompressedPage(render_index_html(billing_manager.publishable_key,
+                                                          currency_exponent(billing_manager.currency)))
+    return _index_page
+
+@app.get("/", response_class=HTMLResponse)
+async def index(request: Request):
+    """Main page"""
+    return get_index_page().response(request)
+
 @app.post("/api/create-payment-intent")
-async def create_payment_intent():
-    """Create Payment Intent"""
-    result = billing_manager.create_payment_intent()
-    return JSONResponse(content=result)
+async def create_payment_intent(request: Request):
+    """Create Payment Intent (deduplicated by Idempotency-Key or X-Session-Id)"""
+    result = await get_billing_manager().create_payment_intent(
+        idempotency_key=request.headers.get('idempotency-key'),
+        session_id=request.headers.get('x-session-id'),
+    )
+    # Only the fields the page uses (client secret, amount, status), not the whole PaymentIntent
+    content = payment_intent_response(result)
+    if 'retry_after' in result:
+        # Stripe is unhealthy or overloaded: we failed fast without calling it
+        return FastJSONResponse(status_code=503, content=content,
+                                headers={'Retry-After': str(math.ceil(result['retry_after']))})
+    return FastJSONResponse(content=content)
+
+def snapshot_response(request: Request, snapshot: dict, body: bytes) -> Response:
+    """Serve a pre-serialized snapshot body with ETag / Cache-Control (304 on match)"""
+    max_age = max(0, math.floor(snapshot['expires_at'] - time.time()))
+    headers = {
+        'ETag': snapshot['etag'],
+        'Cache-Control': f"private, max-age={max_age}",
+    }
+    if request.headers.get('if-none-match') == snapshot['etag']:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 @app.get("/api/billing-status")
-async def get_billing_status():
+async def get_billing_status(request: Request):
     """Get current billing status"""
-    return JSONResponse(content=billing_manager.get_billing_summary())
+    snapshot = get_billing_manager().get_billing_snapshot()
+    return snapshot_response(request, snapshot, snapshot['summary_json'])
+
+@app.get("/api/billing-stream")
+async def get_billing_stream():
+    """Stream billing status as Server-Sent Events"""
+    billing_stream = get_stream_hub()
+    subscriber = billing_stream.subscribe()
+    return StreamingResponse(
+        billing_stream.stream(subscriber),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/webhooks/stripe")
+async def stripe_webhook(request: Request):
+    """Receive Stripe webhooks (acknowledged immediately, processed in the background)"""
+    payload = await request.body()
+    status_code, content = get_webhook_processor().receive(payload, request.headers.get('stripe-signature'))
+    return JSONResponse(status_code=status_code, content=content)
+
+@app.get("/webhooks/stripe/stats")
+async def stripe_webhook_stats():
+    """Webhook receive / processing counters"""
+    return JSONResponse(content=get_webhook_processor().stats())
+
+class BulkInvoiceRequest(BaseModel):
+    run_id: str
+    customer_ids: List[str]
+    concurrency: int = 8
+    period_start: Optional[float] = None
+    period_end: Optional[float] = None
+
+@app.post("/api/invoices/bulk", status_code=202)
+async def start_bulk_invoicing(body: BulkInvoiceRequest):
+    """Start (or resume) a bulk invoicing run in the background"""
+    task = bulk_tasks.get(body.run_id)
+    if task is not None and not task.done():
+        raise HTTPException(status_code=409, detail=f"run {body.run_id} is already in progress")
+
+    try:
+        bulk_run = BulkInvoiceRun(
+            get_billing_manager(),
+            body.run_id,
+            concurrency=body.concurrency,
+            period_start=body.period_start,
+            period_end=body.period_end,
+        )
+    except ValueError as e:
+        # Resuming with a different period would change every remaining amount
+        raise HTTPException(status_code=409, detail=str(e))
+    bulk_runs[body.run_id] = bulk_run
+    bulk_tasks[body.run_id] = asyncio.create_task(bulk_run.run(body.customer_ids))
+    return JSONResponse(status_code=202, content={'run_id': body.run_id, 'status_url': f"/api/invoices/bulk/{body.run_id}"})
+
+@app.get("/api/invoices/bulk/{run_id}")
+async def get_bulk_invoicing(run_id: str):
+    """Get progress, throughput and latency of a bulk invoicing run"""
+    bulk_run = bulk_runs.get(run_id)
+    if bulk_run is None:
+        raise HTTPException(status_code=404, detail=f"unknown run {run_id}")
+    return JSONResponse(content=bulk_run.report())
+
+class UsageRecord(BaseModel):
+    customer_id: str
+    value: int
+    event_name: Optional[str] = None
+
+@app.post("/api/usage", status_code=202)
+async def record_usage(body: UsageRecord):
+    """Record metered usage (crash-safe once acknowledged, fsynced within USAGE_FSYNC_INTERVAL; sent in batches)"""
+    meter = get_usage_meter()
+    try:
+        meter.record(body.customer_id, body.value,
+                     body.event_name or get_billing_manager().settings.usage_event_name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(status_code=202, content={'recorded': True})
+
+@app.get("/api/usage/stats")
+async def get_usage_stats():
+    """Recorded vs. reported usage and pending write-ahead log entries"""
+    return JSONResponse(content=get_usage_meter().stats())
+
+class InvoiceJobRequest(BaseModel):
+    customer_id: str
+    period_start: Optional[float] = None
+    period_end: Optional[float] = None
+
+def job_accepted(job: dict) -> JSONResponse:
+    """202 with the job ID and where to poll it"""
+    return JSONResponse(status_code=202, content={
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'status_url': f"/api/jobs/{job['job_id']}",
+    })
+
+@app.post("/api/jobs/invoices", status_code=202)
+async def enqueue_invoice(body: InvoiceJobRequest, request: Request):
+    """Queue an invoice and return right away (same Idempotency-Key returns the same job)"""
+    get_job_worker()
+    return job_accepted(get_billing_manager().enqueue_invoice(
+        body.customer_id, body.period_start, body.period_end,
+        idempotency_key=request.headers.get('idempotency-key'),
+    ))
+
+@app.post("/api/jobs/test-payments", status_code=202)
+async def enqueue_test_payment(request: Request):
+    """Queue a server-side test payment and return right away"""
+    get_job_worker()
+    return job_accepted(get_billing_manager().enqueue_test_payment(
+        idempotency_key=request.headers.get('idempotency-key'),
+    ))
+
+@app.get("/api/jobs")
+async def get_job_stats():
+    """Jobs by status and this worker's drain counters"""
+    return JSONResponse(content=get_job_worker().stats())
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Status, attempts and result of a queued job"""
+    job = get_billing_manager().job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"unknown job {job_id}")
+    return JSONResponse(content=job)
+
+@app.get("/api/export/{kind}")
+async def export_billing_history(kind: str, format: str = 'ndjson', since: Optional[float] = None,
+                                 row_group_size: int = 10000):
+    """Stream payment intents or invoices (newest first) as NDJSON, CSV, Parquet or Arrow
+
+    Pages are fetched from Stripe as the body is sent, one row group at a time, so
+    memory stays flat however long the history is. `since` is a UNIX timestamp.
+    """
+    kinds = {plural: name for name, (_, plural) in billing_export.EXPORT_OBJECTS.items()}
+    if kind not in kinds:
+        raise HTTPException(status_code=404, detail=f"unknown export {kind} (choose from {', '.join(kinds)})")
+    if format not in billing_export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"unknown format {format}")
+    if format in ('parquet', 'arrow') and billing_export.pyarrow is None:
+        raise HTTPException(status_code=501, detail="Parquet / Arrow export requires pyarrow")
+    # A plain generator: Starlette iterates it in the threadpool, so the Stripe
+    # page requests never block the event loop
+    body = billing_export.stream_export(get_billing_manager(), kinds[kind], format, since,
+                                        max(1, min(row_group_size, 100000)))
+    filename = f"{kind}.{billing_export.EXTENSIONS[format]}"
+    return StreamingResponse(body, media_type=billing_export.FORMATS[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.get("/api/uptime")
-async def get_uptime():
+async def get_uptime(request: Request):
     """Get server uptime"""
-    return JSONResponse(content=billing_manager.get_server_uptime())
+    snapshot = get_billing_manager().get_billing_snapshot()
+    return snapshot_response(request, snapshot, snapshot['uptime_json'])
+
+@app.get("/api/cluster-status")
+async def get_cluster_status():
+    """Which worker answered, whether it is the leader, and the shared state it sees"""
+    billing_manager = get_billing_manager()
+    content = {
+        'pid': os.getpid(),
+        'is_leader': billing_manager.leader.is_leader if billing_manager.leader is not None else True,
+        'shared_state': billing_manager.shared_state.stats() if billing_manager.shared_state is not None else None,
+        'periodic_charging': periodic_charger.stats() if periodic_charger is not None else None,
+    }
+    return JSONResponse(content=content)
+
+@app.get("/api/stripe-health")
+async def get_stripe_health():
+    """Circuit breaker state and in-flight outbound Stripe calls for this worker"""
+    return JSONResponse(content=get_billing_manager().resilience.stats())
+
+@app.get("/api/payment-status/{payment_intent_id}")
+async def get_payment_status(payment_intent_id: str):
+    """Payment status, served from the Stripe object cache when possible"""
+    result = await get_billing_manager().get_payment_status(payment_intent_id)
+    if result.get('not_found'):
+        raise HTTPException(status_code=404, detail=result['error'])
+    content = payment_status_response(result)
+    if 'retry_after' in result:
+        return FastJSONResponse(status_code=503, content=content,
+                                headers={'Retry-After': str(math.ceil(result['retry_after']))})
+    return FastJSONResponse(content=content)
+
+@app.get("/api/stripe-cache")
+async def get_stripe_cache_stats():
+    """Hit/miss counts, sizes and TTLs of the Stripe object cache, per object type"""
+    return JSONResponse(content=get_billing_manager().object_cache.stats())
+
+@app.get("/api/resource-usage")
+async def get_resource_usage():
+    """Latest /proc sample, usage since boot and the sampler's own cost (RESOURCE_BILLING only)"""
+    billing_manager = get_billing_manager()
+    sampler = billing_manager.resource_sampler
+    if sampler is None:
+        raise HTTPException(status_code=404, detail="Resource billing is not enabled")
+    return JSONResponse(content={
+        'latest': sampler.latest(),
+        'usage': sampler.usage(billing_manager.boot_timestamp),
+        'rates': billing_manager.resource_rate.describe(),
+        'sampler': sampler.stats(),
+    })
+
+@app.post("/api/agent/heartbeats")
+async def ingest_heartbeats(request: Request):
+    """Receive a compressed heartbeat batch from a node agent and apply it in one pass"""
+    token = get_settings().agent_token
+    if token and not hmac.compare_digest(request.headers.get('authorization', ''), f"Bearer {token}"):
+        raise HTTPException(status_code=401, detail="invalid agent token")
+    if request.headers.get('content-type') != HEARTBEAT_CONTENT_TYPE:
+        raise HTTPException(status_code=415, detail=f"expected {HEARTBEAT_CONTENT_TYPE}")
+    # Refuse on the declared length first, then stop reading as soon as the cap is passed
+    # (chunked bodies have no Content-Length), so an oversized body is never buffered whole
+    try:
+        declared = int(request.headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid Content-Length")
+    if declared > MAX_HEARTBEAT_BATCH_BYTES:
+        raise HTTPException(status_code=413, detail="heartbeat batch too large")
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > MAX_HEARTBEAT_BATCH_BYTES:
+            raise HTTPException(status_code=413, detail="heartbeat batch too large")
+    try:
+        frames = decode_batch(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return JSONResponse(content={'success': True, **get_node_registry().apply(frames)})
+
+@app.get("/api/nodes")
+async def get_nodes(offset: int = 0, limit: int = 100):
+    """Nodes reporting through agents: totals plus one page of per-node state"""
+    registry = get_node_registry()
+    return JSONResponse(content={'stats': registry.stats(), 'nodes': registry.list(offset, min(limit, 1000))})
+
+@app.get("/api/nodes/{node_id}")
+async def get_node(node_id: str):
+    """Uptime, last heartbeat and gaps of one node"""
+    node = get_node_registry().get(node_id)
+    if node is None:
+        raise HTTPException(status_code=404, detail=f"unknown node {node_id}")
+    return JSONResponse(content=node)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics (Stripe call latency/errors, handler latency, billed amounts)"""
+    return Response(content=REGISTRY.render(), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
-    port = int(os.getenv('PORT', 8000))
+    import argparse
+
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Server Billing System web app")
+    parser.add_argument('--workers', type=int,
+                        help="production mode: run N worker processes sharing billing state (no auto-reload)")
+    parser.add_argument('--host', default='0.0.0.0')
+    args = parser.parse_args()
+
+    port = get_settings().port
     print(f"🌐 Starting Server Billing System...")
     print(f"📍 URL: http://localhost:{port}")
     print(f"💡 Access with browser to test payments")
-    
-    uvicorn.run("web_app:app", host="0.0.0.0", port=port, reload=True)
+
+    if args.workers is None:
+        # Development: single process with auto-reload
+        uvicorn.run("web_app:app", host=args.host, port=port, reload=True)
+    else:
+        import psutil
+        from shared_state import SharedBillingState
+
+        # Workers inherit the path through the environment and share one state file
+        state_path = os.environ.setdefault('SHARED_STATE_PATH', 'billing_state.bin')
+        SharedBillingState(state_path, psutil.boot_time()).begin_run()
+        print(f"👷 {args.workers} workers, shared state: {state_path}")
+        uvicorn.run("web_app:app", host=args.host, port=port, workers=args.workers, log_level='warning')
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Webhookリプレイツール
+署名付きのStripeイベント（payment_intent.succeeded / invoice.payment_succeeded）を生成して
+/webhooks/stripe へ同時に送り込み、受付と処理の持続スループット（イベント/秒）を計測する。
+Stripeの再送を模して一定割合で同じイベントを重複送信する。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from typing import List
+
+import httpx
+import stripe
+
+
+def make_event(index: int) -> dict:
+    """テスト用のStripeイベント"""
+    if index % 2 == 0:
+        event_type = 'payment_intent.succeeded'
+        obj = {
+            'id': f"pi_{uuid.uuid4().hex[:24]}",
+            'object': 'payment_intent',
+            'amount': random.randint(1, 10000),
+            'currency': 'jpy',
+            'metadata': {'server_name': 'ReplayServer', 'uptime_hours': '1.5'},
+        }
+    else:
+        event_type = 'invoice.payment_succeeded'
+        obj = {
+            'id': f"in_{uuid.uuid4().hex[:24]}",
+            'object': 'invoice',
+            'customer': f"cus_{index:08d}",
+            'amount_paid': random.randint(1, 10000),
+            'currency': 'jpy',
+            'metadata': {'server_name': 'ReplayServer'},
+        }
+    return {
+        'id': f"evt_{uuid.uuid4().hex[:24]}",
+        'object': 'event',
+        'type': event_type,
+        'created': int(time.time()),
+        'data': {'object': obj},
+    }
+
+
+def build_payloads(events: int, duplicate_ratio: float, secret: str) -> List[tuple]:
+    """署名済みの (payload, header) のリスト（重複送信を含む）"""
+    payloads = []
+    for i in range(events):
+        body = json.dumps(make_event(i))
+        payloads.append((body, stripe.WebhookSignature.generate_signature_header(body, secret)))
+    duplicates = random.sample(payloads, int(len(payloads) * duplicate_ratio))
+    payloads.extend(duplicates)
+    random.shuffle(payloads)
+    return payloads
+
+
+async def replay(base_url: str, payloads: List[tuple], concurrency: int) -> dict:
+    queue: asyncio.Queue = asyncio.Queue()
+    for item in payloads:
+        queue.put_nowait(item)
+    statuses: dict = {}
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=30,
+                                 limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def sender():
+            while not queue.empty():
+                body, header = queue.get_nowait()
+                response = await client.post('/webhooks/stripe', content=body, headers={
+                    'Stripe-Signature': header, 'Content-Type': 'application/json'})
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        send_elapsed = time.perf_counter() - start
+
+        # バックグラウンド処理が追いつくまで待つ
+        while True:
+            stats = (await client.get('/webhooks/stripe/stats')).json()
+            if stats['queued'] == 0 and stats['processed'] + stats['failed'] + stats['ignored'] >= stats['received']:
+                break
+            await asyncio.sleep(0.01)
+        total_elapsed = time.perf_counter() - start
+
+    return {
+        'sent': len(payloads),
+        'statuses': statuses,
+        'send_elapsed': send_elapsed,
+        'total_elapsed': total_elapsed,
+        'stats': stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay signed Stripe webhooks and measure events/s")
+    parser.add_argument('--url', help="running app (default: start web_app in-process)")
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--duplicates', type=float, default=0.1, help="fraction re-sent as duplicates")
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--secret', default=os.getenv('STRIPE_WEBHOOK_SECRET', 'whsec_replay_test'))
+    args = parser.parse_args()
+
+    payloads = build_payloads(args.events, args.duplicates, args.secret)
+
+    server = thread = None
+    base_url = args.url
+    if base_url is None:
+        os.environ['STRIPE_WEBHOOK_SECRET'] = args.secret
+        os.environ.setdefault('WEBHOOK_RESULTS_PATH', os.devnull)
+        from fake_stripe import run_app_in_thread
+        import web_app
+
+        server, thread, base_url = run_app_in_thread(web_app.app)
+    try:
+        result = asyncio.run(replay(base_url, payloads, args.concurrency))
+    finally:
+        if server is not None:
+            server.should_exit = True
+            thread.join(timeout=10)
+
+    print("\n" + "=" * 50)
+    print(f"📨 Webhookリプレイ結果 ({result['sent']}件送信, 同時 {args.concurrency})")
+    print("=" * 50)
+    print(f"HTTPステータス: {result['statuses']}")
+    print(f"受付スループット: {result['sent'] / result['send_elapsed']:,.0f} イベント/秒")
+    print(f"処理完了まで: {result['stats']['processed'] / result['total_elapsed']:,.0f} イベント/秒")
+    print(f"処理状況: {result['stats']}")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
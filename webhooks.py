@@ -0,0 +1,192 @@
+"""
+# webhooks.py
+Stripe Webhook Processor
+署名検証とイベントIDによる重複排除だけをリクエスト経路で行い、すぐに2xxを返す。
+イベント本体はインメモリキューを通じてバックグラウンドのワーカーが処理し、
+処理結果はまとめて（バッチで）JSON Lines ファイルへ書き出す。
+"""
+import asyncio
+import json
+from typing import Callable, Dict, List, Optional, Tuple
+
+from settings import get_settings
+from ttl_cache import TTLCache
+
+EventHandler = Callable[[Dict], Optional[Dict]]
+
+
+def handle_payment_intent_succeeded(event: Dict) -> Dict:
+    """payment_intent.succeeded の結果レコード"""
+    intent = event['data']['object']
+    metadata = intent.get('metadata') or {}
+    return {
+        'event_id': event['id'],
+        'type': event['type'],
+        'payment_intent_id': intent.get('id'),
+        'amount': intent.get('amount'),
+        'currency': intent.get('currency'),
+        'server_name': metadata.get('server_name'),
+        'uptime_hours': metadata.get('uptime_hours'),
+        'created': event.get('created'),
+    }
+
+
+def handle_invoice_payment_succeeded(event: Dict) -> Dict:
+    """invoice.payment_succeeded の結果レコード"""
+    invoice = event['data']['object']
+    metadata = invoice.get('metadata') or {}
+    return {
+        'event_id': event['id'],
+        'type': event['type'],
+        'invoice_id': invoice.get('id'),
+        'customer': invoice.get('customer'),
+        'amount_paid': invoice.get('amount_paid'),
+        'currency': invoice.get('currency'),
+        'server_name': metadata.get('server_name'),
+        'billing_period': metadata.get('billing_period'),
+        'created': event.get('created'),
+    }
+
+
+DEFAULT_HANDLERS: Dict[str, EventHandler] = {
+    'payment_intent.succeeded': handle_payment_intent_succeeded,
+    'invoice.payment_succeeded': handle_invoice_payment_succeeded,
+}
+
+
+class WebhookProcessor:
+    """Webhookの受付（検証・重複排除・キュー投入）とバックグラウンド処理"""
+
+    def __init__(self, secret: Optional[str] = None, results_path: Optional[str] = None,
+                 workers: int = 4, queue_size: int = 10000, dedupe_size: int = 100000,
+                 dedupe_ttl: float = 3 * 24 * 3600, batch_size: int = 500,
+                 flush_interval: float = 1.0, tolerance: int = 300,
+                 handlers: Optional[Dict[str, EventHandler]] = None):
+        settings = get_settings()
+        self.secret = secret if secret is not None else settings.stripe_webhook_secret
+        self.results_path = results_path or settings.webhook_results_path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.tolerance = tolerance  # 署名タイムスタンプの許容誤差（秒）
+        self.handlers = dict(DEFAULT_HANDLERS if handlers is None else handlers)
+
+        # Stripeは同じイベントを再送してくるのでIDで弾く（件数・期間とも上限付き）
+        self.seen_events = TTLCache(maxsize=dedupe_size, ttl=dedupe_ttl)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batch: List[Dict] = []
+        self._tasks: List[asyncio.Task] = []
+        self._write_lock = asyncio.Lock()
+        self._listeners: List[Callable[[Dict], object]] = []
+
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.ignored = 0
+        self.failed = 0
+        self.written = 0
+
+    def add_listener(self, callback: Callable[[Dict], object]):
+        """受け付けたイベントごとにリクエスト経路で呼ぶコールバック（キャッシュの無効化など軽い処理だけ）"""
+        self._listeners.append(callback)
+
+    # ---- リクエスト経路 ----
+
+    def receive(self, payload: bytes, signature: Optional[str]) -> Tuple[int, Dict]:
+        """署名を検証してキューに積む。(HTTPステータス, 応答ボディ) を返す"""
+        import stripe  # 初回のWebhook受信まで読み込まない（2回目以降は sys.modules を引くだけ）
+
+        try:
+            stripe.WebhookSignature.verify_header(payload, signature, self.secret, self.tolerance)
+            event = json.loads(payload)
+            event_id = event['id']
+        except (stripe.SignatureVerificationError, ValueError, KeyError, TypeError) as e:
+            self.rejected += 1
+            return 400, {'error': f"invalid webhook: {e}"}
+
+        if event_id in self.seen_events:
+            self.duplicates += 1
+            return 200, {'received': True, 'duplicate': True}
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 受け付けられないときは5xxでStripeに再送させる
+            return 503, {'error': 'webhook queue is full'}
+
+        self.seen_events.set(event_id, True)
+        self.received += 1
+        for callback in self._listeners:
+            callback(event)
+        return 200, {'received': True}
+
+    # ---- バックグラウンド処理 ----
+
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            try:
+                handler = self.handlers.get(event.get('type'))
+                if handler is None:
+                    self.ignored += 1
+                    continue
+                record = handler(event)
+                if record is not None:
+                    self._batch.append(record)
+                    if len(self._batch) >= self.batch_size:
+                        await self.flush()
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"❌ Webhook処理エラー ({event.get('id')}): {e}")
+            finally:
+                self.queue.task_done()
+
+    async def _flusher(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _write_batch(self, batch: List[Dict]):
+        with open(self.results_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch))
+
+    async def flush(self):
+        """溜まった結果レコードをまとめて書き出す"""
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        async with self._write_lock:
+            await asyncio.to_thread(self._write_batch, batch)
+        self.written += len(batch)
+
+    def start(self):
+        """ワーカーとフラッシャーを起動"""
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._flusher()))
+
+    async def stop(self, drain: bool = True):
+        """（キューを処理し切ってから）停止し、残りの結果を書き出す"""
+        if drain and self._tasks:
+            await self.queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.flush()
+
+    def stats(self) -> Dict:
+        """受付・処理状況"""
+        return {
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'queued': self.queue.qsize(),
+            'processed': self.processed,
+            'ignored': self.ignored,
+            'failed': self.failed,
+            'written': self.written,
+        }